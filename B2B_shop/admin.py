@@ -1,27 +1,114 @@
+from django.conf import settings
 from django.contrib import admin, messages
-from django.db import transaction
-from .models import Seller, CreditRequest, TransactionLog, Charge
-from django.db.models import F
+from .models import (
+    Seller, SellerCreditShard, CreditRequest, CreditApprovalRule, TransactionLog, Charge, ChargeBatch,
+    CreditTransfer, ReconciliationCheckpoint
+)
+from .sharding import enable_credit_sharding
+from .approvals import approve_credit_requests, reject_credit_requests
+
+class SellerCreditShardInline(admin.TabularInline):
+    model = SellerCreditShard
+    readonly_fields = ('index', 'credit')
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
 
 @admin.register(Seller)
 class SellerAdmin(admin.ModelAdmin):
-    list_display = ('name', 'credit')
-    readonly_fields = ('credit',)
+    list_display = ('name', 'credit', 'shard_count')
+    # Written by the ledger only: an edited ledger_seq would break the seller's (seller, seq) chain
+    readonly_fields = ('credit', 'shard_count', 'ledger_seq')
+    fieldsets = (
+        (None, {'fields': ('user', 'name', 'parent', 'credit', 'shard_count', 'ledger_seq')}),
+        ('Admission limits', {
+            'description': "Empty fields use the defaults from the settings, 0 turns a limit off. "
+                           "Changes reach every web process within AUTH_TOKEN_LOCAL_CACHE_TTL seconds.",
+            'fields': ('charge_rate_limit', 'charge_rate_burst', 'max_inflight_charges', 'credit_request_rate_limit'),
+        }),
+    )
+    raw_id_fields = ('parent',)
+    inlines = [SellerCreditShardInline]
+    actions = ['enable_sharding']
+    # Changed by the ledger while a change form is open, so never written back from it
+    ledger_fields = ('credit', 'ledger_seq', 'shard_count')
+
+    def save_model(self, request, obj, form, change):
+        """
+        Saves an edited seller without the ledger's columns: a full save would write back the
+        balance read when the form was loaded and undo every charge settled since.
+        """
+        if not change:
+            return super().save_model(request, obj, form, change)
+        obj.save(update_fields=[
+            field.name for field in obj._meta.concrete_fields
+            if not field.primary_key and field.name not in self.ledger_fields
+        ])
+
+    @admin.action(description='Enable credit sharding for selected sellers')
+    def enable_sharding(self, request, queryset):
+        """
+        Admin action to split the credit of hot sellers into SELLER_CREDIT_SHARDS shards.
+        """
+        enabled = 0
+        for seller in queryset.filter(shard_count=0):
+            try:
+                enable_credit_sharding(seller.id, settings.SELLER_CREDIT_SHARDS)
+                enabled += 1
+            except Exception as e:
+                self.message_user(request, f"Error enabling sharding for {seller.name}: {e}", messages.ERROR)
+
+        self.message_user(request, f"Successfully enabled sharding for {enabled} sellers.", messages.SUCCESS)
 
 @admin.register(TransactionLog)
 class TransactionLogAdmin(admin.ModelAdmin):
     list_display = ('seller', 'transaction_type', 'amount', 'balance_after', 'created_at')
     list_filter = ('seller', 'transaction_type')
+    ordering = ('-created_at',)
     readonly_fields = [f.name for f in TransactionLog._meta.fields] # All fields read-only
 
 @admin.register(Charge)
 class ChargeAdmin(admin.ModelAdmin):
     list_display = ('seller', 'phone_number', 'amount', 'status', 'created_at')
+    search_fields = ('=phone_number',)
+
+@admin.register(ChargeBatch)
+class ChargeBatchAdmin(admin.ModelAdmin):
+    list_display = ('seller', 'mode', 'status', 'line_count', 'total_amount',
+                    'completed_count', 'failed_count', 'created_at')
+    list_filter = ('status', 'mode')
+    readonly_fields = ('completed_count', 'failed_count', 'processed_at')
+
+@admin.register(CreditTransfer)
+class CreditTransferAdmin(admin.ModelAdmin):
+    list_display = ('sender', 'recipient', 'amount', 'created_at')
+    raw_id_fields = ('sender', 'recipient')
+    readonly_fields = [f.name for f in CreditTransfer._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(ReconciliationCheckpoint)
+class ReconciliationCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('seller', 'status', 'entry_count', 'checked_at')
+    list_filter = ('status',)
+    readonly_fields = [f.name for f in ReconciliationCheckpoint._meta.fields]
+
+@admin.register(CreditApprovalRule)
+class CreditApprovalRuleAdmin(admin.ModelAdmin):
+    """
+    Edits reach every web process within AUTO_APPROVAL_RULES_CHECK_INTERVAL seconds.
+    """
+    list_display = ('__str__', 'trusted', 'max_amount', 'daily_cap', 'updated_at')
+    list_select_related = ('seller',)
+    raw_id_fields = ('seller',)
 
 @admin.register(CreditRequest)
 class CreditRequestAdmin(admin.ModelAdmin):
-    list_display = ('seller', 'amount', 'status', 'created_at')
-    list_filter = ('status',)
+    list_display = ('seller', 'amount', 'status', 'auto_approved', 'created_at')
+    list_filter = ('status', 'auto_approved')
     actions = ['approve_requests', 'reject_requests']
 
     def has_delete_permission(self, request, obj=None):
@@ -31,68 +118,25 @@ class CreditRequestAdmin(admin.ModelAdmin):
     def approve_requests(self, request, queryset):
         """
         Admin action to approve credit requests.
-        This operation is atomic to ensure data integrity[cite: 18].
-        It prevents a request from being processed more than once[cite: 14].
+        The whole selection is approved in one atomic, set-based transaction[cite: 18].
+        Requests that are not pending anymore are skipped, so none is processed twice[cite: 14].
         """
-        # Filter for only pending requests to avoid re-approving
-        pending_requests = queryset.filter(status='pending')
-        
-        for credit_request in pending_requests:
-            try:
-                with transaction.atomic():
-                    credit_request = CreditRequest.objects.select_for_update().get(pk=credit_request.pk)
-                    if credit_request.status != 'pending':
-                        # skip it, someone else already did it
-                        continue
-
-                    # Lock the seller row to prevent race conditions during update
-                    seller = Seller.objects.select_for_update().get(pk=credit_request.seller.id)
-
-                    Seller.objects.filter(pk=seller.pk) \
-                                .update(credit=F('credit') + credit_request.amount)
-                    
-                    # Now reload seller.credit if you need it for the log:
-                    seller.refresh_from_db()
-                    
-                    # Update request status
-                    credit_request.status = 'approved'
-                    credit_request.save()
-                    
-                    # Create a log for the transaction
-                    TransactionLog.objects.create(
-                        seller=seller,
-                        transaction_type='add_credit',
-                        amount=credit_request.amount,
-                        balance_after=seller.credit
-                    )
-            except Exception as e:
-                self.message_user(request, f"Error approving request for {credit_request.seller.name}: {e}", messages.ERROR)
-        
-        self.message_user(request, f"Successfully approved {pending_requests.count()} requests.", messages.SUCCESS)
+        result = approve_credit_requests(queryset.values_list('pk', flat=True))
+
+        for error in result.errors:
+            self.message_user(request, f"Error approving requests for {error}", messages.ERROR)
+        self.message_user(
+            request,
+            f"Approved {result.approved} requests, skipped {result.skipped} already processed, "
+            f"failed {result.failed}.",
+            messages.SUCCESS if not result.failed else messages.WARNING
+        )
 
     @admin.action(description='Reject selected credit requests')
     def reject_requests(self, request, queryset):
         """
         Admin action to reject credit requests.
-        This operation is atomic to ensure data integrity.
+        Only pending requests are rejected, in a single atomic UPDATE.
         """
-        # Filter for only pending requests to avoid re-rejecting
-        pending_requests = queryset.filter(status='pending')
-        
-        for credit_request in pending_requests:
-            try:
-                with transaction.atomic():
-                    credit_request = CreditRequest.objects.select_for_update().get(pk=credit_request.pk)
-                    if credit_request.status != 'pending':
-                        # skip it, someone else already processed it
-                        continue
-
-                    # Update request status to rejected
-                    credit_request.status = 'rejected'
-                    credit_request.save()
-                    
-            except Exception as e:
-                self.message_user(request, f"Error rejecting request for {credit_request.seller.name}: {e}", messages.ERROR)
-        
-        self.message_user(request, f"Successfully rejected {pending_requests.count()} requests.", messages.SUCCESS)
-
+        rejected = reject_credit_requests(queryset.values_list('pk', flat=True))
+        self.message_user(request, f"Successfully rejected {rejected} requests.", messages.SUCCESS)
@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import CreditRequest
+from .ledger import MAX_CREDIT, Posting, apply_postings
+
+ApprovalResult = namedtuple('ApprovalResult', 'approved skipped failed errors')
+
+
+def approve_credit_requests(request_ids, auto_approved=False):
+    """
+    Approves the given credit requests in one set-based transaction.
+    Pending requests are locked in primary key order and posted to the ledger, which
+    locks their sellers in the same order and adds the sum of each seller's requests
+    to its credit in one UPDATE; all statuses flip in one UPDATE.
+    Requests that are no longer pending are skipped; a seller whose balance would
+    overflow fails with all of its requests.
+    `auto_approved` marks the requests as approved by an approval rule.
+    """
+    request_ids = set(request_ids)
+
+    with transaction.atomic():
+        # Only the requests: their sellers are locked by the ledger, in seller order
+        pending = list(
+            CreditRequest.objects.select_for_update(of=('self',))
+            .filter(pk__in=request_ids, status='pending')
+            .order_by('pk')
+            .values_list('pk', 'seller_id', 'amount', 'seller__name')
+        )
+        posted = apply_postings(
+            Posting(seller_id, amount, 'add_credit', reference=pk) for pk, seller_id, amount, _ in pending
+        )
+        approved_ids = [posting.reference for posting in posted.applied]
+        CreditRequest.objects.filter(pk__in=approved_ids).update(
+            status='approved', auto_approved=auto_approved, updated_at=timezone.now()
+        )
+
+    names = {seller_id: name for _, seller_id, _, name in pending}
+    return ApprovalResult(
+        approved=len(approved_ids),
+        skipped=len(request_ids) - len(pending),
+        failed=len(posted.rejected),
+        errors=[
+            f"{names[seller_id]}: credit would exceed {MAX_CREDIT}"
+            for seller_id in dict.fromkeys(posting.seller_id for posting in posted.rejected)
+        ],
+    )
+
+
+def reject_credit_requests(request_ids):
+    """
+    Rejects the pending requests among the given ones with a single UPDATE.
+    Returns the number of requests rejected.
+    """
+    return CreditRequest.objects.filter(pk__in=set(request_ids), status='pending') \
+        .update(status='rejected', updated_at=timezone.now())
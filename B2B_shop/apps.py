@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class B2BShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'B2B_shop'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        # Installs the query profiling wrapper on every new connection
+        from . import profiling  # noqa: F401
@@ -0,0 +1,195 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Seller
+from .serializers import ChargeSerializer, CreditRequestSerializer, TransactionLogSerializer
+from .authentication import aauthenticate_token
+from .charging import submit_charge
+from .charge_status import await_charge, parse_wait
+from .auto_approval import submit_credit_request
+from . import idempotency
+from .idempotency import IDEMPOTENCY_KEY_HEADER
+from .ratelimit import check_rate
+from .history import (
+    EXPORT_CONTENT_TYPES, seller_transactions, parse_page_size, keyset_page, split_page, astream_export
+)
+
+
+async def aauthenticate(request):
+    """
+    Async counterpart of the token authentication of the DRF views.
+    Resolves `Authorization: Token <key>` through the same token caches.
+    """
+    auth = request.headers.get('Authorization', '').split()
+    if len(auth) != 2 or auth[0].lower() != 'token':
+        return None
+    return await aauthenticate_token(auth[1])
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return JsonResponse(data, status=status_code, encoder=JSONEncoder, safe=False)
+
+
+def throttled_response(exc):
+    """
+    The 429 DRF's exception handler builds for a Throttled exception.
+    """
+    response = json_response({"detail": exc.detail}, status.HTTP_429_TOO_MANY_REQUESTS)
+    response['Retry-After'] = str(exc.wait)
+    return response
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncSellerView(View):
+    """
+    Base class for async endpoints of an authenticated seller.
+    Handlers receive the seller as an extra argument. Views with a `throttle_scope`
+    apply its rate limits like the DRF views' SellerRateThrottle.
+    """
+    throttle_scope = None
+
+    async def dispatch(self, request, *args, **kwargs):
+        user = await aauthenticate(request)
+        if user is None:
+            return json_response(
+                {"detail": "Authentication credentials were not provided or are invalid."},
+                status.HTTP_401_UNAUTHORIZED
+            )
+        try:
+            seller = user.seller
+        except Seller.DoesNotExist:
+            return json_response(
+                {"error": "No seller account found for this user"},
+                status.HTTP_400_BAD_REQUEST
+            )
+        if self.throttle_scope:
+            wait = await sync_to_async(check_rate)(seller, self.throttle_scope)
+            if wait is not None:
+                return throttled_response(exceptions.Throttled(wait))
+        return await super().dispatch(request, seller, *args, **kwargs)
+
+    def request_data(self, request):
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+
+
+class AsyncChargeView(AsyncSellerView):
+    """
+    Async version of ChargeAPIView.
+    Only validation and rate limiting run on the event loop: the charge itself is submitted
+    through sync_to_async, so each request in progress holds a thread and a database connection.
+    """
+    throttle_scope = 'charge'
+
+    async def post(self, request, seller):
+        data = self.request_data(request)
+        if data is None:
+            return json_response({"error": "Invalid JSON body"}, status.HTTP_400_BAD_REQUEST)
+
+        serializer = ChargeSerializer(data=data)
+        if not serializer.is_valid():
+            return json_response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if idempotency_key is not None:
+            error = idempotency.validate_key(idempotency_key)
+            if error:
+                return json_response({"error": error}, status.HTTP_400_BAD_REQUEST)
+
+        # The write path needs a transaction or the broker client, both blocking.
+        # Under ASGI each request gets its own sync thread, so charges do not queue on one thread
+        try:
+            response_data, status_code = await sync_to_async(submit_charge)(
+                seller,
+                serializer.validated_data['amount'],
+                str(serializer.validated_data['phone_number']),
+                idempotency_key,
+            )
+        except exceptions.Throttled as exc:
+            return throttled_response(exc)
+        return json_response(response_data, status_code)
+
+
+class AsyncChargeDetailView(AsyncSellerView):
+    """
+    Async version of ChargeDetailAPIView. A long poll waits on the event loop
+    instead of holding a thread for up to CHARGE_STATUS_MAX_WAIT seconds.
+    """
+
+    async def get(self, request, seller, charge_id):
+        try:
+            wait = parse_wait(request.GET.get('wait'))
+        except ValueError as e:
+            return json_response({"error": str(e)}, status.HTTP_400_BAD_REQUEST)
+
+        data = await await_charge(seller.id, charge_id, wait)
+        if data is None:
+            return json_response({"error": "Charge not found"}, status.HTTP_404_NOT_FOUND)
+        return json_response(data)
+
+
+class AsyncCreditRequestView(AsyncSellerView):
+    """
+    Async version of CreditRequestAPIView.
+    The request is created (and auto-approved) through sync_to_async, so each request in
+    progress holds a thread and a database connection.
+    """
+    throttle_scope = 'credit_request'
+
+    async def post(self, request, seller):
+        data = self.request_data(request)
+        if data is None:
+            return json_response({"error": "Invalid JSON body"}, status.HTTP_400_BAD_REQUEST)
+
+        serializer = CreditRequestSerializer(data={'amount': data.get('amount'), 'seller': seller.pk})
+        # validating the seller field looks it up in the database
+        if not await sync_to_async(serializer.is_valid)():
+            return json_response(serializer.errors, status.HTTP_400_BAD_REQUEST)
+
+        try:
+            credit_request = await sync_to_async(submit_credit_request)(seller, serializer.validated_data['amount'])
+        except IntegrityError as e:
+            return json_response({"error": str(e)}, status.HTTP_400_BAD_REQUEST)
+        return json_response(CreditRequestSerializer(credit_request).data, status.HTTP_201_CREATED)
+
+
+class AsyncTransactionsView(AsyncSellerView):
+    """
+    Async version of TransactionsAPIView.
+    """
+
+    async def get(self, request, seller):
+        transactions = seller_transactions(seller, request.GET)
+
+        export_format = request.GET.get('export')
+        if export_format:
+            if export_format not in EXPORT_CONTENT_TYPES:
+                return json_response({"error": "Unsupported export format"}, status.HTTP_400_BAD_REQUEST)
+            response = StreamingHttpResponse(
+                astream_export(transactions, export_format),
+                content_type=EXPORT_CONTENT_TYPES[export_format]
+            )
+            response['Content-Disposition'] = f'attachment; filename="transactions.{export_format}"'
+            return response
+
+        try:
+            page_size = parse_page_size(request.GET.get('page_size'))
+            rows = [log async for log in keyset_page(transactions, request.GET.get('cursor'), page_size)]
+        except ValueError as e:
+            return json_response({"error": str(e)}, status.HTTP_400_BAD_REQUEST)
+
+        rows, next_cursor = split_page(rows, page_size)
+        return json_response({
+            "results": TransactionLogSerializer(rows, many=True).data,
+            "next_cursor": next_cursor,
+        })
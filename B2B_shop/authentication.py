@@ -0,0 +1,191 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .models import Seller
+
+CACHE_KEY = 'auth_token:{digest}'
+# Seller fields carried by the cached identity, the admission limits checked before the view
+IDENTITY_LIMIT_FIELDS = ('charge_rate_limit', 'charge_rate_burst', 'max_inflight_charges', 'credit_request_rate_limit')
+
+
+class LocalLRUCache:
+    """
+    Small thread-safe in-process LRU with a per-entry TTL.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_tokens = LocalLRUCache(
+    max_size=settings.AUTH_TOKEN_LOCAL_CACHE_SIZE,
+    ttl=settings.AUTH_TOKEN_LOCAL_CACHE_TTL,
+)
+
+
+def _digest(key):
+    # Never store raw tokens as cache keys
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _identity_from_token(token):
+    """
+    The cached identity of a token: everything the views need before the debit.
+    """
+    user = token.user
+    try:
+        seller = user.seller
+    except Seller.DoesNotExist:
+        seller = None
+    return {
+        'user_id': user.pk,
+        'username': user.username,
+        'is_active': user.is_active,
+        'seller_id': seller.pk if seller else None,
+        'seller_name': seller.name if seller else None,
+        'shard_count': seller.shard_count if seller else 0,
+        'limits': {field: getattr(seller, field) for field in IDENTITY_LIMIT_FIELDS} if seller else {},
+    }
+
+
+def _user_from_identity(identity):
+    """
+    Builds the request user without touching the database.
+    The attached seller only carries identity fields, not the current credit.
+    """
+    user = User(pk=identity['user_id'], username=identity['username'], is_active=identity['is_active'])
+    if identity['seller_id'] is not None:
+        user.seller = Seller(
+            pk=identity['seller_id'],
+            user_id=identity['user_id'],
+            name=identity['seller_name'],
+            shard_count=identity['shard_count'],
+            **identity.get('limits', {}),
+        )
+    return user
+
+
+def resolve_token(key):
+    """
+    Resolves a token key to its identity: local LRU, then Redis, then the database.
+    Returns None for unknown tokens.
+    """
+    digest = _digest(key)
+    identity = local_tokens.get(digest)
+    if identity is not None:
+        return identity
+
+    identity = cache.get(CACHE_KEY.format(digest=digest))
+    if identity is None:
+        try:
+            token = Token.objects.select_related('user__seller').get(key=key)
+        except Token.DoesNotExist:
+            return None
+        identity = _identity_from_token(token)
+        cache.set(CACHE_KEY.format(digest=digest), identity, timeout=settings.AUTH_TOKEN_CACHE_TTL)
+
+    local_tokens.set(digest, identity)
+    return identity
+
+
+async def aresolve_token(key):
+    """
+    Async version of resolve_token.
+    """
+    digest = _digest(key)
+    identity = local_tokens.get(digest)
+    if identity is not None:
+        return identity
+
+    identity = await cache.aget(CACHE_KEY.format(digest=digest))
+    if identity is None:
+        try:
+            token = await Token.objects.select_related('user__seller').aget(key=key)
+        except Token.DoesNotExist:
+            return None
+        identity = _identity_from_token(token)
+        await cache.aset(CACHE_KEY.format(digest=digest), identity, timeout=settings.AUTH_TOKEN_CACHE_TTL)
+
+    local_tokens.set(digest, identity)
+    return identity
+
+
+def invalidate_token(key):
+    digest = _digest(key)
+    local_tokens.delete(digest)
+    cache.delete(CACHE_KEY.format(digest=digest))
+
+
+def invalidate_user_tokens(user_id):
+    """
+    Drops the cached identity of every token of a user.
+    Other processes may keep their local copy for up to AUTH_TOKEN_LOCAL_CACHE_TTL.
+    """
+    for key in Token.objects.filter(user_id=user_id).values_list('key', flat=True):
+        invalidate_token(key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that resolves tokens from the caches, so an authenticated
+    request needs no database query before the view runs.
+    """
+
+    def authenticate_credentials(self, key):
+        identity = resolve_token(key)
+        if identity is None:
+            raise exceptions.AuthenticationFailed('Invalid token.')
+        if not identity['is_active']:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+
+        user = _user_from_identity(identity)
+        return user, Token(key=key, user=user)
+
+
+async def aauthenticate_token(key):
+    """
+    Returns the active user of a token key for the async views, or None.
+    """
+    identity = await aresolve_token(key)
+    if identity is None or not identity['is_active']:
+        return None
+    return _user_from_identity(identity)
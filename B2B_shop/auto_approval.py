@@ -0,0 +1,167 @@
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from .approvals import approve_credit_requests
+from .metrics import Counter
+from .models import CreditApprovalRule, CreditRequest
+
+VERSION_KEY = 'approval_rules:version'
+DAILY_TOTAL_KEY = 'auto_approved:{seller_id}:{day}'
+# Daily totals outlive their day, whatever the time zone
+DAILY_TOTAL_TTL = 2 * 24 * 60 * 60
+
+AUTO_APPROVALS_TOTAL = Counter(
+    'b2b_credit_request_auto_approvals_total', "New credit requests by approval rule outcome"
+)
+
+# A CreditApprovalRule as evaluated: no queries, no model instances
+Rule = namedtuple('Rule', 'trusted max_amount daily_cap')
+
+
+def compile_rules():
+    """
+    {seller_id: Rule} of every approval rule, the default rule under None.
+    """
+    return {
+        seller_id: Rule(trusted, max_amount, daily_cap)
+        for seller_id, trusted, max_amount, daily_cap
+        in CreditApprovalRule.objects.values_list('seller_id', 'trusted', 'max_amount', 'daily_cap')
+    }
+
+
+class ApprovalRules:
+    """
+    The compiled approval rules of this process.
+    They are reloaded when the version in the shared cache, bumped by every rule edit, has
+    changed; the version is looked up at most every AUTO_APPROVAL_RULES_CHECK_INTERVAL
+    seconds, so between lookups evaluating a request is a dictionary lookup.
+    """
+
+    def __init__(self):
+        self._rules = None
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, seller_id):
+        """
+        The rule of a seller, else the default rule, else None.
+        """
+        now = time.monotonic()
+        if self._rules is None or now - self._checked_at >= settings.AUTO_APPROVAL_RULES_CHECK_INTERVAL:
+            self._refresh(now)
+        rules = self._rules
+        return rules[seller_id] if seller_id in rules else rules.get(None)
+
+    def _refresh(self, now):
+        # Read before the rules: an edit in between only makes the next check reload again
+        version = cache.get(VERSION_KEY)
+        with self._lock:
+            if self._rules is None or version != self._version:
+                self._rules = compile_rules()
+                self._version = version
+            self._checked_at = now
+
+    def clear(self):
+        with self._lock:
+            self._rules = None
+
+
+approval_rules = ApprovalRules()
+
+
+def invalidate_approval_rules():
+    """
+    Makes every process reload the rules: this one now, the others at their next version check.
+    """
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+    approval_rules.clear()
+
+
+def matches(rule, amount):
+    return rule is not None and (rule.trusted or (rule.max_amount is not None and amount <= rule.max_amount))
+
+
+def _daily_total_key(seller_id):
+    return DAILY_TOTAL_KEY.format(seller_id=seller_id, day=timezone.localdate().isoformat())
+
+
+def _reserve_daily_cap(seller_id, daily_cap, amount):
+    """
+    Adds `amount` to the seller's credit approved automatically today unless that would
+    exceed `daily_cap`. The total is kept in cents in the shared cache, so concurrent
+    requests of a seller cannot both slip under the cap.
+    """
+    if daily_cap is None:
+        return True
+    key, cents = _daily_total_key(seller_id), int(amount * 100)
+    cache.add(key, 0, timeout=DAILY_TOTAL_TTL)
+    if cache.incr(key, cents) <= daily_cap * 100:
+        return True
+    cache.decr(key, cents)
+    return False
+
+
+def _release_daily_cap(seller_id, daily_cap, amount):
+    if daily_cap is None:
+        return
+    try:
+        cache.decr(_daily_total_key(seller_id), int(amount * 100))
+    except ValueError:
+        # The day is over, or the total was evicted
+        pass
+
+
+def auto_approve(credit_request, rule):
+    """
+    Approves a new pending credit request through approve_credit_requests(), in the
+    caller's transaction, if the seller's approval `rule` allows it.
+    Returns whether it was approved; other requests are left for an admin. The daily
+    cap reserved for it is released if the approval fails here, and is the caller's
+    to release if its transaction then fails (see submit_credit_request).
+    """
+    if not matches(rule, credit_request.amount) or \
+            not _reserve_daily_cap(credit_request.seller_id, rule.daily_cap, credit_request.amount):
+        AUTO_APPROVALS_TOTAL.inc(outcome='pending')
+        return False
+
+    try:
+        result = approve_credit_requests([credit_request.pk], auto_approved=True)
+    except Exception:
+        _release_daily_cap(credit_request.seller_id, rule.daily_cap, credit_request.amount)
+        raise
+    if not result.approved:
+        # The credit would overflow
+        _release_daily_cap(credit_request.seller_id, rule.daily_cap, credit_request.amount)
+        AUTO_APPROVALS_TOTAL.inc(outcome='failed')
+        return False
+
+    credit_request.status, credit_request.auto_approved = 'approved', True
+    AUTO_APPROVALS_TOTAL.inc(outcome='approved')
+    return True
+
+
+def submit_credit_request(seller, amount):
+    """
+    Creates a credit request and approves it right away if the approval rules allow it,
+    in one transaction. If the transaction fails after the approval, the approval's
+    share of the daily cap is released with it.
+    """
+    rule = approval_rules.get(seller.pk) if settings.AUTO_APPROVAL_ENABLED else None
+    approved = False
+    try:
+        with transaction.atomic():
+            credit_request = CreditRequest.objects.create(seller=seller, amount=amount)
+            approved = auto_approve(credit_request, rule)
+    except Exception:
+        if approved:
+            _release_daily_cap(seller.pk, rule.daily_cap, amount)
+        raise
+    return credit_request
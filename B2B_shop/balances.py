@@ -0,0 +1,170 @@
+import threading
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Seller
+
+BALANCE_KEY = 'seller_balance:{seller_id}'
+CENT = Decimal('0.01')
+
+# Stores snapshot ARGV[1..3] (credit, last_seq, updated_at) in hash KEYS[1] for ARGV[4]
+# seconds unless the hash holds a higher last_seq, in which case that one is kept.
+# Returns the snapshot now stored.
+STORE_BALANCE = """
+local current = redis.call('HMGET', KEYS[1], 'credit', 'last_seq', 'updated_at')
+if current[2] and tonumber(current[2]) > tonumber(ARGV[2]) then
+    return current
+end
+redis.call('HSET', KEYS[1], 'credit', ARGV[1], 'last_seq', ARGV[2], 'updated_at', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {ARGV[1], ARGV[2], ARGV[3]}
+"""
+
+
+def _balance_key(seller_id):
+    return BALANCE_KEY.format(seller_id=seller_id)
+
+
+def _snapshot(credit, last_seq):
+    return {
+        'credit': str(Decimal(credit).quantize(CENT)),
+        'last_seq': last_seq,
+        'updated_at': timezone.now().isoformat(),
+    }
+
+
+def read_balances(seller_ids):
+    """
+    {seller_id: snapshot} of the committed balances, read without locks in one query.
+    last_seq counts the entries issued on all of a seller's balance chains, so it only
+    ever grows; for sharded sellers the credit is the sum of the shards.
+    """
+    rows = Seller.objects.filter(pk__in=seller_ids).annotate(
+        shard_credit=Sum('credit_shards__credit'), shard_seq=Sum('credit_shards__ledger_seq')
+    ).values_list('pk', 'credit', 'shard_count', 'ledger_seq', 'shard_credit', 'shard_seq')
+    return {
+        pk: _snapshot(shard_credit or 0, ledger_seq + (shard_seq or 0)) if shard_count
+        else _snapshot(credit, ledger_seq)
+        for pk, credit, shard_count, ledger_seq, shard_credit, shard_seq in rows
+    }
+
+
+class RedisBalances:
+    """
+    Snapshots kept as Redis hashes, each compare-and-set one atomic script call.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def _decode(values):
+        credit, last_seq, updated_at = (value.decode() for value in values)
+        return {'credit': credit, 'last_seq': int(last_seq), 'updated_at': updated_at}
+
+    def get(self, key):
+        values = self.client.hmget(key, 'credit', 'last_seq', 'updated_at')
+        return None if values[1] is None else self._decode(values)
+
+    def store(self, key, snapshot, timeout):
+        return self._decode(self.client.register_script(STORE_BALANCE)(
+            keys=[key], args=[snapshot['credit'], snapshot['last_seq'], snapshot['updated_at'], timeout]
+        ))
+
+
+class CacheBalances:
+    """
+    The same on a cache that is not Redis (tests, a single process),
+    atomic within this process only.
+    """
+    _lock = threading.Lock()
+
+    def get(self, key):
+        return cache.get(key)
+
+    def store(self, key, snapshot, timeout):
+        with self._lock:
+            cached = cache.get(key)
+            if cached is not None and cached['last_seq'] > snapshot['last_seq']:
+                return cached
+            cache.set(key, snapshot, timeout=timeout)
+        return snapshot
+
+
+def _balances():
+    backend = caches['default']
+    if isinstance(backend, RedisCache):
+        return RedisBalances(backend._cache.get_client(write=True))
+    return CacheBalances()
+
+
+def cached_balance(seller_id):
+    """
+    The cached snapshot of the seller's balance, or None.
+    """
+    return _balances().get(_balance_key(seller_id))
+
+
+def store_balance(seller_id, snapshot):
+    """
+    Caches a snapshot unless a newer one (higher last_seq) is already there, as one
+    atomic compare-and-set, so snapshots published out of order never go back in time.
+    Returns the snapshot left in the cache.
+    """
+    return _balances().store(_balance_key(seller_id), snapshot, settings.BALANCE_CACHE_TTL)
+
+
+def publish_balance(seller_id, credit=None, last_seq=None):
+    """
+    Writes the seller's balance snapshot through to the cache once the current
+    transaction commits; nothing is published if it rolls back.
+    Paths that know the new credit and seq (a Seller row UPDATE ... RETURNING) pass them,
+    otherwise the committed balance is read back after the commit.
+    """
+    if credit is not None:
+        snapshot = _snapshot(credit, last_seq)
+        transaction.on_commit(lambda: store_balance(seller_id, snapshot))
+    else:
+        publish_balances([seller_id])
+
+
+def publish_balances(seller_ids):
+    """
+    Reads back and caches the balances of several sellers after the commit.
+    """
+    seller_ids = list(seller_ids)
+
+    def publish():
+        for seller_id, snapshot in read_balances(seller_ids).items():
+            store_balance(seller_id, snapshot)
+
+    transaction.on_commit(publish)
+
+
+def seller_balance(seller_id):
+    """
+    The seller's balance for the balance endpoint: the cached snapshot, or the database
+    on a miss. age_seconds says how long ago the value was read from a committed state;
+    a cached snapshot is at most BALANCE_CACHE_TTL old.
+    """
+    snapshot = cached_balance(seller_id)
+    source = 'cache'
+    if snapshot is None:
+        # A snapshot published since the read wins over it
+        read = read_balances([seller_id])[seller_id]
+        snapshot = store_balance(seller_id, read)
+        source = 'database' if snapshot == read else 'cache'
+
+    age = timezone.now() - parse_datetime(snapshot['updated_at'])
+    return {
+        **snapshot,
+        'source': source,
+        'age_seconds': round(max(age.total_seconds(), 0.0), 3),
+    }
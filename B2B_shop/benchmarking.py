@@ -0,0 +1,83 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize_latencies(latencies, elapsed):
+    """
+    Summarizes request latencies (in seconds) of a run that took `elapsed` seconds.
+    """
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput_per_sec': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else None,
+    }
+
+
+async def http_request(url, method='GET', headers=None, body=None):
+    """
+    Minimal HTTP/1.1 client on asyncio streams, so thousands of requests can be in
+    flight from one process. Returns the response status code.
+    """
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    reader, writer = await asyncio.open_connection(
+        parts.hostname, port, ssl=parts.scheme == 'https'
+    )
+    payload = json.dumps(body).encode() if body is not None else b''
+    lines = [
+        f"{method} {parts.path or '/'}{'?' + parts.query if parts.query else ''} HTTP/1.1",
+        f"Host: {parts.netloc}",
+        "Connection: close",
+        f"Content-Length: {len(payload)}",
+    ]
+    if body is not None:
+        lines.append("Content-Type: application/json")
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + payload)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    return int(status_line.split()[1])
+
+
+async def run_http_load(url, total, concurrency, method='GET', headers=None, body=None):
+    """
+    Sends `total` requests with at most `concurrency` in flight.
+    Returns (latencies of successful requests, status code counts, elapsed seconds).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, statuses = [], {}
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                code = await http_request(url, method, headers, body)
+            except OSError:
+                code = 'error'
+            statuses[code] = statuses.get(code, 0) + 1
+            if code != 'error' and code < 500:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    return latencies, statuses, time.perf_counter() - start
@@ -0,0 +1,274 @@
+import asyncio
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import transaction
+from redis import asyncio as aioredis
+
+from .models import Charge
+from .idempotency import charge_result
+from .ratelimit import release_inflight
+
+STATUS_KEY = 'charge_status:{charge_id}'
+# Pub/sub channel announcing that a charge left 'pending'
+CHANNEL = 'charge_done:{charge_id}'
+# How long to wait for Redis to confirm a subscription (seconds)
+SUBSCRIBE_TIMEOUT = 1
+
+# In-process channels, used when the cache is not Redis (tests, a single process)
+_local_waiters = defaultdict(set)
+_local_lock = threading.Lock()
+
+
+def _status_key(charge_id):
+    return STATUS_KEY.format(charge_id=charge_id)
+
+
+def _redis():
+    backend = caches['default']
+    return backend._cache if isinstance(backend, RedisCache) else None
+
+
+def parse_wait(value):
+    """
+    The seconds a charge lookup may wait, from its `wait` parameter, at most
+    CHARGE_STATUS_MAX_WAIT. Raises ValueError if it is not a number of seconds.
+    """
+    wait = float(value or 0)
+    if not (math.isfinite(wait) and wait >= 0):
+        raise ValueError("wait must be a number of seconds")
+    return min(wait, settings.CHARGE_STATUS_MAX_WAIT)
+
+
+def pending_result(charge_id, amount):
+    return {
+        "charge_id": str(charge_id),
+        "status": "pending",
+        "amount": str(amount),
+        "balance_after": None,
+    }
+
+
+def failed_result(charge_id, amount, error):
+    """
+    The outcome of a charge that failed before a Charge row was written.
+    """
+    return {
+        "charge_id": str(charge_id),
+        "status": "failed",
+        "amount": str(amount),
+        "balance_after": None,
+        "error": error,
+    }
+
+
+def remember_pending(seller_id, charge_id, amount):
+    """
+    Records an accepted charge before its task runs, so its id can be looked up
+    before the Charge row exists. Never replaces an outcome that is already known.
+    """
+    cache.add(
+        _status_key(charge_id), (seller_id, pending_result(charge_id, amount)),
+        timeout=settings.CHARGE_STATUS_TTL
+    )
+
+
+def publish_charge_results(seller_id, results):
+    """
+    Caches the outcomes of a seller's charges and wakes their waiters once the
+    current transaction commits; nothing is published if it rolls back.
+    Settled charges stop counting against the seller's in-flight cap.
+    """
+    results = list(results)
+    if not results:
+        return
+
+    def publish():
+        cache.set_many(
+            {_status_key(result['charge_id']): (seller_id, result) for result in results},
+            timeout=settings.CHARGE_STATUS_TTL
+        )
+        release_inflight(seller_id, [result['charge_id'] for result in results if result['status'] != 'pending'])
+        channels = [CHANNEL.format(charge_id=result['charge_id']) for result in results]
+        redis = _redis()
+        if redis is None:
+            with _local_lock:
+                for channel in channels:
+                    for event in _local_waiters.get(channel, ()):
+                        event.set()
+            return
+        pipeline = redis.get_client(write=True).pipeline(transaction=False)
+        for channel, result in zip(channels, results):
+            pipeline.publish(channel, result['status'])
+        pipeline.execute()
+
+    transaction.on_commit(publish)
+
+
+def publish_charge_result(charge, balance_after=None, shard_balance_after=None):
+    publish_charge_results(charge.seller_id, [charge_result(charge, balance_after, shard_balance_after)[0]])
+
+
+def lookup_charge(seller_id, charge_id):
+    """
+    The seller's charge as charge_result data, or None if it has no such charge.
+    Outcomes published by the workers are served from the cache, older charges
+    from the Charge table.
+    """
+    cached = cache.get(_status_key(charge_id))
+    if cached is not None:
+        owner, result = cached
+        return result if owner == seller_id else None
+
+    charge = Charge.objects.filter(pk=charge_id, seller_id=seller_id).first()
+    return charge_result(charge)[0] if charge is not None else None
+
+
+async def alookup_charge(seller_id, charge_id):
+    """
+    Async counterpart of lookup_charge().
+    """
+    cached = await cache.aget(_status_key(charge_id))
+    if cached is not None:
+        owner, result = cached
+        return result if owner == seller_id else None
+
+    charge = await Charge.objects.filter(pk=charge_id, seller_id=seller_id).afirst()
+    return charge_result(charge)[0] if charge is not None else None
+
+
+@contextmanager
+def _subscription(channel):
+    """
+    Subscribes to `channel` and yields wait(timeout), which returns after a message
+    or the timeout, whichever comes first. It may also return early without a message.
+    """
+    redis = _redis()
+    if redis is None:
+        event = threading.Event()
+        with _local_lock:
+            _local_waiters[channel].add(event)
+
+        def wait(timeout):
+            event.wait(timeout)
+            event.clear()
+
+        try:
+            yield wait
+        finally:
+            with _local_lock:
+                _local_waiters[channel].discard(event)
+                if not _local_waiters[channel]:
+                    del _local_waiters[channel]
+        return
+
+    pubsub = redis.get_client(write=False).pubsub()
+    try:
+        pubsub.subscribe(channel)
+        # Messages published before the confirmation would be missed
+        pubsub.get_message(timeout=SUBSCRIBE_TIMEOUT)
+        yield lambda timeout: pubsub.get_message(timeout=timeout)
+    finally:
+        pubsub.close()
+
+
+def wait_for_charge(seller_id, charge_id, timeout):
+    """
+    Looks the charge up and, while it is pending, waits up to `timeout` seconds
+    for its outcome to be published. Returns the latest charge_result data, or None.
+    """
+    data = lookup_charge(seller_id, charge_id)
+    if data is None or data['status'] != 'pending' or timeout <= 0:
+        return data
+
+    deadline = time.monotonic() + timeout
+    with _subscription(CHANNEL.format(charge_id=charge_id)) as wait:
+        # The outcome may have been published before the subscription
+        data = lookup_charge(seller_id, charge_id)
+        while data is not None and data['status'] == 'pending':
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait(remaining)
+            data = lookup_charge(seller_id, charge_id)
+    return data
+
+
+class _LoopEvent:
+    """
+    An asyncio.Event that publish() can set from its worker thread.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def set(self):
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._event.clear()
+
+
+@asynccontextmanager
+async def _asubscription(channel):
+    """
+    Async counterpart of _subscription(): yields an async wait(timeout), so waiting
+    holds no thread, only a Redis connection of its own.
+    """
+    redis = _redis()
+    if redis is None:
+        event = _LoopEvent()
+        with _local_lock:
+            _local_waiters[channel].add(event)
+        try:
+            yield event.wait
+        finally:
+            with _local_lock:
+                _local_waiters[channel].discard(event)
+                if not _local_waiters[channel]:
+                    del _local_waiters[channel]
+        return
+
+    client = aioredis.Redis.from_url(redis._servers[0])
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(channel)
+        # Messages published before the confirmation would be missed
+        await pubsub.get_message(timeout=SUBSCRIBE_TIMEOUT)
+        yield lambda timeout: pubsub.get_message(timeout=timeout)
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
+
+
+async def await_charge(seller_id, charge_id, timeout):
+    """
+    Async counterpart of wait_for_charge(), for the async charge view: the wait
+    suspends the request instead of blocking a thread.
+    """
+    data = await alookup_charge(seller_id, charge_id)
+    if data is None or data['status'] != 'pending' or timeout <= 0:
+        return data
+
+    deadline = time.monotonic() + timeout
+    async with _asubscription(CHANNEL.format(charge_id=charge_id)) as wait:
+        # The outcome may have been published before the subscription
+        data = await alookup_charge(seller_id, charge_id)
+        while data is not None and data['status'] == 'pending':
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await wait(remaining)
+            data = await alookup_charge(seller_id, charge_id)
+    return data
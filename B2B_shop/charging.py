@@ -0,0 +1,379 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from rest_framework import status
+from .models import Seller, Charge, ChargeBatch
+from . import idempotency
+from .charge_status import pending_result, publish_charge_results, remember_pending
+from .ledger import Posting, apply_postings, lock_seller, retry_on_conflict
+from .metrics import CHARGES_TOTAL
+from .ratelimit import acquire_inflight, inflight_limit_exceeded, release_inflight
+from .uuids import uuid7
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Marker set while a flush is queued for a seller, so a burst of charges
+# schedules a single flush instead of one task per charge.
+FLUSH_SCHEDULED_KEY = 'charge_flush_scheduled:{seller_id}'
+# Upper bound for the marker in case the scheduled flush is lost.
+FLUSH_SCHEDULE_TIMEOUT = 60
+
+
+def enqueue_pending_charge(seller_id, amount, phone_number, idempotency_key=None, charge_id=None):
+    """
+    Buffers a charge for batched processing.
+    The charge is stored as 'pending' and settled by the next flush for its seller.
+    """
+    charge = idempotency.create_charge(
+        unique_id=charge_id,
+        seller_id=seller_id,
+        phone_number=phone_number,
+        amount=amount,
+        status='pending',
+        idempotency_key=idempotency_key,
+        # The flush hands it over; the outbox relay only picks it up if that gets lost
+        dispatched_at=timezone.now()
+    )
+    schedule_charge_flush(seller_id)
+    return charge
+
+
+def enqueue_outbox_charge(seller_id, amount, phone_number, idempotency_key=None, charge_id=None):
+    """
+    Stores a charge in the outbox: an INSERT of a 'pending' row, without a broker
+    call, so a slow or unavailable broker neither loses the charge nor stalls the
+    request. The outbox relay hands it to a worker (B2B_shop.outbox).
+    """
+    return idempotency.create_charge(
+        unique_id=charge_id,
+        seller_id=seller_id,
+        phone_number=phone_number,
+        amount=amount,
+        status='pending',
+        idempotency_key=idempotency_key
+    )
+
+
+def schedule_charge_flush(seller_id):
+    """
+    Queues a flush for the seller unless one is already waiting.
+    """
+    from .tasks import flush_pending_charges_task
+
+    key = FLUSH_SCHEDULED_KEY.format(seller_id=seller_id)
+    if cache.add(key, 1, timeout=FLUSH_SCHEDULE_TIMEOUT):
+        flush_pending_charges_task.apply_async(
+            args=[seller_id],
+            countdown=settings.CHARGE_BATCH_FLUSH_INTERVAL_MS / 1000
+        )
+
+
+def clear_charge_flush(seller_id):
+    """
+    Clears the scheduled marker so charges arriving during a flush queue the next one.
+    """
+    cache.delete(FLUSH_SCHEDULED_KEY.format(seller_id=seller_id))
+
+
+def process_pending_charges(seller_id, limit):
+    """
+    Settles up to `limit` pending charges of a seller under a single row lock.
+    Charges are accepted in arrival order while the credit covers them, the rest fail.
+    Their outcomes are published to the clients waiting on them.
+    Returns the number of charges settled.
+    """
+    with transaction.atomic():
+        seller = lock_seller(seller_id)
+        pending = list(
+            Charge.objects.filter(seller_id=seller_id, status='pending', batch__isnull=True)
+            .order_by('created_at', 'unique_id')[:limit]
+        )
+        if pending:
+            settle_charges(seller, pending)
+            publish_charge_results(seller_id, [idempotency.charge_result(charge)[0] for charge in pending])
+        return len(pending)
+
+
+def settle_outbox_charges(seller_id, charge_ids):
+    """
+    Settles the given charges of a seller that are still pending, in arrival order.
+    Charges settled by an earlier delivery are skipped, so running it twice for the
+    same charges debits them once. Returns the number of charges settled.
+    """
+    with transaction.atomic():
+        seller = Seller.objects.get(pk=seller_id)
+        if not seller.shard_count:
+            # The seller's row lock before its charges', like the other settle paths
+            seller = lock_seller(seller_id)
+        pending = list(
+            Charge.objects.select_for_update()
+            .filter(pk__in=charge_ids, seller_id=seller_id, status='pending')
+            .order_by('created_at', 'unique_id')
+        )
+        if pending:
+            settle_charges(seller, pending)
+            publish_charge_results(seller_id, [idempotency.charge_result(charge)[0] for charge in pending])
+        return len(pending)
+
+
+def settle_charges(seller, charges, all_or_nothing=False):
+    """
+    Settles pending charges of a seller in order, with one status UPDATE per outcome
+    and their postings applied to the ledger at once: a single credit UPDATE and one
+    bulk INSERT of the logs.
+    Must run inside a transaction holding the seller's row lock (or, for sharded
+    sellers, any transaction). With `all_or_nothing` either every charge completes
+    or all of them fail. The charges' status is updated in memory as well.
+    Returns the number of completed charges.
+    """
+    postings = [
+        Posting(seller.pk, -charge.amount, 'charge_sale', charge.phone_number, reference=charge.pk)
+        for charge in charges
+    ]
+    if not seller.shard_count and not all_or_nothing:
+        # The ledger applies a seller's postings together, so only the ones the credit
+        # covers in arrival order are handed over
+        covered, balance = [], seller.credit
+        for posting in postings:
+            if balance + posting.amount >= 0:
+                balance += posting.amount
+                covered.append(posting)
+        postings = covered
+    posted = apply_postings(postings, all_or_nothing=all_or_nothing, sharded=bool(seller.shard_count))
+    completed = [posting.reference for posting in posted.applied]
+
+    # Every charge completed or failed; lines loaded with only() never read their status
+    outcomes = dict.fromkeys(completed, 'completed')
+    failed = [charge.pk for charge in charges if charge.pk not in outcomes]
+    for charge in charges:
+        charge.status = outcomes.get(charge.pk, 'failed')
+
+    if completed:
+        Charge.objects.filter(pk__in=completed).update(status='completed')
+        CHARGES_TOTAL.inc(len(completed), outcome='completed')
+    if failed:
+        Charge.objects.filter(pk__in=failed).update(status='failed')
+        CHARGES_TOTAL.inc(len(failed), outcome='insufficient_credit')
+        logger.warning("%s charges failed for seller [%s]: insufficient credit", len(failed), seller.pk)
+    return len(completed)
+
+
+def create_charge_batch(seller_id, lines, mode='partial'):
+    """
+    Stores a batch and its (phone_number, amount) lines as pending charges
+    with one bulk INSERT. The lines are settled by process_charge_batch.
+    """
+    with transaction.atomic():
+        batch = ChargeBatch.objects.create(
+            seller_id=seller_id,
+            mode=mode,
+            line_count=len(lines),
+            total_amount=sum(amount for _, amount in lines)
+        )
+        Charge.objects.bulk_create([
+            Charge(
+                seller_id=seller_id,
+                phone_number=phone_number,
+                amount=amount,
+                status='pending',
+                batch=batch,
+                batch_line=line
+            )
+            for line, (phone_number, amount) in enumerate(lines, start=1)
+        ], batch_size=settings.CHARGE_BATCH_MAX_SIZE)
+    return batch
+
+
+def process_charge_batch(batch_id):
+    """
+    Settles every line of a charge batch under one seller lock: all of them or none
+    in 'all_or_nothing' mode, otherwise in line order while the credit covers them.
+    Batches that were already processed are returned unchanged.
+    """
+    with transaction.atomic():
+        batch = ChargeBatch.objects.select_for_update().get(pk=batch_id)
+        if batch.status != 'pending':
+            return batch
+
+        seller = lock_seller(batch.seller_id)
+        # The related manager reads batch_id of every row, so it must not be deferred
+        lines = list(
+            batch.charges.filter(status='pending')
+            .only('unique_id', 'amount', 'phone_number', 'batch')
+            .order_by('batch_line')
+        )
+        completed = settle_charges(seller, lines, all_or_nothing=batch.mode == 'all_or_nothing')
+
+        batch.status = 'processed'
+        batch.completed_count = completed
+        batch.failed_count = len(lines) - completed
+        batch.processed_at = timezone.now()
+        batch.save(update_fields=['status', 'completed_count', 'failed_count', 'processed_at'])
+    return batch
+
+
+def charge_batch_result(batch, lines=None):
+    """
+    Response data describing a batch, with the outcome of each line if `lines` is given.
+    """
+    data = {
+        "batch_id": str(batch.unique_id),
+        "mode": batch.mode,
+        "status": batch.status,
+        "line_count": batch.line_count,
+        "total_amount": str(batch.total_amount),
+        "completed_count": batch.completed_count,
+        "failed_count": batch.failed_count,
+        "created_at": batch.created_at.isoformat(),
+        "processed_at": batch.processed_at.isoformat() if batch.processed_at else None,
+    }
+    if lines is not None:
+        data["lines"] = [
+            {
+                "line": line,
+                "charge_id": str(charge_id),
+                "phone_number": phone_number,
+                "amount": str(amount),
+                "status": charge_status,
+            }
+            for line, charge_id, phone_number, amount, charge_status in lines
+        ]
+    return data
+
+
+def submit_charge_batch(seller, lines, mode='partial'):
+    """
+    Stores a validated batch and hands it to the configured processing mode.
+    Returns (response data, HTTP status).
+    """
+    from .tasks import process_charge_batch_task
+
+    batch = create_charge_batch(seller.id, lines, mode)
+    if settings.CHARGE_PROCESSING_MODE == 'sync':
+        batch = process_charge_batch(batch.pk)
+        return charge_batch_result(batch), status.HTTP_201_CREATED
+
+    process_charge_batch_task.delay(str(batch.pk))
+    return charge_batch_result(batch), status.HTTP_202_ACCEPTED
+
+
+def charge_now(seller_id, amount, phone_number, idempotency_key=None, charge_id=None):
+    """
+    Processes a charge synchronously in one short transaction, whose debit is a
+    single conditional UPDATE of the seller's row (see ledger.apply_postings).
+    Returns the Charge and the seller's balance after it (None if it failed).
+    """
+    charge, balance_after = _charge_now(seller_id, amount, phone_number, idempotency_key, charge_id)
+    CHARGES_TOTAL.inc(outcome='insufficient_credit' if balance_after is None else 'completed')
+    if balance_after is None:
+        logger.warning("Charge failed for seller [%s]: insufficient credit (%s)", seller_id, amount)
+    return charge, balance_after
+
+
+@retry_on_conflict
+def _charge_now(seller_id, amount, phone_number, idempotency_key, charge_id):
+    posted = apply_postings([Posting(seller_id, -amount, 'charge_sale', phone_number)])
+    balance_after = posted.logs[0].balance_after if posted.applied else None
+    charge = idempotency.create_charge(
+        unique_id=charge_id,
+        seller_id=seller_id,
+        phone_number=phone_number,
+        amount=amount,
+        status='failed' if balance_after is None else 'completed',
+        idempotency_key=idempotency_key
+    )
+    return charge, balance_after
+
+
+def submit_charge(seller, amount, phone_number, idempotency_key=None):
+    """
+    Hands a validated charge to the configured processing mode.
+    Shared by the sync and async charge views; returns (response data, HTTP status).
+    A request repeating an Idempotency-Key gets the original outcome back
+    without touching the seller's credit. Raises Throttled when the seller has
+    MAX_INFLIGHT_CHARGES charges pending already.
+    """
+    if idempotency_key is None:
+        return _admit_charge(seller, amount, phone_number)
+
+    result = idempotency.replay(seller.id, idempotency_key)
+    if result is not None:
+        return result
+    if not idempotency.reserve(seller.id, idempotency_key):
+        return idempotency.IN_PROGRESS_RESPONSE
+
+    try:
+        result = _admit_charge(seller, amount, phone_number, idempotency_key)
+    except IntegrityError:
+        # The unique constraint caught a charge stored earlier with this key
+        idempotency.release(seller.id, idempotency_key)
+        return idempotency.replay(seller.id, idempotency_key) or idempotency.IN_PROGRESS_RESPONSE
+    except Exception:
+        idempotency.release(seller.id, idempotency_key)
+        raise
+
+    idempotency.remember(seller.id, idempotency_key, result)
+    return result
+
+
+def _admit_charge(seller, amount, phone_number, idempotency_key=None):
+    """
+    Dispatches the charge if the seller is under its in-flight cap. The charge
+    counts as in flight until its outcome is published (charge_status).
+    """
+    # The charge id is chosen here so the client can look the charge up at
+    # /api/charge/<id>/ before the task has written it; it is also the task id
+    charge_id = uuid7()
+    if not acquire_inflight(seller, charge_id):
+        raise inflight_limit_exceeded()
+    try:
+        result = _dispatch_charge(seller, amount, phone_number, idempotency_key, charge_id)
+    except Exception:
+        release_inflight(seller.id, [charge_id])
+        raise
+    if result[1] != status.HTTP_202_ACCEPTED:
+        release_inflight(seller.id, [charge_id])
+    return result
+
+
+def _dispatch_charge(seller, amount, phone_number, idempotency_key, charge_id):
+    from .sharding import charge_sharded_seller
+    from .tasks import process_charge_task, process_sharded_charge_task
+
+    if settings.CHARGE_PROCESSING_MODE == 'sync':
+        # Debit inside the request and report the outcome inline
+        if seller.shard_count:
+            charge, shard_balance = charge_sharded_seller(seller.id, amount, phone_number, idempotency_key, charge_id)
+            return idempotency.charge_result(charge, shard_balance_after=shard_balance)
+        charge, balance_after = charge_now(seller.id, amount, phone_number, idempotency_key, charge_id)
+        return idempotency.charge_result(charge, balance_after)
+
+    if settings.CHARGE_PROCESSING_MODE == 'outbox':
+        # Only the INSERT happens in the request, the outbox relay publishes the charge
+        charge = enqueue_outbox_charge(seller.id, amount, phone_number, idempotency_key, charge_id)
+        return idempotency.charge_result(charge)
+
+    if settings.CHARGE_PROCESSING_MODE == 'batch' and not seller.shard_count:
+        # Buffer the charge, one worker settles the seller's charges in bulk
+        charge = enqueue_pending_charge(seller.id, amount, phone_number, idempotency_key, charge_id)
+        return idempotency.charge_result(charge)
+
+    remember_pending(seller.id, charge_id, amount)
+    # Sharded sellers debit one credit shard per charge, never the Seller row
+    task = process_sharded_charge_task if seller.shard_count else process_charge_task
+    # Offload the database operation to Celery
+    task.apply_async(
+        kwargs={
+            'seller_id': seller.id,
+            'amount_str': str(amount),
+            'phone_number': phone_number,
+            'idempotency_key': idempotency_key,
+            'charge_id': str(charge_id),
+            'enqueued_at': time.time(),
+        },
+        task_id=str(charge_id),
+    )
+    return pending_result(charge_id, amount), status.HTTP_202_ACCEPTED
@@ -0,0 +1,155 @@
+import base64
+import csv
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .models import TransactionLog
+
+# Columns written by the streaming export, in order
+EXPORT_FIELDS = (
+    'unique_id', 'transaction_type', 'amount', 'balance_after',
+    'phone_number', 'shard', 'seq', 'created_at',
+)
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+EXPORT_CHUNK_SIZE = 2000
+# Positions of the keyset columns in an export row
+_UNIQUE_ID, _CREATED_AT = EXPORT_FIELDS.index('unique_id'), EXPORT_FIELDS.index('created_at')
+
+
+def seller_transactions(seller, params):
+    """
+    A seller's transaction log in (created_at, unique_id) order,
+    filtered by the optional start_date/end_date query parameters.
+    """
+    transactions = TransactionLog.objects.filter(seller=seller).select_related('seller')
+
+    start_date = params.get('start_date')
+    end_date = params.get('end_date')
+
+    if start_date:
+        transactions = transactions.filter(created_at__gte=start_date)
+    if end_date:
+        transactions = transactions.filter(created_at__lte=end_date)
+
+    return transactions.order_by('created_at', 'unique_id')
+
+
+def encode_cursor(log):
+    raw = f"{log.created_at.isoformat()}|{log.unique_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (created_at, unique_id) position encoded in a cursor.
+    Raises ValueError for malformed cursors.
+    """
+    try:
+        created_at, unique_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        position = parse_datetime(created_at), uuid.UUID(unique_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if position[0] is None:
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def parse_page_size(value):
+    """
+    Parses the page_size query parameter, capped at TRANSACTIONS_MAX_PAGE_SIZE.
+    Raises ValueError for non-positive or non-numeric values.
+    """
+    if value in (None, ''):
+        return settings.TRANSACTIONS_PAGE_SIZE
+    page_size = int(value)
+    if page_size < 1:
+        raise ValueError("page_size must be positive")
+    return min(page_size, settings.TRANSACTIONS_MAX_PAGE_SIZE)
+
+
+def keyset_page(transactions, cursor, page_size):
+    """
+    The rows after `cursor`, fetching one extra row to tell whether a next page exists.
+    Seeks on (created_at, unique_id) instead of using OFFSET, so deep pages stay cheap.
+    created_at is set when an entry is written, not when it commits: an entry whose
+    transaction commits after a later-stamped one was already paged past is skipped
+    by that walk. Clients that need every entry page up to an end_date a few seconds
+    in the past, which no transaction still in flight can write before.
+    """
+    if cursor:
+        transactions = _after(transactions, *decode_cursor(cursor))
+    return transactions[:page_size + 1]
+
+
+def _after(transactions, created_at, unique_id):
+    return transactions.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, unique_id__gt=unique_id))
+
+
+def split_page(rows, page_size):
+    """
+    Returns (rows of this page, cursor of the next page or None).
+    """
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, encode_cursor(rows[-1])
+
+
+def export_rows(transactions):
+    return transactions.values_list(*EXPORT_FIELDS)
+
+
+class _Echo:
+    """
+    File-like object whose write() returns the written value, for streaming csv rows.
+    """
+
+    def write(self, value):
+        return value
+
+
+def format_export_row(row, export_format, writer=None):
+    if export_format == 'csv':
+        return writer.writerow(row)
+    return json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str) + '\n'
+
+
+def stream_export(transactions, export_format):
+    """
+    Yields export lines while iterating with a server-side cursor,
+    so memory stays flat however long the history is.
+    """
+    writer = csv.writer(_Echo())
+    if export_format == 'csv':
+        yield writer.writerow(EXPORT_FIELDS)
+    for row in export_rows(transactions).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield format_export_row(row, export_format, writer)
+
+
+async def astream_export(transactions, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Async version of stream_export for ASGI, where a sync iterator would be read whole
+    into memory before the first byte is sent. Reads `chunk_size` rows per keyset
+    query, each in a worker thread, and sends each chunk as one body message.
+    """
+    writer = csv.writer(_Echo())
+    if export_format == 'csv':
+        yield writer.writerow(EXPORT_FIELDS)
+    chunk = export_rows(transactions)[:chunk_size]
+    while True:
+        rows = await sync_to_async(list)(chunk)
+        if not rows:
+            return
+        yield ''.join(format_export_row(row, export_format, writer) for row in rows)
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]
+        chunk = export_rows(_after(transactions, last[_CREATED_AT], last[_UNIQUE_ID]))[:chunk_size]
@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework import status
+
+from .models import Charge, ChargeIdempotencyKey
+from .uuids import uuid7
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_MAX_LENGTH = Charge._meta.get_field('idempotency_key').max_length
+
+# Keys of charges and of transfers are separate scopes
+CACHE_KEY = '{scope}_idempotency:{seller_id}:{key}'
+# Stored while the first request with a key is still being processed
+IN_PROGRESS = 'in_progress'
+# How long a request may hold the in-progress marker
+IN_PROGRESS_TIMEOUT = 30
+
+IN_PROGRESS_RESPONSE = (
+    {"error": "A request with this Idempotency-Key is already being processed."},
+    status.HTTP_409_CONFLICT,
+)
+
+
+def archived_response(charge_id):
+    return (
+        {"charge_id": str(charge_id), "error": "This Idempotency-Key was used by a charge that has been archived."},
+        status.HTTP_409_CONFLICT,
+    )
+
+
+def _cache_key(seller_id, key, scope='charge'):
+    return CACHE_KEY.format(scope=scope, seller_id=seller_id, key=key)
+
+
+def validate_key(key):
+    """
+    Returns an error message for an unusable key, or None.
+    """
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return f"{IDEMPOTENCY_KEY_HEADER} must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters"
+    return None
+
+
+def charge_result(charge, balance_after=None, shard_balance_after=None):
+    """
+    Response data and HTTP status describing a processed charge.
+    A charge of a sharded seller has no balance_after, as its debit only locked one
+    shard; the balance of that shard is reported as shard_balance_after instead.
+    """
+    data = {
+        "charge_id": str(charge.unique_id),
+        "status": charge.status,
+        "amount": str(charge.amount),
+        "balance_after": str(balance_after) if balance_after is not None else None,
+    }
+    if shard_balance_after is not None:
+        data["shard_balance_after"] = str(shard_balance_after)
+    if charge.status == 'pending':
+        return data, status.HTTP_202_ACCEPTED
+    if charge.status != 'completed':
+        data["error"] = "Insufficient credit"
+        return data, status.HTTP_400_BAD_REQUEST
+    return data, status.HTTP_201_CREATED
+
+
+def create_charge(seller_id, idempotency_key=None, unique_id=None, **fields):
+    """
+    Creates a Charge. A charge with an Idempotency-Key is stored in one transaction
+    with its ChargeIdempotencyKey, which raises IntegrityError if a charge of the
+    seller already used the key, in any month.
+    """
+    unique_id = unique_id or uuid7()
+    if idempotency_key is None:
+        return Charge.objects.create(unique_id=unique_id, seller_id=seller_id, **fields)
+    with transaction.atomic():
+        ChargeIdempotencyKey.objects.create(seller_id=seller_id, key=idempotency_key, charge_id=unique_id)
+        return Charge.objects.create(
+            unique_id=unique_id, seller_id=seller_id, idempotency_key=idempotency_key, **fields
+        )
+
+
+def cached_result(seller_id, key, scope='charge'):
+    """
+    The outcome cached for the key in `scope`, IN_PROGRESS_RESPONSE while it is being
+    processed, or None.
+    """
+    cached = cache.get(_cache_key(seller_id, key, scope))
+    if cached == IN_PROGRESS:
+        return IN_PROGRESS_RESPONSE
+    return cached
+
+
+def replay(seller_id, key):
+    """
+    The stored outcome of an earlier request with this key, or None if the key is new.
+    The Redis cache answers most retries; ChargeIdempotencyKey backs it up once the entry expires.
+    """
+    cached = cached_result(seller_id, key)
+    if cached is not None:
+        return cached
+
+    charge_id = ChargeIdempotencyKey.objects.filter(seller_id=seller_id, key=key) \
+        .values_list('charge_id', flat=True).first()
+    if charge_id is None:
+        return None
+    charge = Charge.objects.filter(pk=charge_id).first()
+    if charge is None:
+        # Archived with its partition, the key stays used
+        return archived_response(charge_id)
+    result = charge_result(charge)
+    remember(seller_id, key, result)
+    return result
+
+
+def reserve(seller_id, key, scope='charge'):
+    """
+    Claims the key for this request. Returns False if another request holds it.
+    """
+    return cache.add(_cache_key(seller_id, key, scope), IN_PROGRESS, timeout=IN_PROGRESS_TIMEOUT)
+
+
+def release(seller_id, key, scope='charge'):
+    cache.delete(_cache_key(seller_id, key, scope))
+
+
+def remember(seller_id, key, result, scope='charge'):
+    cache.set(_cache_key(seller_id, key, scope), result, timeout=settings.IDEMPOTENCY_KEY_TTL)
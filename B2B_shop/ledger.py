@@ -0,0 +1,476 @@
+import functools
+import random
+import time
+from collections import defaultdict, namedtuple
+from contextlib import nullcontext
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction, OperationalError
+from django.db.models import BigIntegerField, Case, DecimalField, F, Value, When
+
+from .balances import publish_balance, publish_balances
+from .metrics import Counter
+from .models import Seller, SellerCreditShard, TransactionLog
+
+CENT = Decimal('0.01')
+
+_credit_field = Seller._meta.get_field('credit')
+# Largest balance the credit column can hold
+MAX_CREDIT = Decimal(10) ** (_credit_field.max_digits - _credit_field.decimal_places) - CENT
+
+# Most sellers changed by one UPDATE; each is one CASE branch the database walks per row
+UPDATE_BATCH_SIZE = 500
+
+# How apply_postings() treats seller rows another transaction holds
+LOCK_WAIT = 'wait'
+LOCK_NOWAIT = 'nowait'
+LOCK_SKIP_LOCKED = 'skip_locked'
+
+# SQLSTATEs of conflicts that succeed when the transaction is run again:
+# serialization_failure, deadlock_detected and lock_not_available (NOWAIT)
+RETRYABLE_SQLSTATES = {'40001', '40P01', '55P03'}
+
+LEDGER_RETRIES_TOTAL = Counter('b2b_ledger_retries_total', "Ledger transactions run again after a conflict, by SQLSTATE")
+
+# One change of a seller's credit and the log entry describing it. `amount` is signed,
+# negative for debits; `reference` identifies what it is for (a charge, a credit request)
+# to the caller and is not stored.
+Posting = namedtuple('Posting', 'seller_id amount transaction_type phone_number reference', defaults=(None, None))
+
+# `applied` postings and their `logs`, in the same order; the `rejected` ones the credit
+# did not cover (or that would overflow it); the `skipped` ones of sellers another
+# transaction held with LOCK_SKIP_LOCKED
+PostingResult = namedtuple('PostingResult', 'applied logs rejected skipped')
+
+
+class _RolledBack(Exception):
+    pass
+
+
+def _group_by_seller(postings):
+    by_seller = defaultdict(list)
+    for posting in postings:
+        by_seller[posting.seller_id].append(posting)
+    return by_seller
+
+
+def _bounds(entries):
+    """
+    (total, lowest, highest) running sum of the entries, the bounds counted from 0.
+    """
+    total = lowest = highest = Decimal('0.00')
+    for posting in entries:
+        total += posting.amount
+        lowest, highest = min(lowest, total), max(highest, total)
+    return total, lowest, highest
+
+
+def _chain_logs(seller_id, entries, balance, seq, shard=None):
+    """
+    Log entries of postings applied together, whose last entry ends at `balance` and `seq`.
+    """
+    balance -= sum(posting.amount for posting in entries)
+    seq -= len(entries)
+    logs = []
+    for posting in entries:
+        balance += posting.amount
+        seq += 1
+        logs.append(TransactionLog(
+            seller_id=seller_id,
+            transaction_type=posting.transaction_type,
+            amount=posting.amount,
+            balance_after=balance,
+            phone_number=posting.phone_number,
+            shard=shard,
+            seq=seq
+        ))
+    return logs
+
+
+def _update_seller(seller_id, entries):
+    """
+    Applies an unsharded seller's postings with one conditional UPDATE, which also
+    takes the row lock, unless a running balance would leave [0, MAX_CREDIT].
+    Returns (credit, ledger_seq) after it, or None if no row was updated.
+    """
+    total, lowest, highest = _bounds(entries)
+    table = connection.ops.quote_name(Seller._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {table} SET credit = credit + %s, ledger_seq = ledger_seq + %s "
+            f"WHERE id = %s AND shard_count = 0 AND credit >= %s AND credit <= %s "
+            f"RETURNING credit, ledger_seq",
+            [total, len(entries), seller_id, -lowest, MAX_CREDIT - highest]
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return Decimal(str(row[0])).quantize(CENT), row[1]
+
+
+def _lock_sellers(seller_ids, lock):
+    """
+    Locks the sellers' rows in primary key order, so transactions posting to the
+    same sellers queue up instead of deadlocking. The lock is FOR NO KEY UPDATE, the
+    one an UPDATE takes: FOR UPDATE would also block the key share lock that inserting
+    a log entry or a charge takes on its seller, and deadlock with transactions that
+    hold a credit shard while they log to the seller.
+    Returns {seller_id: (credit, ledger_seq, shard_count)} of the rows locked.
+    """
+    rows = (
+        Seller.objects.select_for_update(
+            nowait=lock == LOCK_NOWAIT, skip_locked=lock == LOCK_SKIP_LOCKED, no_key=True
+        )
+        .filter(pk__in=seller_ids)
+        .order_by('pk')
+        .values_list('pk', 'credit', 'ledger_seq', 'shard_count')
+    )
+    return {pk: (credit, seq, shard_count) for pk, credit, seq, shard_count in rows}
+
+
+def lock_seller(seller_id):
+    """
+    Locks a seller's row the way apply_postings() does and returns the Seller, for
+    callers that read its balance or shards before posting. Raises Seller.DoesNotExist.
+    """
+    return Seller.objects.select_for_update(no_key=True).get(pk=seller_id)
+
+
+def lock_shards(seller_id):
+    """
+    Locks every credit shard of a seller, in index order.
+    """
+    return list(SellerCreditShard.objects.select_for_update().filter(seller_id=seller_id).order_by('index'))
+
+
+def _update_locked_sellers(updates):
+    """
+    Adds each (seller_id, entries, total, ...) update to its locked Seller row, with a
+    single UPDATE per UPDATE_BATCH_SIZE sellers, so fanning out to many sellers costs
+    one statement rather than one per seller.
+    """
+    for start in range(0, len(updates), UPDATE_BATCH_SIZE):
+        batch = updates[start:start + UPDATE_BATCH_SIZE]
+        if len(batch) == 1:
+            seller_id, entries, total = batch[0][:3]
+            Seller.objects.filter(pk=seller_id).update(
+                credit=F('credit') + total, ledger_seq=F('ledger_seq') + len(entries)
+            )
+            continue
+        Seller.objects.filter(pk__in=[seller_id for seller_id, *_ in batch]).update(
+            credit=F('credit') + Case(
+                *(When(pk=seller_id, then=Value(total)) for seller_id, _, total, *_ in batch),
+                output_field=DecimalField(max_digits=_credit_field.max_digits, decimal_places=_credit_field.decimal_places)
+            ),
+            ledger_seq=F('ledger_seq') + Case(
+                *(When(pk=seller_id, then=Value(len(entries))) for seller_id, entries, *_ in batch),
+                output_field=BigIntegerField()
+            ),
+        )
+
+
+def split_evenly(total, shard_count):
+    """
+    Splits an amount into `shard_count` parts that differ by at most one cent.
+    """
+    cents = int(total / CENT)
+    base, remainder = divmod(cents, shard_count)
+    return [(base + (1 if i < remainder else 0)) * CENT for i in range(shard_count)]
+
+
+def _lock_shard(seller_id, **filters):
+    """
+    Locks one shard of the seller, preferring shards no other transaction holds.
+    """
+    shards = SellerCreditShard.objects.filter(seller_id=seller_id, **filters)
+    shard = shards.select_for_update(skip_locked=True).order_by('?').first()
+    if shard is None:
+        # every matching shard is busy, wait for one instead of failing
+        shard = shards.select_for_update().order_by('?').first()
+    return shard
+
+
+def debit_credit_shard(seller_id, amount, entries=1):
+    """
+    Debits `amount` from any shard that can cover it and reserves `entries` seq
+    numbers of its log, the last one being the returned shard's ledger_seq.
+    Must run inside a transaction. Returns the debited shard, or None when no
+    single shard holds enough credit.
+    """
+    shard = _lock_shard(seller_id, credit__gte=amount)
+    if shard is None:
+        return None
+
+    SellerCreditShard.objects.filter(pk=shard.pk).update(
+        credit=F('credit') - amount, ledger_seq=F('ledger_seq') + entries
+    )
+    shard.credit -= amount
+    shard.ledger_seq += entries
+    return shard
+
+
+def credit_credit_shard(seller_id, amount, entries=1):
+    """
+    Adds `amount` to the seller's emptiest free shard and reserves `entries` seq numbers.
+    Must run inside a transaction. Returns the credited shard.
+    """
+    shards = SellerCreditShard.objects.filter(seller_id=seller_id).order_by('credit')
+    shard = shards.select_for_update(skip_locked=True).first() or shards.select_for_update().first()
+
+    SellerCreditShard.objects.filter(pk=shard.pk).update(
+        credit=F('credit') + amount, ledger_seq=F('ledger_seq') + entries
+    )
+    shard.credit += amount
+    shard.ledger_seq += entries
+    return shard
+
+
+def _post_to_shards(seller_id, entries, all_or_nothing):
+    """
+    Applies a sharded seller's postings without touching its Seller row. Debits are
+    taken one by one from any shard that covers them (with `all_or_nothing`, all of
+    them from one shard or none), then the credits land together on the emptiest shard.
+    Returns (applied, logs, rejected).
+    """
+    debits = [posting for posting in entries if posting.amount < 0]
+    credits = [posting for posting in entries if posting.amount >= 0]
+    applied, logs, rejected = [], [], []
+
+    if all_or_nothing and debits:
+        shard = debit_credit_shard(seller_id, -sum(posting.amount for posting in debits), entries=len(debits))
+        if shard is None:
+            return [], [], list(entries)
+        applied += debits
+        logs += _chain_logs(seller_id, debits, shard.credit, shard.ledger_seq, shard.index)
+    else:
+        for posting in debits:
+            shard = debit_credit_shard(seller_id, -posting.amount)
+            if shard is None:
+                rejected.append(posting)
+                continue
+            applied.append(posting)
+            logs += _chain_logs(seller_id, [posting], shard.credit, shard.ledger_seq, shard.index)
+
+    if credits:
+        shard = credit_credit_shard(seller_id, sum(posting.amount for posting in credits), entries=len(credits))
+        applied += credits
+        logs += _chain_logs(seller_id, credits, shard.credit, shard.ledger_seq, shard.index)
+    return applied, logs, rejected
+
+
+def apply_postings(postings, lock=LOCK_WAIT, all_or_nothing=False, sharded=False):
+    """
+    Applies postings to the sellers' credit: every change of a balance goes through here.
+    Must run inside a transaction, e.g. one started by retry_on_conflict().
+
+    Seller rows are locked in primary key order and the unsharded sellers get a single
+    UPDATE adding the sum of each one's postings, which are applied together or, if a running
+    balance would go negative or exceed MAX_CREDIT, rejected together. The logs chain
+    their balance_after and seq in posting order and are written with one INSERT.
+    `lock` chooses what happens when another transaction holds a seller: LOCK_WAIT,
+    LOCK_NOWAIT (the database error is raised, and retried by retry_on_conflict) or
+    LOCK_SKIP_LOCKED (the seller's postings are returned as skipped).
+    Sharded sellers are posted to their credit shards (see _post_to_shards); with
+    `sharded` the caller vouches that all the sellers are, and their rows are not read.
+    With `all_or_nothing` either every posting is applied or all are rejected.
+    Raises Seller.DoesNotExist for an unknown seller.
+    """
+    postings = list(postings)
+    by_seller = _group_by_seller(postings)
+    seller_ids = sorted(by_seller)
+    rows, sharded_ids, skipped = {}, [], []
+
+    if not postings:
+        return PostingResult([], [], [], [])
+    if sharded:
+        sharded_ids, seller_ids = seller_ids, []
+    elif len(seller_ids) == 1 and lock == LOCK_WAIT:
+        # A single row needs no lock ordering: the conditional UPDATE locks it
+        # and checks the balance in one statement
+        seller_id = seller_ids[0]
+        updated = _update_seller(seller_id, postings)
+        if updated is not None:
+            logs = _chain_logs(seller_id, postings, *updated)
+            TransactionLog.objects.bulk_create(logs)
+            publish_balance(seller_id, *updated)
+            return PostingResult(postings, logs, [], [])
+        shard_count = Seller.objects.filter(pk=seller_id).values_list('shard_count', flat=True).first()
+        if shard_count is None:
+            raise Seller.DoesNotExist(f"Seller {seller_id} does not exist")
+        if not shard_count:
+            return PostingResult([], [], postings, [])
+        sharded_ids, seller_ids = seller_ids, []
+    else:
+        rows = _lock_sellers(seller_ids, lock)
+        if lock == LOCK_SKIP_LOCKED:
+            skipped = [posting for seller_id in seller_ids if seller_id not in rows for posting in by_seller[seller_id]]
+            seller_ids = [seller_id for seller_id in seller_ids if seller_id in rows]
+        missing = [seller_id for seller_id in seller_ids if seller_id not in rows]
+        if missing:
+            raise Seller.DoesNotExist(f"Seller {missing[0]} does not exist")
+        sharded_ids = [seller_id for seller_id in seller_ids if rows[seller_id][2]]
+        seller_ids = [seller_id for seller_id in seller_ids if not rows[seller_id][2]]
+
+    # Unsharded sellers are checked against their locked rows before anything is written
+    applied, logs, rejected, updates = [], [], [], []
+    for seller_id in seller_ids:
+        entries = by_seller[seller_id]
+        credit, seq, _ = rows[seller_id]
+        total, lowest, highest = _bounds(entries)
+        if credit + lowest < 0 or credit + highest > MAX_CREDIT:
+            rejected += entries
+        else:
+            updates.append((seller_id, entries, total, credit + total, seq + len(entries)))
+    if all_or_nothing and (rejected or skipped):
+        return PostingResult([], [], postings, [])
+
+    # Shard debits can only fail once tried, so they go first; past the first sharded
+    # seller a savepoint undoes the others if one of them fails
+    try:
+        with transaction.atomic() if all_or_nothing and len(sharded_ids) > 1 else nullcontext():
+            for seller_id in sharded_ids:
+                shard_applied, shard_logs, shard_rejected = _post_to_shards(
+                    seller_id, by_seller[seller_id], all_or_nothing
+                )
+                if all_or_nothing and shard_rejected:
+                    raise _RolledBack
+                applied += shard_applied
+                logs += shard_logs
+                rejected += shard_rejected
+    except _RolledBack:
+        return PostingResult([], [], postings, [])
+    if sharded_ids:
+        publish_balances(sharded_ids)
+
+    _update_locked_sellers(updates)
+    for seller_id, entries, total, balance, seq in updates:
+        applied += entries
+        logs += _chain_logs(seller_id, entries, balance, seq)
+        publish_balance(seller_id, balance, seq)
+
+    if logs:
+        TransactionLog.objects.bulk_create(logs)
+    return PostingResult(applied, logs, rejected, skipped)
+
+
+def split_into_shards(seller_id, shard_count):
+    """
+    Moves an unsharded seller's credit into `shard_count` new shards, logging the
+    transfer so the seller's log still sums to its balance. `credit` keeps reporting
+    the total, now as the sum of the shards. Must run inside a transaction.
+    Returns the Seller as locked.
+    """
+    seller = lock_seller(seller_id)
+    if seller.shard_count:
+        raise ValueError(f"Seller {seller_id} is already sharded")
+
+    parts = split_evenly(seller.credit, shard_count)
+    # Each funded shard's chain starts with its transfer entry
+    SellerCreditShard.objects.bulk_create([
+        SellerCreditShard(seller=seller, index=i, credit=part, ledger_seq=1 if part else 0)
+        for i, part in enumerate(parts)
+    ])
+
+    seq = seller.ledger_seq
+    if seller.credit:
+        seq += 1
+        logs = [TransactionLog(
+            seller=seller,
+            transaction_type='shard_rebalance',
+            amount=-seller.credit,
+            balance_after=Decimal('0.00'),
+            seq=seq
+        )]
+        logs += [
+            TransactionLog(
+                seller=seller,
+                transaction_type='shard_rebalance',
+                amount=part,
+                balance_after=part,
+                shard=i,
+                seq=1
+            )
+            for i, part in enumerate(parts) if part
+        ]
+        TransactionLog.objects.bulk_create(logs)
+
+    Seller.objects.filter(pk=seller_id).update(shard_count=shard_count, ledger_seq=seq)
+    publish_balance(seller_id)
+    return seller
+
+
+def rebalance_shards(seller_id):
+    """
+    Evens out a sharded seller's shards and refreshes Seller.credit to their sum.
+    Every shard that changes gets a 'shard_rebalance' log entry. The seller is locked
+    before its shards, in index order. Must run inside a transaction.
+    """
+    seller = lock_seller(seller_id)
+    if not seller.shard_count:
+        return
+
+    shards = lock_shards(seller_id)
+    total = sum((shard.credit for shard in shards), Decimal('0.00'))
+    logs = []
+    for shard, target in zip(shards, split_evenly(total, len(shards))):
+        if shard.credit == target:
+            continue
+        shard.ledger_seq += 1
+        logs.append(TransactionLog(
+            seller_id=seller_id,
+            transaction_type='shard_rebalance',
+            amount=target - shard.credit,
+            balance_after=target,
+            shard=shard.index,
+            seq=shard.ledger_seq
+        ))
+        shard.credit = target
+
+    if logs:
+        SellerCreditShard.objects.bulk_update(shards, ['credit', 'ledger_seq'])
+        TransactionLog.objects.bulk_create(logs)
+    Seller.objects.filter(pk=seller_id).update(credit=total)
+    if logs:
+        publish_balance(seller_id)
+
+
+def _sqlstate(error):
+    cause = error.__cause__
+    return getattr(cause, 'sqlstate', None) or getattr(cause, 'pgcode', None)
+
+
+def retry_on_conflict(func):
+    """
+    Decorator running the function in a transaction of its own, run again when the
+    database reports a serialization failure, a deadlock or a NOWAIT lock conflict.
+    It is retried up to LEDGER_MAX_RETRIES times after a random pause of up to
+    LEDGER_RETRY_BACKOFF_MS, doubling on each attempt and capped at
+    LEDGER_RETRY_MAX_BACKOFF_MS. Called inside another transaction the error is raised,
+    as only the outermost transaction can be run again.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as e:
+                sqlstate = _sqlstate(e)
+                if (sqlstate not in RETRYABLE_SQLSTATES or attempt >= settings.LEDGER_MAX_RETRIES
+                        or connection.in_atomic_block):
+                    raise
+            LEDGER_RETRIES_TOTAL.inc(sqlstate=sqlstate)
+            backoff = min(settings.LEDGER_RETRY_BACKOFF_MS * 2 ** attempt, settings.LEDGER_RETRY_MAX_BACKOFF_MS)
+            time.sleep(random.uniform(0, backoff) / 1000)
+            attempt += 1
+    return wrapper
+
+
+@retry_on_conflict
+def post(postings, lock=LOCK_WAIT, all_or_nothing=False):
+    """
+    Applies postings in a transaction of their own, retried on conflicts.
+    """
+    return apply_postings(postings, lock=lock, all_or_nothing=all_or_nothing)
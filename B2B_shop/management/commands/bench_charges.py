@@ -0,0 +1,340 @@
+import json
+import random
+import subprocess
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+from decimal import Decimal
+
+from celery.contrib.testing.worker import start_worker
+
+from django.conf import settings
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from b2b_project.celery import app as celery_app, charge_queue_names
+from B2B_shop.benchmarking import summarize_latencies
+from B2B_shop.models import Seller, CreditRequest, Charge
+from B2B_shop.outbox import run_charge_relay
+
+USERNAME_PREFIX = 'bench_'
+
+
+class LockWaitSampler(threading.Thread):
+    """
+    Samples pg_stat_activity and integrates the number of backends waiting on a lock,
+    which approximates the total lock wait time of the run in seconds.
+    """
+    interval = 0.01
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopped = threading.Event()
+        self.lock_wait_seconds = 0.0
+        self.max_waiting = 0
+
+    def run(self):
+        try:
+            with connection.cursor() as cursor:
+                while not self.stopped.is_set():
+                    cursor.execute(
+                        "SELECT count(*) FROM pg_stat_activity "
+                        "WHERE datname = current_database() AND wait_event_type = 'Lock'"
+                    )
+                    waiting = cursor.fetchone()[0]
+                    self.lock_wait_seconds += waiting * self.interval
+                    self.max_waiting = max(self.max_waiting, waiting)
+                    time.sleep(self.interval)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class OutboxRelay(threading.Thread):
+    """
+    Relays the charge outbox from a thread, in place of the charge_relay service.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            run_charge_relay(self.stopped)
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the charge pipeline (ChargeAPIView -> charge processing) and the admin "
+        "approval path against the configured database, reporting latency percentiles, "
+        "throughput and lock wait time. Creates and deletes its own 'bench_' sellers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sellers', type=int, default=10)
+        parser.add_argument('--hot-sellers', type=int, default=1,
+                            help="Number of sellers receiving the hot share of charges")
+        parser.add_argument('--hot-ratio', type=float, default=0.0,
+                            help="Fraction of charges sent to the hot sellers (0 = uniform)")
+        parser.add_argument('--charges', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--mode', choices=['task', 'batch', 'sync', 'outbox'],
+                            help="Charge processing mode (default: CHARGE_PROCESSING_MODE)")
+        parser.add_argument('--workers', action='store_true',
+                            help="Hand charges to running Celery workers instead of executing tasks "
+                                 "eagerly, and wait for them to settle")
+        parser.add_argument('--local-workers', type=int, default=0,
+                            help="Run this many worker threads in-process over an in-memory broker, in "
+                                 "the queue layout of --charge-queues, and wait for the charges to settle")
+        parser.add_argument('--charge-queues', type=int,
+                            help="Number of per-seller charge queues to route to, 0 for the default "
+                                 "queue (default: CHARGE_QUEUE_COUNT). Workers must consume them")
+        parser.add_argument('--amount', default='1.00')
+        parser.add_argument('--initial-credit', default='10000000.00')
+        parser.add_argument('--approvals', type=int, default=0,
+                            help="Number of credit requests to approve through the admin action")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write the results to this JSON file")
+        parser.add_argument('--compare', help="Print the change against an earlier results file")
+        parser.add_argument('--keep', action='store_true', help="Keep the benchmark sellers")
+
+    def handle(self, *args, **options):
+        if options['hot_sellers'] > options['sellers']:
+            raise CommandError("--hot-sellers cannot exceed --sellers")
+        if User.objects.filter(username__startswith=USERNAME_PREFIX).exists():
+            raise CommandError("Benchmark sellers already exist, remove them or run with a clean database")
+
+        mode = options['mode'] or settings.CHARGE_PROCESSING_MODE
+        charge_queues = settings.CHARGE_QUEUE_COUNT if options['charge_queues'] is None else options['charge_queues']
+        sellers, tokens = self.create_sellers(options)
+        results = {
+            'config': {key: options[key] for key in (
+                'sellers', 'hot_sellers', 'hot_ratio', 'charges', 'concurrency',
+                'workers', 'local_workers', 'amount', 'approvals', 'seed',
+            )},
+            'commit': self.git_commit(),
+            'database': connection.vendor,
+        }
+        results['config']['mode'] = mode
+        results['config']['charge_queues'] = charge_queues
+
+        eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = not (options['workers'] or options['local_workers'])
+        workers = self.local_workers(charge_queues, options['local_workers']) if options['local_workers'] else ExitStack()
+        try:
+            # The benchmark sellers are meant to run into lock contention, not their rate limits
+            with override_settings(CHARGE_PROCESSING_MODE=mode, CHARGE_QUEUE_COUNT=charge_queues,
+                                   RATE_LIMIT_ENABLED=False), workers:
+                results['charges'] = self.bench_charges(sellers, tokens, options)
+            if options['approvals']:
+                results['approvals'] = self.bench_approvals(sellers, options)
+        finally:
+            celery_app.conf.task_always_eager = eager
+            if not options['keep']:
+                User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+        self.report(results, options)
+
+    def create_sellers(self, options):
+        users = User.objects.bulk_create([
+            User(username=f"{USERNAME_PREFIX}{i}") for i in range(options['sellers'])
+        ])
+        sellers = Seller.objects.bulk_create([
+            Seller(user=user, name=user.username, credit=Decimal(options['initial_credit']))
+            for user in users
+        ])
+        tokens = {
+            token.user_id: token.key
+            for token in Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users])
+        }
+        return sellers, [tokens[seller.user_id] for seller in sellers]
+
+    def pick_sellers(self, options):
+        """
+        Seller index of every charge, with `hot_ratio` of them going to the hot sellers.
+        """
+        rng = random.Random(options['seed'])
+        hot = options['hot_sellers']
+        cold = options['sellers'] - hot
+        picks = []
+        for _ in range(options['charges']):
+            if hot and (rng.random() < options['hot_ratio'] or not cold):
+                picks.append(rng.randrange(hot))
+            else:
+                picks.append(hot + rng.randrange(cold))
+        return picks
+
+    def bench_charges(self, sellers, tokens, options):
+        picks = self.pick_sellers(options)
+        body = {'phone_number': '09120000000', 'amount': options['amount']}
+        latencies, statuses = [], Counter()
+        lock = threading.Lock()
+        next_charge = iter(range(len(picks)))
+
+        def worker():
+            client = APIClient(SERVER_NAME='localhost')
+            try:
+                while True:
+                    with lock:
+                        index = next(next_charge, None)
+                    if index is None:
+                        return
+                    client.credentials(HTTP_AUTHORIZATION=f"Token {tokens[picks[index]]}")
+                    start = time.perf_counter()
+                    response = client.post('/api/charge/', body)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        statuses[response.status_code] += 1
+            finally:
+                connections.close_all()
+
+        sampler = LockWaitSampler() if connection.vendor == 'postgresql' else None
+        if sampler:
+            sampler.start()
+
+        relay = OutboxRelay() if settings.CHARGE_PROCESSING_MODE == 'outbox' else None
+        threads = [threading.Thread(target=worker) for _ in range(options['concurrency'])]
+        start = time.perf_counter()
+        if relay:
+            relay.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if options['workers'] or options['local_workers'] or relay:
+            self.wait_for_settlement(sellers, len(picks))
+        elapsed = time.perf_counter() - start
+        if relay:
+            relay.stop()
+
+        if sampler:
+            sampler.stop()
+
+        summary = summarize_latencies(latencies, elapsed)
+        summary['statuses'] = {str(code): count for code, count in statuses.items()}
+        summary['charge_statuses'] = dict(Counter(
+            Charge.objects.filter(seller__in=sellers).values_list('status', flat=True)
+        ))
+        summary['settled_per_sec'] = round(
+            sum(count for status, count in summary['charge_statuses'].items() if status != 'pending') / elapsed, 2
+        )
+        if sampler:
+            summary['lock_wait_seconds'] = round(sampler.lock_wait_seconds, 3)
+            summary['max_lock_waiters'] = sampler.max_waiting
+        return summary
+
+    def local_workers(self, charge_queues, threads):
+        """
+        Starts Celery workers in this process over an in-memory broker, laid out like
+        the deployment: all threads on the default queue, or one thread per charge queue
+        (`threads` of them) next to one default queue thread.
+        """
+        if charge_queues and charge_queues != threads:
+            raise CommandError("--local-workers must equal --charge-queues when charges are routed per seller")
+        # The in-memory transport only notices freed prefetch slots every few seconds,
+        # so the threads prefetch deeply; a charge queue still has a single thread
+        celery_app.conf.update(
+            CELERY_BROKER_URL='memory://', CELERY_BROKER_TRANSPORT_OPTIONS={'polling_interval': 0.001},
+            CELERY_WORKER_PREFETCH_MULTIPLIER=64, CELERY_TASK_ALWAYS_EAGER=False, CELERY_TASK_IGNORE_RESULT=True,
+        )
+        layout = [(queue, 1) for queue in charge_queue_names(charge_queues)]
+        layout.append((celery_app.conf.task_default_queue, 1 if charge_queues else threads))
+
+        stack = ExitStack()
+        for queue, concurrency in layout:
+            stack.enter_context(start_worker(
+                celery_app, pool='threads', concurrency=concurrency, queues=[queue],
+                perform_ping_check=False, shutdown_timeout=60,
+            ))
+        return stack
+
+    def wait_for_settlement(self, sellers, expected, timeout=600):
+        deadline = time.monotonic() + timeout
+        settled = Charge.objects.filter(seller__in=sellers).exclude(status='pending')
+        while settled.count() < expected:
+            if time.monotonic() > deadline:
+                raise CommandError(f"Only {settled.count()} of {expected} charges settled in {timeout}s")
+            time.sleep(0.1)
+
+    def bench_approvals(self, sellers, options):
+        rng = random.Random(options['seed'])
+        CreditRequest.objects.bulk_create([
+            CreditRequest(seller=rng.choice(sellers), amount=Decimal('1.00'))
+            for _ in range(options['approvals'])
+        ])
+        queryset = CreditRequest.objects.filter(seller__in=sellers, status='pending')
+
+        request = RequestFactory().post('/admin/B2B_shop/creditrequest/')
+        request._messages = CookieStorage(request)
+        model_admin = site._registry[CreditRequest]
+
+        start = time.perf_counter()
+        model_admin.approve_requests(request, queryset)
+        elapsed = time.perf_counter() - start
+
+        approved = CreditRequest.objects.filter(seller__in=sellers, status='approved').count()
+        return {
+            'requests': options['approvals'],
+            'approved': approved,
+            'seconds': round(elapsed, 3),
+            'approvals_per_sec': round(approved / elapsed, 2) if elapsed else None,
+        }
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, check=True, cwd=settings.BASE_DIR
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self, results, options):
+        charges = results['charges']
+        self.stdout.write(
+            f"charges ({results['config']['mode']}, {results['config']['charge_queues']} charge queues): "
+            f"{charges['requests']} requests, "
+            f"{charges['throughput_per_sec']} req/s, {charges['settled_per_sec']} settled/s, "
+            f"p50={charges['p50_ms']}ms p95={charges['p95_ms']}ms p99={charges['p99_ms']}ms, "
+            f"lock wait={charges.get('lock_wait_seconds')}s, outcomes={charges['charge_statuses']}"
+        )
+        if 'approvals' in results:
+            approvals = results['approvals']
+            self.stdout.write(
+                f"approvals: {approvals['approved']}/{approvals['requests']} in {approvals['seconds']}s "
+                f"({approvals['approvals_per_sec']}/s)"
+            )
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+            for section in ('charges', 'approvals'):
+                for metric, value in results.get(section, {}).items():
+                    before = previous.get(section, {}).get(metric)
+                    if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+                        self.stdout.write(
+                            f"{section}.{metric}: {before} -> {value} ({(value - before) / before:+.1%})"
+                        )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
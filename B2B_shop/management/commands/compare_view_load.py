@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+from B2B_shop.benchmarking import run_http_load, summarize_latencies
+
+# endpoint name -> (method, sync path, async path, request body)
+ENDPOINTS = {
+    'transactions': ('GET', '/api/transactions/', '/api/async/transactions/', None),
+    'credit-request': ('POST', '/api/credit-request/', '/api/async/credit-request/', {'amount': '1.00'}),
+    'charge': ('POST', '/api/charge/', '/api/async/charge/', {'phone_number': '09120000000', 'amount': '0.01'}),
+}
+
+
+class Command(BaseCommand):
+    help = "Compares the sync DRF views with their async-native versions under concurrent load."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://localhost:8000')
+        parser.add_argument('--token', required=True, help="Auth token of the seller to load test with")
+        parser.add_argument('--endpoint', choices=list(ENDPOINTS), action='append',
+                            help="Endpoint to compare, may be repeated (default: all)")
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--output', help="Write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        headers = {'Authorization': f"Token {options['token']}"}
+        results = {}
+
+        for name in options['endpoint'] or list(ENDPOINTS):
+            method, sync_path, async_path, body = ENDPOINTS[name]
+            for variant, path in (('sync', sync_path), ('async', async_path)):
+                latencies, statuses, elapsed = asyncio.run(run_http_load(
+                    options['base_url'].rstrip('/') + path,
+                    options['requests'],
+                    options['concurrency'],
+                    method=method,
+                    headers=headers,
+                    body=body,
+                ))
+                summary = summarize_latencies(latencies, elapsed)
+                summary['statuses'] = {str(code): count for code, count in statuses.items()}
+                results[f"{name}:{variant}"] = summary
+                self.stdout.write(
+                    f"{name:<15} {variant:<6} {summary['throughput_per_sec']} req/s  "
+                    f"p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms  "
+                    f"statuses={summary['statuses']}"
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from B2B_shop.partitioning import (
+    archive_blockers, archive_partition, ensure_partitions, expired_partitions, is_partitioned, partitioned_models,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates the monthly transaction log and charge partitions ahead of time and archives "
+        "partitions older than the retention period to gzipped CSV files (Postgres only)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=settings.PARTITION_MONTHS_AHEAD,
+                            help="Months ahead of the current one to create partitions for")
+        parser.add_argument('--retain', type=int, default=settings.PARTITION_RETENTION_MONTHS,
+                            help="Past months to keep attached; older partitions are archived (0 keeps all)")
+        parser.add_argument('--archive-dir', default=settings.PARTITION_ARCHIVE_DIR)
+        parser.add_argument('--detach-only', action='store_true',
+                            help="Detach expired partitions but keep them as standalone tables")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the partitions that would be archived")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Table partitioning needs PostgreSQL")
+
+        if not options['dry_run']:
+            for name in ensure_partitions(options['ahead']):
+                self.stdout.write(f"Created {name}")
+
+        if not options['retain']:
+            return
+        with connection.cursor() as cursor:
+            expired = [
+                (model, month, name)
+                for model in partitioned_models() if is_partitioned(cursor, model)
+                for month, name in expired_partitions(cursor, model, options['retain']).items()
+            ]
+            blockers = {name: archive_blockers(model, month) for model, month, name in expired}
+
+        for model, month, name in expired:
+            if blockers[name]:
+                self.stderr.write(f"Skipped {name}: {blockers[name]}")
+            elif options['dry_run']:
+                self.stdout.write(f"Would archive {name}")
+            else:
+                target = archive_partition(model, month, options['archive_dir'], options['detach_only'])
+                self.stdout.write(f"Detached {name}" if options['detach_only'] else f"Archived {name} to {target}")
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from B2B_shop.partitioning import convert_to_partitioned, is_partitioned, partitioned_models
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the transaction log and charge tables as tables partitioned by created_at month "
+        "(Postgres only). Each table is locked while its rows are copied, so run it in a "
+        "maintenance window; tables that are partitioned already are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=settings.PARTITION_MONTHS_AHEAD,
+                            help="Months ahead of the current one to create partitions for")
+        parser.add_argument('--lock-timeout', default='5s',
+                            help="Give up if a table cannot be locked within this long, "
+                                 "e.g. behind a long transaction (Postgres interval, 0 waits forever)")
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Table partitioning needs PostgreSQL")
+
+        for model in partitioned_models():
+            table = model._meta.db_table
+            with transaction.atomic(), connection.cursor() as cursor:
+                if is_partitioned(cursor, model):
+                    self.stdout.write(f"{table} is partitioned already")
+                    continue
+                cursor.execute("SELECT set_config('lock_timeout', %s, true)", [options['lock_timeout']])
+                convert_to_partitioned(cursor, model, options['ahead'])
+            self.stdout.write(f"Partitioned {table}")
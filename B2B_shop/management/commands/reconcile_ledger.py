@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from B2B_shop.models import Seller
+from B2B_shop.reconciliation import reconcile_seller, reset_checkpoints
+from B2B_shop.tasks import reconcile_seller_task
+
+
+class Command(BaseCommand):
+    help = (
+        "Verifies that every seller's transaction log forms unbroken balance_after chains ending "
+        "at the live balances. Only entries added since the last run are read."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seller', type=int, action='append',
+                            help="Seller id to reconcile, may be repeated (default: all)")
+        parser.add_argument('--full', action='store_true',
+                            help="Drop the checkpoints first and verify the whole log")
+        parser.add_argument('--queue', action='store_true',
+                            help="Queue one Celery task per seller instead of running here")
+
+    def handle(self, *args, **options):
+        if options['full']:
+            reset_checkpoints(options['seller'])
+
+        seller_ids = options['seller'] or list(Seller.objects.values_list('id', flat=True))
+        if options['queue']:
+            for seller_id in seller_ids:
+                reconcile_seller_task.delay(seller_id)
+            self.stdout.write(f"Queued reconciliation of {len(seller_ids)} sellers")
+            return
+
+        verified, mismatches = 0, 0
+        for seller_id in seller_ids:
+            try:
+                result = reconcile_seller(seller_id)
+            except Seller.DoesNotExist:
+                raise CommandError(f"Seller {seller_id} does not exist")
+            verified += result.verified
+            if result.error:
+                mismatches += 1
+                self.stderr.write(f"seller {seller_id}: {result.error}")
+
+        self.stdout.write(f"Verified {verified} entries of {len(seller_ids)} sellers, {mismatches} mismatches")
+        if mismatches:
+            raise CommandError(f"{mismatches} sellers have ledger mismatches")
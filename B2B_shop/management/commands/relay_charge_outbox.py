@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from B2B_shop.outbox import relay_charge_outbox, run_charge_relay
+
+
+class Command(BaseCommand):
+    help = (
+        "Publishes the charges stored by the 'outbox' charge processing mode to the Celery "
+        "workers, one task per seller and round, until interrupted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help="Most charges published per round (default: CHARGE_OUTBOX_BATCH_SIZE)")
+        parser.add_argument('--interval', type=int,
+                            help="Milliseconds between rounds that were not full "
+                                 "(default: CHARGE_OUTBOX_POLL_INTERVAL_MS)")
+        parser.add_argument('--once', action='store_true', help="Run a single round and exit")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or settings.CHARGE_OUTBOX_BATCH_SIZE
+        if options['once']:
+            relayed = relay_charge_outbox(batch_size)
+            self.stdout.write(f"Relayed {relayed} charges")
+            return
+
+        self.stdout.write(f"Relaying the charge outbox, {batch_size} charges per round")
+        try:
+            run_charge_relay(batch_size=batch_size, interval_ms=options['interval'])
+        except KeyboardInterrupt:
+            pass
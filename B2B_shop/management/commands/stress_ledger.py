@@ -0,0 +1,146 @@
+import multiprocessing
+import random
+import time
+from collections import Counter
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import Sum
+
+from B2B_shop.ledger import (
+    LEDGER_RETRIES_TOTAL, LOCK_NOWAIT, LOCK_SKIP_LOCKED, LOCK_WAIT, RETRYABLE_SQLSTATES, Posting, post,
+)
+from B2B_shop.models import Seller, TransactionLog
+from B2B_shop.reconciliation import reconcile_seller
+from B2B_shop.sharding import enable_credit_sharding
+
+USERNAME_PREFIX = 'stress_'
+LOCK_NOT_AVAILABLE = '55P03'
+LOCK_MODES = (LOCK_WAIT, LOCK_NOWAIT, LOCK_SKIP_LOCKED)
+
+
+def hammer(worker, options, seller_ids):
+    """
+    Runs one process's share of random multi-seller postings.
+    Returns the Counter of its outcomes.
+    """
+    rng = random.Random(options['seed'] * 1000 + worker)
+    max_cents = int(Decimal(options['max_amount']) * 100)
+    outcomes = Counter()
+    LEDGER_RETRIES_TOTAL.clear()
+    try:
+        for _ in range(options['transactions']):
+            # The sellers come in random order, the ledger locks them in its own
+            sellers = rng.sample(seller_ids, rng.randint(1, min(options['width'], len(seller_ids))))
+            amounts = [rng.choice((-1, 1)) * rng.randint(1, max_cents) * Decimal('0.01') for _ in sellers]
+            postings = [
+                Posting(seller_id, amount, 'add_credit' if amount > 0 else 'charge_sale')
+                for seller_id, amount in zip(sellers, amounts)
+            ]
+            try:
+                result = post(postings, lock=rng.choice(options['lock']), all_or_nothing=rng.random() < 0.5)
+            except OperationalError as e:
+                if getattr(e.__cause__, 'pgcode', None) != LOCK_NOT_AVAILABLE:
+                    raise
+                # NOWAIT gives up once a seller stays busy through every retry
+                outcomes['gave_up'] += 1
+                continue
+            outcomes['transactions'] += 1
+            outcomes['applied'] += len(result.applied)
+            outcomes['rejected'] += len(result.rejected)
+            outcomes['skipped'] += len(result.skipped)
+        for sqlstate in RETRYABLE_SQLSTATES:
+            outcomes[f"retried:{sqlstate}"] += LEDGER_RETRIES_TOTAL.value(sqlstate=sqlstate)
+    finally:
+        connections.close_all()
+    return outcomes
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammers the ledger (B2B_shop.ledger) from many processes with random postings over "
+        "a few sellers, in random seller order and lock modes, then verifies that every balance "
+        "equals its initial credit plus its log and that the log chains are unbroken. "
+        "Creates and deletes its own 'stress_' sellers; meant for PostgreSQL."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=8)
+        parser.add_argument('--transactions', type=int, default=500, help="Transactions per process")
+        parser.add_argument('--sellers', type=int, default=5,
+                            help="Sellers sharing the load; fewer means more contention")
+        parser.add_argument('--sharded-sellers', type=int, default=0,
+                            help="How many of the sellers have sharded credit (4 shards each)")
+        parser.add_argument('--width', type=int, default=3, help="Most sellers posted to per transaction")
+        parser.add_argument('--lock', choices=LOCK_MODES, action='append',
+                            help="Lock mode to use, may be repeated (default: all, picked at random)")
+        parser.add_argument('--max-amount', default='20.00', help="Largest debit or credit of a posting")
+        parser.add_argument('--initial-credit', default='100.00')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help="Keep the stress sellers")
+
+    def handle(self, *args, **options):
+        if options['sharded_sellers'] > options['sellers']:
+            raise CommandError("--sharded-sellers cannot exceed --sellers")
+        if User.objects.filter(username__startswith=USERNAME_PREFIX).exists():
+            raise CommandError("Stress sellers already exist, remove them or run with a clean database")
+        if connection.vendor != 'postgresql':
+            self.stderr.write("Warning: the processes only contend for row locks on PostgreSQL")
+        options['lock'] = options['lock'] or list(LOCK_MODES)
+
+        initial = Decimal(options['initial_credit'])
+        users = User.objects.bulk_create([
+            User(username=f"{USERNAME_PREFIX}{i}") for i in range(options['sellers'])
+        ])
+        sellers = Seller.objects.bulk_create([Seller(user=user, name=user.username, credit=initial) for user in users])
+        seller_ids = [seller.pk for seller in sellers]
+        for seller_id in seller_ids[:options['sharded_sellers']]:
+            enable_credit_sharding(seller_id, 4)
+
+        try:
+            # Forked processes must not share the parent's connection
+            connections.close_all()
+            start = time.perf_counter()
+            with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+                results = pool.starmap(hammer, [(worker, options, seller_ids) for worker in range(options['processes'])])
+            elapsed = time.perf_counter() - start
+            outcomes = sum(results, Counter())
+            mismatches = self.verify(seller_ids, initial)
+        finally:
+            if not options['keep']:
+                User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+        retries = {key.split(':')[1]: count for key, count in outcomes.items() if key.startswith('retried:') and count}
+        self.stdout.write(
+            f"{outcomes['transactions']} transactions in {elapsed:.2f}s "
+            f"({outcomes['transactions'] / elapsed:.1f}/s) from {options['processes']} processes: "
+            f"{outcomes['applied']} postings applied, {outcomes['rejected']} rejected, "
+            f"{outcomes['skipped']} skipped, {outcomes['gave_up']} NOWAIT transactions gave up, "
+            f"retries by SQLSTATE={retries}"
+        )
+        for mismatch in mismatches:
+            self.stderr.write(mismatch)
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} sellers have ledger mismatches")
+        # Sellers are locked in one order, so any deadlock is a bug
+        if retries.get('40P01'):
+            raise CommandError(f"{retries['40P01']} deadlocks")
+        self.stdout.write(f"Verified the ledgers of {len(seller_ids)} sellers")
+
+    def verify(self, seller_ids, initial):
+        mismatches = []
+        log_sums = dict(
+            TransactionLog.objects.filter(seller_id__in=seller_ids).values('seller_id')
+            .annotate(total=Sum('amount')).values_list('seller_id', 'total')
+        )
+        for seller in Seller.objects.filter(pk__in=seller_ids):
+            # The sharding transfer entries of a sharded seller sum to zero
+            expected = initial + (log_sums.get(seller.pk) or 0)
+            if seller.live_credit != expected:
+                mismatches.append(f"seller {seller.pk}: balance {seller.live_credit}, log says {expected}")
+            result = reconcile_seller(seller.pk)
+            if result.error:
+                mismatches.append(f"seller {seller.pk}: {result.error}")
+        return mismatches
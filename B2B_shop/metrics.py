@@ -0,0 +1,184 @@
+import bisect
+import threading
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Upper bounds of the latency histogram buckets (seconds)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_null_timer = nullcontext()
+# METRICS_ENABLED, read once: a settings lookup costs more than recording a value
+_enabled = None
+
+
+def enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = settings.METRICS_ENABLED
+    return _enabled
+
+
+@receiver(setting_changed)
+def _reset_enabled(setting, **kwargs):
+    global _enabled
+    if setting == 'METRICS_ENABLED':
+        _enabled = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in labels)
+    return '{' + pairs + '}'
+
+
+class Metric:
+    """
+    A metric kept in this process's memory, one series per set of label values.
+    Recording is a no-op while METRICS_ENABLED is off.
+    """
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self._series.items())
+            lines += [line for labels, value in series for line in self._render_series(labels, value)]
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled():
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._series.get(tuple(sorted(labels.items())), 0)
+
+    def _render_series(self, labels, value):
+        yield f"{self.name}{_format_labels(labels)} {value}"
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.started, **self.labels)
+
+
+class Histogram(Metric):
+    """
+    Counts observations into fixed buckets, plus their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not enabled():
+            return
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # per bucket counts (the last one is +Inf), sum, count
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """
+        Context manager observing the duration of its block.
+        """
+        return _Timer(self, labels) if enabled() else _null_timer
+
+    def count(self, **labels):
+        series = self._series.get(tuple(sorted(labels.items())))
+        return series[2] if series else 0
+
+    def _render_series(self, labels, value):
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            yield f"{self.name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(labels)} {total}"
+        yield f"{self.name}_count{_format_labels(labels)} {count}"
+
+
+def render():
+    """
+    The metrics of this process in the Prometheus text format.
+    """
+    lines = [line for metric in _registry for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    for metric in _registry:
+        metric.clear()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    """
+    Serves /metrics of this process from a daemon thread, for processes without
+    a web server such as Celery workers. Returns the server.
+    """
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics').start()
+    return server
+
+
+CHARGE_PHASE_SECONDS = Histogram(
+    'b2b_charge_phase_seconds',
+    "Time charges spend in each phase: outbox, queue_wait, lock, insert, commit"
+)
+CHARGES_TOTAL = Counter('b2b_charges_total', "Charges processed by outcome")
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0002_transactionlog_phone_number_charge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seller',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='transactionlog',
+            name='shard',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transactionlog',
+            name='transaction_type',
+            field=models.CharField(choices=[('add_credit', 'Add Credit'), ('charge_sale', 'Charge Sale'), ('shard_rebalance', 'Shard Rebalance')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='SellerCreditShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('credit', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credit_shards', to='B2B_shop.seller')),
+            ],
+            options={
+                'constraints': [models.CheckConstraint(condition=models.Q(('credit__gte', 0)), name='shard_credit_not_negative'), models.UniqueConstraint(fields=('seller', 'index'), name='unique_seller_shard_index')],
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0003_seller_credit_shards'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['seller', 'created_at'], name='charge_seller_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(fields=['phone_number'], name='charge_phone_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['seller', 'created_at'], name='charge_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='creditrequest',
+            index=models.Index(fields=['seller', 'status'], name='creditreq_seller_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='creditrequest',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['created_at'], name='creditreq_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionlog',
+            index=models.Index(fields=['seller', 'created_at', 'unique_id'], name='txlog_seller_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionlog',
+            index=models.Index(fields=['transaction_type', 'created_at'], name='txlog_type_created_idx'),
+        ),
+        # Drop the single-column FK indexes once the composite ones exist
+        migrations.AlterField(
+            model_name='charge',
+            name='seller',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='charges', to='B2B_shop.seller'),
+        ),
+        migrations.AlterField(
+            model_name='transactionlog',
+            name='seller',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transactions', to='B2B_shop.seller'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:40
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0005_charge_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charge',
+            name='batch_line',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ChargeBatch',
+            fields=[
+                ('unique_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('mode', models.CharField(choices=[('partial', 'Partial'), ('all_or_nothing', 'All or nothing')], default='partial', max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processed', 'Processed')], default='pending', max_length=10)),
+                ('line_count', models.PositiveIntegerField()),
+                ('total_amount', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('completed_count', models.PositiveIntegerField(default=0)),
+                ('failed_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('seller', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='charge_batches', to='B2B_shop.seller')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='charge',
+            name='batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='charges', to='B2B_shop.chargebatch'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0006_charge_batches'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerRollupState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rolled_up_until', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LedgerRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('transaction_type', models.CharField(choices=[('add_credit', 'Add Credit'), ('charge_sale', 'Charge Sale'), ('shard_rebalance', 'Shard Rebalance')], max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('entry_count', models.PositiveIntegerField()),
+                ('opening_balance', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('closing_balance', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('first_entry_at', models.DateTimeField()),
+                ('last_entry_at', models.DateTimeField()),
+                ('seller', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='ledger_rollups', to='B2B_shop.seller')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('seller', 'day', 'transaction_type'), name='unique_ledger_rollup')],
+            },
+        ),
+    ]
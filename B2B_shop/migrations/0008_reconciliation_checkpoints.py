@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0007_ledger_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReconciliationCheckpoint',
+            fields=[
+                ('seller', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='reconciliation', serialize=False, to='B2B_shop.seller')),
+                ('verified_until', models.DateTimeField(blank=True, null=True)),
+                ('balances', models.JSONField(default=dict)),
+                ('entry_count', models.PositiveBigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('mismatch', 'Mismatch')], default='ok', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('checked_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
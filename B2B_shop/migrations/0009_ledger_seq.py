@@ -0,0 +1,120 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:51
+
+from itertools import groupby
+from operator import attrgetter
+
+import B2B_shop.uuids
+from django.db import migrations, models
+
+# Entries read and updated per query
+BATCH_SIZE = 1000
+
+
+def _chain_order(entries, balance=None):
+    """
+    Orders a chain's entries by created_at and, for entries created in the same
+    instant, in the order their balances follow each other from `balance`.
+    Returns the ordered entries and the balance after them.
+    """
+    ordered = []
+    for _, group in groupby(entries, key=attrgetter('created_at')):
+        group = list(group)
+        while group:
+            entry = next((e for e in group if e.balance_after - e.amount == balance), None)
+            if entry is None:
+                afters = {e.balance_after for e in group}
+                entry = next((e for e in group if e.balance_after - e.amount not in afters), group[0])
+            group.remove(entry)
+            ordered.append(entry)
+            balance = entry.balance_after
+    return ordered, balance
+
+
+def _chain_batches(entries):
+    """
+    Yields a chain's entries in created_at order, about BATCH_SIZE at a time. A batch
+    only ends between two instants, so entries created in the same instant are ordered together.
+    """
+    entries = entries.order_by('created_at', 'unique_id')
+    batch = list(entries[:BATCH_SIZE])
+    while batch:
+        last = batch[-1]
+        if len(batch) < BATCH_SIZE:
+            yield batch
+            return
+        batch += entries.filter(created_at=last.created_at, unique_id__gt=last.unique_id)
+        yield batch
+        batch = list(entries.filter(created_at__gt=last.created_at)[:BATCH_SIZE])
+
+
+def backfill_seq(apps, schema_editor):
+    """
+    Numbers the existing entries of every chain from 1 and stores the last number
+    on the seller or shard. Checkpoints are dropped so reconciliation starts over in seq order.
+    Chains are read and numbered in batches, so a long log is never held in memory.
+    """
+    Seller = apps.get_model('B2B_shop', 'Seller')
+    SellerCreditShard = apps.get_model('B2B_shop', 'SellerCreditShard')
+    TransactionLog = apps.get_model('B2B_shop', 'TransactionLog')
+    ReconciliationCheckpoint = apps.get_model('B2B_shop', 'ReconciliationCheckpoint')
+
+    ReconciliationCheckpoint.objects.all().delete()
+    for seller_id in Seller.objects.values_list('pk', flat=True).iterator():
+        log = TransactionLog.objects.filter(seller_id=seller_id)
+        for shard in list(log.order_by().values_list('shard', flat=True).distinct()):
+            entries = log.filter(shard=shard).only('unique_id', 'amount', 'balance_after', 'created_at')
+            seq, balance = 0, None
+            for batch in _chain_batches(entries):
+                ordered, balance = _chain_order(batch, balance)
+                for seq, entry in enumerate(ordered, start=seq + 1):
+                    entry.seq = seq
+                TransactionLog.objects.bulk_update(ordered, ['seq'])
+            if shard is None:
+                Seller.objects.filter(pk=seller_id).update(ledger_seq=seq)
+            else:
+                SellerCreditShard.objects.filter(seller_id=seller_id, index=shard).update(ledger_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0008_reconciliation_checkpoints'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='reconciliationcheckpoint',
+            name='verified_until',
+        ),
+        migrations.AddField(
+            model_name='reconciliationcheckpoint',
+            name='sequences',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='seller',
+            name='ledger_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='sellercreditshard',
+            name='ledger_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='transactionlog',
+            name='seq',
+            field=models.PositiveBigIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='charge',
+            name='unique_id',
+            field=models.UUIDField(default=B2B_shop.uuids.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='transactionlog',
+            name='unique_id',
+            field=models.UUIDField(default=B2B_shop.uuids.uuid7, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+    ]
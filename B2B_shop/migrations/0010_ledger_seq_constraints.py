@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0009_ledger_seq'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transactionlog',
+            name='seq',
+            field=models.PositiveBigIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name='transactionlog',
+            constraint=models.UniqueConstraint(condition=models.Q(('shard__isnull', True)), fields=('seller', 'seq'), name='unique_txlog_seller_seq'),
+        ),
+        migrations.AddConstraint(
+            model_name='transactionlog',
+            constraint=models.UniqueConstraint(condition=models.Q(('shard__isnull', False)), fields=('seller', 'shard', 'seq'), name='unique_txlog_shard_seq'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0010_ledger_seq_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charge',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='charge',
+            index=models.Index(condition=models.Q(('batch__isnull', True), ('status', 'pending')), fields=['created_at'], name='charge_outbox_idx'),
+        ),
+    ]
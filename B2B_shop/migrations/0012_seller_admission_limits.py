@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0011_charge_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seller',
+            name='charge_rate_burst',
+            field=models.PositiveIntegerField(blank=True, help_text='Charges accepted at once after an idle period', null=True),
+        ),
+        migrations.AddField(
+            model_name='seller',
+            name='charge_rate_limit',
+            field=models.PositiveIntegerField(blank=True, help_text='Charges per minute', null=True),
+        ),
+        migrations.AddField(
+            model_name='seller',
+            name='credit_request_rate_limit',
+            field=models.PositiveIntegerField(blank=True, help_text='Credit requests per minute', null=True),
+        ),
+        migrations.AddField(
+            model_name='seller',
+            name='max_inflight_charges',
+            field=models.PositiveIntegerField(blank=True, help_text='Accepted charges that may wait for a worker at once', null=True),
+        ),
+    ]
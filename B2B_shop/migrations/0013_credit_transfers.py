@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:59
+
+import B2B_shop.uuids
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0012_seller_admission_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='seller',
+            name='parent',
+            field=models.ForeignKey(blank=True, help_text='Distributor allowed to transfer credit to this seller', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='children', to='B2B_shop.seller'),
+        ),
+        migrations.AlterField(
+            model_name='ledgerrollup',
+            name='transaction_type',
+            field=models.CharField(choices=[('add_credit', 'Add Credit'), ('charge_sale', 'Charge Sale'), ('shard_rebalance', 'Shard Rebalance'), ('transfer_out', 'Transfer Out'), ('transfer_in', 'Transfer In')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='transactionlog',
+            name='transaction_type',
+            field=models.CharField(choices=[('add_credit', 'Add Credit'), ('charge_sale', 'Charge Sale'), ('shard_rebalance', 'Shard Rebalance'), ('transfer_out', 'Transfer Out'), ('transfer_in', 'Transfer In')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='CreditTransfer',
+            fields=[
+                ('unique_id', models.UUIDField(default=B2B_shop.uuids.uuid7, editable=False, primary_key=True, serialize=False)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('recipient', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transfers_in', to='B2B_shop.seller')),
+                ('sender', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='transfers_out', to='B2B_shop.seller')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sender', 'created_at'], name='transfer_sender_created_idx'), models.Index(fields=['recipient', 'created_at'], name='transfer_recipient_created_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(('amount__gt', 0)), name='transfer_amount_positive'), models.CheckConstraint(condition=models.Q(('sender', models.F('recipient')), _negated=True), name='transfer_not_to_self')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:04
+
+import django.db.models.deletion
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0013_credit_transfers'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='creditrequest',
+            name='auto_approved',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='CreditApprovalRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trusted', models.BooleanField(default=False, help_text='Approve requests of any amount')),
+                ('max_amount', models.DecimalField(blank=True, decimal_places=2, help_text='Approve requests up to this amount', max_digits=10, null=True)),
+                ('daily_cap', models.DecimalField(blank=True, decimal_places=2, help_text='Most credit approved automatically per seller and day', max_digits=10, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('seller', models.ForeignKey(blank=True, help_text='Empty for the default rule of every seller without a rule of their own', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='B2B_shop.seller')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(django.db.models.functions.comparison.Coalesce('seller', models.Value(0)), name='approval_rule_per_seller')],
+            },
+        ),
+    ]
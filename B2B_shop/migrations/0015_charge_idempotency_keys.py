@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_keys(apps, schema_editor):
+    """
+    Copies the keys of the existing charges with one INSERT ... SELECT. Should a key
+    already repeat across months, the oldest charge keeps it.
+    """
+    quote = schema_editor.quote_name
+    keys = quote(apps.get_model('B2B_shop', 'ChargeIdempotencyKey')._meta.db_table)
+    charges = quote(apps.get_model('B2B_shop', 'Charge')._meta.db_table)
+    schema_editor.execute(
+        f"INSERT INTO {keys} (seller_id, {quote('key')}, charge_id, created_at) "
+        f"SELECT seller_id, idempotency_key, unique_id, created_at FROM {charges} "
+        f"WHERE idempotency_key IS NOT NULL ORDER BY created_at "
+        f"ON CONFLICT (seller_id, {quote('key')}) DO NOTHING"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0014_credit_approval_rules'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChargeIdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('charge_id', models.UUIDField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('seller', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='B2B_shop.seller')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('seller', 'key'), name='unique_seller_idempotency_key')],
+            },
+        ),
+        migrations.RunPython(backfill_keys, migrations.RunPython.noop),
+    ]
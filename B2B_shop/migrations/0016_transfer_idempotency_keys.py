@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('B2B_shop', '0015_charge_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='credittransfer',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='credittransfer',
+            name='line',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='credittransfer',
+            constraint=models.UniqueConstraint(condition=models.Q(('idempotency_key__isnull', False)), fields=('sender', 'idempotency_key', 'line'), name='unique_transfer_idempotency_key'),
+        ),
+    ]
@@ -1,7 +1,9 @@
 import uuid
 from django.db import models
-from django.db.models import CheckConstraint, Q, F
+from django.db.models import CheckConstraint, UniqueConstraint, Q, F, Sum, Value
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
+from .uuids import uuid7
 
 class Seller(models.Model):
     """
@@ -12,18 +14,71 @@ class Seller(models.Model):
     name = models.CharField(max_length=100)
     # Using DecimalField for financial accuracy
     credit = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    # Number of credit shards, 0 keeps the whole balance on this row.
+    # For sharded sellers `credit` is the sum of the shards, refreshed on rebalance.
+    shard_count = models.PositiveSmallIntegerField(default=0)
+    # Last seq given to an entry of this row's balance_after chain, bumped
+    # in the same UPDATE that changes `credit`
+    ledger_seq = models.PositiveBigIntegerField(default=0)
+    # Admission limits of this seller (B2B_shop.ratelimit); empty uses the settings, 0 turns a limit off
+    charge_rate_limit = models.PositiveIntegerField(blank=True, null=True, help_text="Charges per minute")
+    charge_rate_burst = models.PositiveIntegerField(
+        blank=True, null=True, help_text="Charges accepted at once after an idle period"
+    )
+    max_inflight_charges = models.PositiveIntegerField(
+        blank=True, null=True, help_text="Accepted charges that may wait for a worker at once"
+    )
+    credit_request_rate_limit = models.PositiveIntegerField(
+        blank=True, null=True, help_text="Credit requests per minute"
+    )
+    # The distributor this seller is a sub-reseller of, the only seller that may transfer credit to it
+    parent = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, blank=True, null=True, related_name='children',
+        help_text="Distributor allowed to transfer credit to this seller"
+    )
 
     class Meta:
         constraints = [
             CheckConstraint(check=Q(credit__gte=0), name='credit_not_negative')
         ]
 
+    @property
+    def live_credit(self):
+        """
+        The exact current balance, summed over the shards for sharded sellers.
+        """
+        if not self.shard_count:
+            return self.credit
+        return self.credit_shards.aggregate(total=Sum('credit'))['total'] or 0
+
     def __str__(self):
         return f"{self.name} - Credit: {self.credit}"
 
+class SellerCreditShard(models.Model):
+    """
+    One sub-balance of a sharded seller's credit.
+    Charges debit any shard with enough funds, so a hot seller's charges do not
+    all serialize on the Seller row. Each shard can never be negative.
+    """
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='credit_shards')
+    index = models.PositiveSmallIntegerField()
+    credit = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
+    # Last seq given to an entry of this shard's chain
+    ledger_seq = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            CheckConstraint(check=Q(credit__gte=0), name='shard_credit_not_negative'),
+            UniqueConstraint(fields=['seller', 'index'], name='unique_seller_shard_index'),
+        ]
+
+    def __str__(self):
+        return f"{self.seller.name} shard {self.index} - Credit: {self.credit}"
+
 class CreditRequest(models.Model):
     """
-    A request from a seller to increase their credit, which requires admin approval[cite: 4].
+    A request from a seller to increase their credit, which requires admin approval[cite: 4]
+    unless a CreditApprovalRule approves it on creation.
     """
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -33,13 +88,115 @@ class CreditRequest(models.Model):
     seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='credit_requests')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # Approved on creation by a CreditApprovalRule rather than by an admin
+    auto_approved = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['seller', 'status'], name='creditreq_seller_status_idx'),
+            # The admin review queue only ever scans pending requests
+            models.Index(fields=['created_at'], name='creditreq_pending_idx', condition=Q(status='pending')),
+        ]
+
     def __str__(self):
         return f"Request of {self.amount} for {self.seller.name} ({self.status})"
 
 
+class CreditApprovalRule(models.Model):
+    """
+    Which new credit requests are approved without waiting for an admin (B2B_shop.auto_approval).
+    A seller's own rule replaces the default rule, the one without a seller, so a seller
+    rule that is neither trusted nor has a max amount keeps all of its requests for review.
+    """
+    seller = models.ForeignKey(
+        Seller, on_delete=models.CASCADE, blank=True, null=True, related_name='+',
+        help_text="Empty for the default rule of every seller without a rule of their own"
+    )
+    trusted = models.BooleanField(default=False, help_text="Approve requests of any amount")
+    max_amount = models.DecimalField(
+        max_digits=10, decimal_places=2, blank=True, null=True, help_text="Approve requests up to this amount"
+    )
+    daily_cap = models.DecimalField(
+        max_digits=10, decimal_places=2, blank=True, null=True,
+        help_text="Most credit approved automatically per seller and day"
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # One rule per seller, and a single default rule
+            UniqueConstraint(Coalesce('seller', Value(0)), name='approval_rule_per_seller'),
+        ]
+
+    def __str__(self):
+        return f"Approval rule of {self.seller.name if self.seller_id else 'every seller'}"
+
+
+class ChargeBatch(models.Model):
+    """
+    A bulk top-up list submitted in one request, e.g. payroll-style phone credit.
+    Each line is a Charge; the batch is debited under one lock, either line by line
+    ('partial') or entirely or not at all ('all_or_nothing').
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processed', 'Processed'),
+    ]
+    MODE_CHOICES = [
+        ('partial', 'Partial'),
+        ('all_or_nothing', 'All or nothing'),
+    ]
+
+    unique_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='charge_batches')
+    mode = models.CharField(max_length=20, choices=MODE_CHOICES, default='partial')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    line_count = models.PositiveIntegerField()
+    total_amount = models.DecimalField(max_digits=16, decimal_places=2)
+    completed_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Batch of {self.line_count} charges by {self.seller.name} ({self.status})"
+
+
+class CreditTransfer(models.Model):
+    """
+    Credit a distributor moved to one of its sub-resellers. It is written in the
+    transaction that posts its transfer_out and transfer_in log entries.
+    The transfers of a request share its Idempotency-Key, if any, and are told apart by `line`.
+    """
+    unique_id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
+    sender = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='transfers_out', db_index=False)
+    recipient = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='transfers_in', db_index=False)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    idempotency_key = models.CharField(max_length=64, blank=True, null=True)
+    line = models.PositiveIntegerField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            CheckConstraint(check=Q(amount__gt=0), name='transfer_amount_positive'),
+            CheckConstraint(check=~Q(sender=F('recipient')), name='transfer_not_to_self'),
+            UniqueConstraint(
+                fields=['sender', 'idempotency_key', 'line'],
+                condition=Q(idempotency_key__isnull=False),
+                name='unique_transfer_idempotency_key'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['sender', 'created_at'], name='transfer_sender_created_idx'),
+            models.Index(fields=['recipient', 'created_at'], name='transfer_recipient_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Transfer of {self.amount} from {self.sender.name} to {self.recipient.name}"
+
+
 class Charge(models.Model):
     """
     Represents a charge initiated by a seller, e.g., for a product or service.
@@ -52,22 +209,68 @@ class Charge(models.Model):
         ('failed', 'Failed'),
     ]
 
-    unique_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='charges')
+    unique_id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
+    # Covered by the (seller, created_at) index
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='charges', db_index=False)
     phone_number = models.CharField(max_length=15)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # Client supplied Idempotency-Key, unique per seller so a retried request cannot charge twice
+    idempotency_key = models.CharField(max_length=64, blank=True, null=True)
+    # Set for lines of a batch submission, with their 1-based position in the batch
+    batch = models.ForeignKey(ChargeBatch, on_delete=models.CASCADE, related_name='charges', blank=True, null=True)
+    batch_line = models.PositiveIntegerField(blank=True, null=True)
+    # When a pending charge was last handed to a worker, by the outbox relay or a batch flush
+    dispatched_at = models.DateTimeField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         constraints = [
-            CheckConstraint(check=Q(amount__gt=0), name='charge_amount_positive')
+            CheckConstraint(check=Q(amount__gt=0), name='charge_amount_positive'),
+            UniqueConstraint(
+                fields=['seller', 'idempotency_key'],
+                condition=Q(idempotency_key__isnull=False),
+                name='unique_charge_idempotency_key'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['seller', 'created_at'], name='charge_seller_created_idx'),
+            models.Index(fields=['phone_number'], name='charge_phone_number_idx'),
+            # Buffered charges waiting for a batch flush
+            models.Index(fields=['seller', 'created_at'], name='charge_pending_idx', condition=Q(status='pending')),
+            # Single charges the outbox relay still has to hand to a worker, oldest first
+            models.Index(
+                fields=['created_at'], name='charge_outbox_idx', condition=Q(status='pending', batch__isnull=True)
+            ),
         ]
 
     def __str__(self):
         return f"Charge {self.amount} to {self.phone_number} by {self.seller.name} ({self.status})"
 
 
+class ChargeIdempotencyKey(models.Model):
+    """
+    The Idempotency-Key of every charge that had one, written in the transaction that
+    creates the charge. Once the charge table is partitioned its unique constraint only
+    holds within a month (see B2B_shop.partitioning), so this small unpartitioned table
+    keeps keys unique per seller for good.
+    """
+    # Covered by the unique (seller, key) constraint
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='+', db_index=False)
+    key = models.CharField(max_length=64)
+    # Not a foreign key: a partitioned Charge is keyed by (unique_id, created_at)
+    charge_id = models.UUIDField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['seller', 'key'], name='unique_seller_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} of seller {self.seller_id}"
+
+
 class TransactionLog(models.Model):
     """
     Logs every operation that changes a seller's credit to ensure accounting is verifiable[cite: 6, 7, 15].
@@ -76,16 +279,92 @@ class TransactionLog(models.Model):
     TRANSACTION_TYPES = [
         ('add_credit', 'Add Credit'),
         ('charge_sale', 'Charge Sale'),
+        ('shard_rebalance', 'Shard Rebalance'),
+        ('transfer_out', 'Transfer Out'),
+        ('transfer_in', 'Transfer In'),
     ]
     # Using a UUID for the unique transaction identifier
-    unique_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='transactions')
+    # Time-ordered, so inserts append to the primary key index
+    unique_id = models.UUIDField(primary_key=True, default=uuid7, editable=False)
+    # Covered by the (seller, created_at, unique_id) index
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='transactions', db_index=False)
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     phone_number = models.CharField(max_length=15, blank=True, null=True)
     balance_after = models.DecimalField(max_digits=10, decimal_places=2) # Seller's balance after this tx
+    # Credit shard this entry applies to; balance_after is then the shard's balance
+    shard = models.PositiveSmallIntegerField(blank=True, null=True)
+    # Position in the balance_after chain (the seller's, or the shard's), gapless from 1
+    seq = models.PositiveBigIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # Also the indexes for scanning a chain in seq order
+            UniqueConstraint(fields=['seller', 'seq'], condition=Q(shard__isnull=True), name='unique_txlog_seller_seq'),
+            UniqueConstraint(
+                fields=['seller', 'shard', 'seq'], condition=Q(shard__isnull=False), name='unique_txlog_shard_seq'
+            ),
+        ]
+        indexes = [
+            # History pages and exports seek on (created_at, unique_id) within a seller
+            models.Index(fields=['seller', 'created_at', 'unique_id'], name='txlog_seller_created_idx'),
+            models.Index(fields=['transaction_type', 'created_at'], name='txlog_type_created_idx'),
+        ]
+
     def __str__(self):
         return f"[{self.transaction_type}] {self.amount} for {self.seller.name}"
-    
\ No newline at end of file
+    
+class LedgerRollup(models.Model):
+    """
+    Daily per-seller totals of the transaction log, one row per transaction type.
+    Balances are the seller's total credit (all shards) before the first and
+    after the last entry of that type on that day.
+    Rows are written once a day is complete, see B2B_shop.rollups.
+    """
+    # Covered by the unique (seller, day, transaction_type) constraint
+    seller = models.ForeignKey(Seller, on_delete=models.CASCADE, related_name='ledger_rollups', db_index=False)
+    day = models.DateField()
+    transaction_type = models.CharField(max_length=20, choices=TransactionLog.TRANSACTION_TYPES)
+    amount = models.DecimalField(max_digits=16, decimal_places=2)
+    entry_count = models.PositiveIntegerField()
+    opening_balance = models.DecimalField(max_digits=16, decimal_places=2)
+    closing_balance = models.DecimalField(max_digits=16, decimal_places=2)
+    first_entry_at = models.DateTimeField()
+    last_entry_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['seller', 'day', 'transaction_type'], name='unique_ledger_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.seller_id} {self.day} [{self.transaction_type}] {self.amount}"
+
+class LedgerRollupState(models.Model):
+    """
+    Single row recording up to which instant the transaction log has been rolled up.
+    """
+    rolled_up_until = models.DateTimeField(blank=True, null=True)
+
+class ReconciliationCheckpoint(models.Model):
+    """
+    How far a seller's transaction log has been verified, see B2B_shop.reconciliation.
+    `sequences` and `balances` hold the last verified seq and balance_after of each chain:
+    'main' for the Seller row and the shard index for credit shards.
+    """
+    STATUS_CHOICES = [
+        ('ok', 'OK'),
+        ('mismatch', 'Mismatch'),
+    ]
+
+    seller = models.OneToOneField(Seller, on_delete=models.CASCADE, primary_key=True, related_name='reconciliation')
+    sequences = models.JSONField(default=dict)
+    balances = models.JSONField(default=dict)
+    entry_count = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='ok')
+    error = models.TextField(blank=True)
+    checked_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.seller_id} reconciled through {self.entry_count} entries ({self.status})"
@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .metrics import CHARGE_PHASE_SECONDS
+from .models import Charge
+
+logger = logging.getLogger(__name__)
+
+
+def publish_outbox_batches(batches):
+    """
+    Publishes one settle_outbox_charges_task per (seller_id, charge_ids) batch,
+    all of them over a single broker connection.
+    """
+    from .tasks import settle_outbox_charges_task
+
+    app = settle_outbox_charges_task.app
+    enqueued_at = time.time()
+    # Eager tasks run in this process and never reach the broker
+    producer = nullcontext() if app.conf.task_always_eager else app.producer_or_acquire()
+    with producer as producer:
+        for seller_id, charge_ids in batches:
+            settle_outbox_charges_task.apply_async(
+                kwargs={'seller_id': seller_id, 'charge_ids': charge_ids, 'enqueued_at': enqueued_at},
+                producer=producer,
+            )
+
+
+def relay_charge_outbox(limit=None, publisher=publish_outbox_batches):
+    """
+    Hands up to `limit` pending charges to the workers, oldest first, with one
+    publish per seller, and marks them dispatched in the same transaction.
+    If publishing fails the transaction rolls back and the charges stay in the
+    outbox; if the commit fails after publishing they are published again, which
+    the idempotent settle task absorbs. Charges dispatched more than
+    CHARGE_OUTBOX_REDELIVER_AFTER seconds ago that are still pending, because the
+    broker lost their message or a batch flush never ran, are published again.
+    Returns the number of charges relayed.
+    """
+    limit = limit or settings.CHARGE_OUTBOX_BATCH_SIZE
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.CHARGE_OUTBOX_REDELIVER_AFTER)
+    with transaction.atomic():
+        # Rows another relay is handing over are skipped rather than waited on
+        rows = list(
+            Charge.objects.select_for_update(skip_locked=True)
+            .filter(Q(dispatched_at__isnull=True) | Q(dispatched_at__lt=stale), status='pending', batch__isnull=True)
+            .order_by('created_at')
+            .values_list('unique_id', 'seller_id', 'created_at', 'dispatched_at')[:limit]
+        )
+        if not rows:
+            return 0
+
+        batches = defaultdict(list)
+        for charge_id, seller_id, _, _ in rows:
+            batches[seller_id].append(str(charge_id))
+        publisher(list(batches.items()))
+        Charge.objects.filter(pk__in=[charge_id for charge_id, *_ in rows]).update(dispatched_at=now)
+
+    for _, _, created_at, dispatched_at in rows:
+        if dispatched_at is None:
+            CHARGE_PHASE_SECONDS.observe((now - created_at).total_seconds(), phase='outbox')
+    return len(rows)
+
+
+def run_charge_relay(stopped=None, batch_size=None, interval_ms=None):
+    """
+    Relays the outbox until `stopped` (a threading.Event) is set. Full rounds
+    follow each other immediately, otherwise the relay polls every `interval_ms`.
+    Failed rounds, e.g. while the broker is down, are logged and retried.
+    """
+    stopped = stopped or threading.Event()
+    batch_size = batch_size or settings.CHARGE_OUTBOX_BATCH_SIZE
+    interval = (settings.CHARGE_OUTBOX_POLL_INTERVAL_MS if interval_ms is None else interval_ms) / 1000
+    while not stopped.is_set():
+        try:
+            relayed = relay_charge_outbox(batch_size)
+        except Exception:
+            logger.exception("Charge outbox relay round failed")
+            # Drop the connection if the database went away
+            close_old_connections()
+            relayed = 0
+        if relayed < batch_size:
+            stopped.wait(interval)
@@ -0,0 +1,277 @@
+import datetime
+import gzip
+import logging
+import os
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import UniqueConstraint
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Column the partitioned tables are split on, one range partition per month
+PARTITION_KEY = 'created_at'
+PARTITION_SUFFIX = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+def partitioned_models():
+    """
+    The models whose tables are range partitioned by month.
+    """
+    from .models import Charge, TransactionLog
+    return [TransactionLog, Charge]
+
+
+def month_start(day):
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def month_bounds(month):
+    """
+    The [start, end) instants of a month in the project time zone.
+    """
+    start = timezone.make_aware(datetime.datetime.combine(month, datetime.time.min))
+    end = timezone.make_aware(datetime.datetime.combine(add_months(month, 1), datetime.time.min))
+    return start, end
+
+
+def partition_name(model, month):
+    return f"{model._meta.db_table}_p{month:%Y%m}"
+
+
+def default_partition_name(model):
+    return f"{model._meta.db_table}_default"
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def is_partitioned(cursor, model):
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))",
+        [_quote(model._meta.db_table)]
+    )
+    return cursor.fetchone()[0]
+
+
+def monthly_partitions(cursor, model):
+    """
+    {month: partition name} of the partitions attached to the model's table.
+    """
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s)",
+        [_quote(model._meta.db_table)]
+    )
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        match = PARTITION_SUFFIX.search(name)
+        if match:
+            partitions[datetime.date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def _create_local_unique_indexes(cursor, model, partition, suffix):
+    """
+    Postgres only accepts unique indexes on a partitioned table when they include the
+    partition key, which would make per-seller seq and Idempotency-Key uniqueness
+    meaningless. The model's unique constraints are instead created on every partition,
+    so they only hold within a month. Across months, Idempotency-Keys are guarded by the
+    unpartitioned ChargeIdempotencyKey table; seq numbers are handed out under the
+    seller's (or shard's) row lock, and a repeat would be reported by reconciliation.
+    """
+    with connection.schema_editor(atomic=False) as schema_editor:
+        for constraint in model._meta.constraints:
+            if not isinstance(constraint, UniqueConstraint):
+                continue
+            statement = constraint.create_sql(model, schema_editor)
+            statement.rename_table_references(model._meta.db_table, partition)
+            statement.parts['name'] = _quote(f"{constraint.name}_{suffix}")
+            cursor.execute(str(statement))
+
+
+def create_partition(cursor, model, month):
+    """
+    Attaches the partition of one month. Rows that were already written to the default
+    partition for that month are moved into it.
+    """
+    table, partition, default = model._meta.db_table, partition_name(model, month), default_partition_name(model)
+    start, end = month_bounds(month)
+    cursor.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {_quote(default)} WHERE {PARTITION_KEY} >= %s AND {PARTITION_KEY} < %s)",
+        [start, end]
+    )
+    has_default_rows = cursor.fetchone()[0]
+
+    if has_default_rows:
+        cursor.execute(f"ALTER TABLE {_quote(table)} DETACH PARTITION {_quote(default)}")
+    cursor.execute(
+        f"CREATE TABLE {_quote(partition)} PARTITION OF {_quote(table)} FOR VALUES FROM (%s) TO (%s)",
+        [start, end]
+    )
+    _create_local_unique_indexes(cursor, model, partition, f"p{month:%Y%m}")
+    if has_default_rows:
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {_quote(default)} WHERE {PARTITION_KEY} >= %s AND {PARTITION_KEY} < %s "
+            f"RETURNING *) INSERT INTO {_quote(table)} SELECT * FROM moved",
+            [start, end]
+        )
+        cursor.execute(f"ALTER TABLE {_quote(table)} ATTACH PARTITION {_quote(default)} DEFAULT")
+    return partition
+
+
+def ensure_partitions(months_ahead=None, today=None):
+    """
+    Creates the missing partitions from the current month up to `months_ahead` months
+    ahead, so inserts never fall into the default partition.
+    Returns the names of the partitions created.
+    """
+    if connection.vendor != 'postgresql':
+        return []
+    if months_ahead is None:
+        months_ahead = settings.PARTITION_MONTHS_AHEAD
+    current = month_start(today or timezone.localdate())
+
+    created = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        for model in partitioned_models():
+            if not is_partitioned(cursor, model):
+                continue
+            existing = monthly_partitions(cursor, model)
+            for offset in range(months_ahead + 1):
+                month = add_months(current, offset)
+                if month not in existing:
+                    created.append(create_partition(cursor, model, month))
+    return created
+
+
+def convert_to_partitioned(cursor, model, months_ahead):
+    """
+    Rebuilds an ordinary table as a table partitioned by month on created_at, with
+    partitions for every month that has rows up to `months_ahead` months ahead and a
+    default partition for anything outside them.
+
+    The primary key becomes (unique_id, created_at), as Postgres requires the partition
+    key in it; unique_id stays the key Django looks rows up by. The rows are copied
+    while the table is locked against reads and writes, so this only runs from the
+    partition_tables command, in a maintenance window on large tables.
+    """
+    table = model._meta.db_table
+    if is_partitioned(cursor, model):
+        return
+    legacy = f"{table}_unpartitioned"
+    cursor.execute(f"LOCK TABLE {_quote(table)} IN ACCESS EXCLUSIVE MODE")
+
+    # Plain indexes and foreign keys are recreated from their definitions on the
+    # partitioned table; the primary key and unique indexes are rebuilt as described above
+    cursor.execute(
+        "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i "
+        "WHERE i.indrelid = to_regclass(%s) AND NOT i.indisunique",
+        [_quote(table)]
+    )
+    index_definitions = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+        [_quote(table)]
+    )
+    foreign_keys = cursor.fetchall()
+    cursor.execute(f"SELECT min({PARTITION_KEY}) FROM {_quote(table)}")
+    oldest = cursor.fetchone()[0]
+
+    cursor.execute(f"ALTER TABLE {_quote(table)} RENAME TO {_quote(legacy)}")
+    cursor.execute(
+        f"CREATE TABLE {_quote(table)} (LIKE {_quote(legacy)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        f"PARTITION BY RANGE ({PARTITION_KEY})"
+    )
+    cursor.execute(f"CREATE TABLE {_quote(default_partition_name(model))} PARTITION OF {_quote(table)} DEFAULT")
+
+    current = month_start(timezone.localdate())
+    month = min(month_start(timezone.localdate(oldest)), current) if oldest else current
+    while month <= add_months(current, months_ahead):
+        create_partition(cursor, model, month)
+        month = add_months(month, 1)
+
+    cursor.execute(f"INSERT INTO {_quote(table)} SELECT * FROM {_quote(legacy)}")
+    cursor.execute(f"DROP TABLE {_quote(legacy)}")
+
+    cursor.execute(
+        f"ALTER TABLE {_quote(table)} ADD CONSTRAINT {_quote(table + '_pkey')} "
+        f"PRIMARY KEY ({_quote(model._meta.pk.column)}, {PARTITION_KEY})"
+    )
+    for definition in index_definitions:
+        cursor.execute(definition)
+    for name, definition in foreign_keys:
+        cursor.execute(f"ALTER TABLE {_quote(table)} ADD CONSTRAINT {_quote(name)} {definition}")
+    _create_local_unique_indexes(cursor, model, default_partition_name(model), 'default')
+
+def expired_partitions(cursor, model, retention_months, today=None):
+    """
+    {month: partition name} of the partitions that ended more than `retention_months`
+    full months before the current one.
+    """
+    cutoff = add_months(month_start(today or timezone.localdate()), -retention_months)
+    return {
+        month: name for month, name in sorted(monthly_partitions(cursor, model).items())
+        if month < cutoff
+    }
+
+
+def archive_blockers(model, month):
+    """
+    Why the partition of `month` cannot be archived yet, or None. Log entries must be
+    rolled up (statements read the rollups) and verified by a reconciliation run
+    finished after the month ended (later runs start from the checkpoint).
+    """
+    from .models import LedgerRollupState, TransactionLog
+
+    if model._meta.db_table != TransactionLog._meta.db_table:
+        return None
+    start, end = month_bounds(month)
+    rolled_up_until = LedgerRollupState.objects.filter(pk=1).values_list('rolled_up_until', flat=True).first()
+    if not rolled_up_until or rolled_up_until < end:
+        return "not rolled up yet"
+    unverified = (
+        TransactionLog.objects.filter(created_at__gte=start, created_at__lt=end)
+        .exclude(seller__reconciliation__status='ok', seller__reconciliation__checked_at__gte=end)
+    )
+    if unverified.exists():
+        return "not reconciled yet"
+    return None
+
+
+def archive_partition(model, month, archive_dir=None, detach_only=False):
+    """
+    Detaches the partition of `month`. Unless `detach_only`, its rows are then written
+    to a gzipped CSV file in `archive_dir` and the table is dropped.
+    Returns the archive path, or the detached table's name.
+    """
+    archive_dir = archive_dir or settings.PARTITION_ARCHIVE_DIR
+    table, partition = model._meta.db_table, partition_name(model, month)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Deferred foreign key checks on the partition's rows would block dropping it
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(f"ALTER TABLE {_quote(table)} DETACH PARTITION {_quote(partition)}")
+        if detach_only:
+            return partition
+
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, f"{partition}.csv.gz")
+        temporary = f"{path}.tmp"
+        with gzip.open(temporary, 'wt', encoding='utf-8') as f:
+            cursor.copy_expert(f"COPY {_quote(partition)} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+        # Only drop the rows once the file is complete
+        os.replace(temporary, path)
+        cursor.execute(f"DROP TABLE {_quote(partition)}")
+
+    logger.info("Archived partition %s to %s", partition, path)
+    return path
@@ -0,0 +1,196 @@
+import heapq
+import logging
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Longest SQL text put in a response header
+HEADER_SQL_LENGTH = 200
+
+REQUEST_QUERIES = Histogram(
+    'b2b_request_queries', "Database queries issued per request, by endpoint", buckets=QUERY_COUNT_BUCKETS
+)
+REQUEST_DB_SECONDS = Histogram('b2b_request_db_seconds', "Database time per request, by endpoint")
+
+
+class QueryProfile:
+    """
+    The number of queries of a block, their total duration and the `keep` slowest statements.
+    """
+
+    def __init__(self, keep=3):
+        self.keep = keep
+        self.count = 0
+        self.duration = 0.0
+        self._slowest = []
+
+    def record(self, duration, sql):
+        self.count += 1
+        self.duration += duration
+        # (duration, count) keeps the heap ordered without comparing statements
+        entry = (duration, self.count, sql)
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, entry)
+        elif self.keep:
+            heapq.heappushpop(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        """
+        [(duration, sql)] of the slowest statements, slowest first.
+        """
+        return [(duration, sql) for duration, _, sql in sorted(self._slowest, reverse=True)]
+
+
+# The profiles of the current request or block. A context variable rather than a
+# connection's own wrappers, so the queries async views run in worker threads count too
+_active_profiles = ContextVar('active_query_profiles', default=())
+
+
+def _profile_execute(execute, sql, params, many, context):
+    profiles = _active_profiles.get()
+    if not profiles:
+        return execute(sql, params, many, context)
+    started = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = perf_counter() - started
+        for profile in profiles:
+            profile.record(elapsed, sql)
+
+
+def install(connection):
+    """
+    Adds the profiling execute wrapper to a connection, once. It goes first, as
+    connection.execute_wrapper() blocks remove the last wrapper when they end.
+    """
+    if _profile_execute not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _profile_execute)
+
+
+@receiver(connection_created)
+def _install_on_connect(sender, connection, **kwargs):
+    install(connection)
+
+
+@contextmanager
+def profile_queries(keep=3):
+    """
+    Profiles the queries issued inside the block, including those of threads it
+    hands work to through sync_to_async. Blocks can be nested.
+    """
+    for connection in connections.all():
+        install(connection)
+    profile = QueryProfile(keep)
+    token = _active_profiles.set(_active_profiles.get() + (profile,))
+    try:
+        yield profile
+    finally:
+        _active_profiles.reset(token)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@contextmanager
+def query_budget(limit, keep=10):
+    """
+    Fails when the block issues more than `limit` queries, listing the slowest of
+    them. Tests use it to pin an endpoint's query count, so an N+1 fails the build
+    instead of slowing production down.
+    """
+    with profile_queries(keep) as profile:
+        yield profile
+    if profile.count > limit:
+        statements = '\n'.join(f"  {duration * 1000:.2f}ms {sql}" for duration, sql in profile.slowest)
+        raise QueryBudgetExceeded(f"{profile.count} queries exceed the budget of {limit}:\n{statements}")
+
+
+def endpoint_name(request):
+    """
+    The URL pattern the request matched, with the action of admin changelist posts.
+    Patterns keep the metric labels few, unlike paths.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    endpoint = match.route
+    if match.namespace == 'admin' and request.method == 'POST' and request.POST.get('action'):
+        endpoint = f"{endpoint}#{request.POST['action']}"
+    return endpoint
+
+
+def _header_sql(sql):
+    sql = re.sub(r'\s+', ' ', sql).strip()[:HEADER_SQL_LENGTH]
+    return sql.encode('latin-1', 'replace').decode('latin-1')
+
+
+class QueryProfilingMiddleware:
+    """
+    Profiles the database queries of every request. Counts and DB time are kept per
+    endpoint in the b2b_request_queries / b2b_request_db_seconds metrics, statements
+    slower than QUERY_PROFILING_SLOW_MS are logged, and with DEBUG on each response
+    carries its numbers in X-DB-* and Server-Timing headers.
+    Queries run while a streaming response is consumed are not counted.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = settings.QUERY_PROFILING_ENABLED
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        with profile_queries(settings.QUERY_PROFILING_SLOWEST) as profile:
+            response = self.get_response(request)
+        self.record(request, response, profile)
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        with profile_queries(settings.QUERY_PROFILING_SLOWEST) as profile:
+            response = await self.get_response(request)
+        self.record(request, response, profile)
+        return response
+
+    def record(self, request, response, profile):
+        endpoint = endpoint_name(request)
+        REQUEST_QUERIES.observe(profile.count, endpoint=endpoint)
+        REQUEST_DB_SECONDS.observe(profile.duration, endpoint=endpoint)
+
+        slow = settings.QUERY_PROFILING_SLOW_MS / 1000
+        for duration, sql in profile.slowest:
+            if duration >= slow:
+                logger.warning("Slow query (%.1fms) on %s: %s", duration * 1000, endpoint, sql)
+
+        if settings.DEBUG:
+            response['X-DB-Query-Count'] = str(profile.count)
+            response['X-DB-Time-Ms'] = f"{profile.duration * 1000:.2f}"
+            response['X-DB-Slowest'] = ' | '.join(
+                f"{duration * 1000:.2f}ms {_header_sql(sql)}" for duration, sql in profile.slowest
+            )
+            response['Server-Timing'] = (
+                f'db;dur={profile.duration * 1000:.2f};desc="{profile.count} queries"'
+            )
@@ -0,0 +1,229 @@
+import math
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from rest_framework import exceptions
+from rest_framework.throttling import BaseThrottle
+
+from .metrics import Counter
+
+BUCKET_KEY = 'ratelimit:{scope}:{seller_id}'
+INFLIGHT_KEY = 'inflight_charges:{seller_id}'
+# Most refused buckets remembered by the in-process fast path
+LOCAL_BLOCKS_MAX_SIZE = 10000
+
+RATE_LIMITED_TOTAL = Counter('b2b_rate_limited_total', "Requests refused by admission control, by scope and limit")
+
+# Where each scope's limits come from: the Seller field overriding the setting, if any
+Scope = namedtuple('Scope', 'rate_field rate_setting burst_field burst_setting')
+
+SCOPES = {
+    'charge': Scope('charge_rate_limit', 'CHARGE_RATE_LIMIT', 'charge_rate_burst', 'CHARGE_RATE_BURST'),
+    'credit_request': Scope(
+        'credit_request_rate_limit', 'CREDIT_REQUEST_RATE_LIMIT', None, 'CREDIT_REQUEST_RATE_BURST'
+    ),
+}
+
+# Takes a token from bucket KEYS[1], which refills continuously at ARGV[1] tokens per
+# second up to ARGV[2]; Redis' clock keeps it consistent across the web processes.
+# Returns 0 if a token was taken, otherwise the milliseconds until there is one.
+TAKE_TOKEN = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - at, 0) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = math.ceil((1 - tokens) / rate * 1000)
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return wait
+"""
+
+# Admits charge ARGV[2] into the sorted set of a seller's charges in flight unless it
+# holds ARGV[1] of them already. Members are scored by when they stop counting
+# (ARGV[3] seconds later), so charges whose outcome is never published expire.
+ACQUIRE_INFLIGHT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class RedisLimits:
+    """
+    Limits kept in Redis, each check one atomic script call.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def take(self, key, rate, burst):
+        return self.client.register_script(TAKE_TOKEN)(keys=[key], args=[rate, burst]) / 1000
+
+    def acquire(self, key, member, cap, ttl):
+        return bool(self.client.register_script(ACQUIRE_INFLIGHT)(keys=[key], args=[cap, member, ttl]))
+
+    def release(self, key, members):
+        self.client.zrem(key, *members)
+
+
+class CacheLimits:
+    """
+    The same limits on a cache that is not Redis (tests, a single process),
+    atomic within this process only.
+    """
+    _lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with self._lock:
+            tokens, at = cache.get(key, (burst, now))
+            tokens = min(burst, tokens + max(now - at, 0) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            cache.set(key, (tokens, now), timeout=math.ceil(burst / rate) + 1)
+        return wait
+
+    def acquire(self, key, member, cap, ttl):
+        now = time.time()
+        with self._lock:
+            members = {m: expires for m, expires in cache.get(key, {}).items() if expires > now}
+            if len(members) >= cap:
+                return False
+            members[member] = now + ttl
+            cache.set(key, members, timeout=ttl)
+        return True
+
+    def release(self, key, members):
+        with self._lock:
+            current = cache.get(key)
+            if current:
+                remaining = {member: expires for member, expires in current.items() if member not in members}
+                cache.set(key, remaining, timeout=settings.INFLIGHT_CHARGE_TTL)
+
+
+def _limits():
+    backend = caches['default']
+    if isinstance(backend, RedisCache):
+        return RedisLimits(backend._cache.get_client(write=True))
+    return CacheLimits()
+
+
+# The in-process fast path: {bucket key: time.monotonic() it has a token again} of the
+# Redis buckets that refused a request, so a client flooding past its limit is turned
+# away without a Redis round trip until the bucket refills
+_local_blocks = {}
+_local_blocks_lock = threading.Lock()
+
+
+def _blocked_for(key):
+    return _local_blocks.get(key, 0) - time.monotonic()
+
+
+def _block_locally(key, wait):
+    with _local_blocks_lock:
+        if len(_local_blocks) >= LOCAL_BLOCKS_MAX_SIZE:
+            now = time.monotonic()
+            for expired in [k for k, until in _local_blocks.items() if until <= now]:
+                del _local_blocks[expired]
+            if len(_local_blocks) >= LOCAL_BLOCKS_MAX_SIZE:
+                return
+        _local_blocks[key] = time.monotonic() + wait
+
+
+def _seller_limit(seller, field, setting):
+    value = getattr(seller, field) if field else None
+    return getattr(settings, setting) if value is None else value
+
+
+def check_rate(seller, scope):
+    """
+    Takes a token from the seller's bucket of `scope`.
+    Returns None if the request is admitted, otherwise the seconds until it would be.
+    """
+    limits = SCOPES[scope]
+    rate = _seller_limit(seller, limits.rate_field, limits.rate_setting)
+    burst = _seller_limit(seller, limits.burst_field, limits.burst_setting)
+    if not (settings.RATE_LIMIT_ENABLED and rate and burst):
+        return None
+
+    key = BUCKET_KEY.format(scope=scope, seller_id=seller.pk)
+    backend = _limits()
+    if isinstance(backend, RedisLimits):
+        blocked = _blocked_for(key)
+        if blocked > 0:
+            RATE_LIMITED_TOTAL.inc(scope=scope, limit='rate')
+            return blocked
+
+    wait = backend.take(key, rate / 60, burst)
+    if not wait:
+        return None
+    RATE_LIMITED_TOTAL.inc(scope=scope, limit='rate')
+    if isinstance(backend, RedisLimits):
+        _block_locally(key, wait)
+    return wait
+
+
+def acquire_inflight(seller, charge_id):
+    """
+    Counts an accepted charge against the seller's MAX_INFLIGHT_CHARGES until
+    release_inflight() or INFLIGHT_CHARGE_TTL. Returns False if the seller is at the cap.
+    """
+    cap = _seller_limit(seller, 'max_inflight_charges', 'MAX_INFLIGHT_CHARGES')
+    if not settings.RATE_LIMIT_ENABLED or not cap:
+        return True
+    key = INFLIGHT_KEY.format(seller_id=seller.pk)
+    if _limits().acquire(key, str(charge_id), cap, settings.INFLIGHT_CHARGE_TTL):
+        return True
+    RATE_LIMITED_TOTAL.inc(scope='charge', limit='inflight')
+    return False
+
+
+def release_inflight(seller_id, charge_ids):
+    """
+    Stops counting settled charges as in flight.
+    """
+    charge_ids = [str(charge_id) for charge_id in charge_ids]
+    if charge_ids and settings.RATE_LIMIT_ENABLED:
+        _limits().release(INFLIGHT_KEY.format(seller_id=seller_id), charge_ids)
+
+
+def inflight_limit_exceeded():
+    return exceptions.Throttled(
+        wait=settings.INFLIGHT_RETRY_AFTER, detail="Too many charges are waiting to be processed."
+    )
+
+
+class SellerRateThrottle(BaseThrottle):
+    """
+    Applies the seller's token bucket of the view's `throttle_scope`.
+    DRF answers refused requests with a 429 and Retry-After.
+    """
+
+    def allow_request(self, request, view):
+        seller = getattr(request.user, 'seller', None)
+        if seller is None:
+            return True
+        self.retry_after = check_rate(seller, view.throttle_scope)
+        return self.retry_after is None
+
+    def wait(self):
+        return self.retry_after
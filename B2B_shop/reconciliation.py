@@ -0,0 +1,181 @@
+import logging
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .ledger import lock_seller, lock_shards, retry_on_conflict
+from .models import SellerCreditShard, TransactionLog, ReconciliationCheckpoint
+
+logger = logging.getLogger(__name__)
+
+ReconciliationResult = namedtuple('ReconciliationResult', 'seller_id verified error')
+
+MAIN_CHAIN = 'main'
+# Held while a seller is being reconciled, so overlapping runs skip it
+RUNNING_KEY = 'reconciliation_running:{seller_id}'
+RUNNING_TIMEOUT = 60 * 60
+
+ENTRY_FIELDS = ('unique_id', 'seq', 'amount', 'balance_after')
+
+
+def chain_key(shard):
+    return MAIN_CHAIN if shard is None else str(shard)
+
+
+class ChainVerifier:
+    """
+    Follows the balance_after chains of one seller: the Seller row's and one per credit shard.
+    Each entry must carry the next seq of its chain and continue its balance,
+    i.e. balance_after == previous balance_after + amount.
+    """
+
+    def __init__(self, sequences=None, balances=None):
+        self.sequences = dict(sequences or {})
+        self.balances = {chain: Decimal(balance) for chain, balance in (balances or {}).items()}
+        self.verified = 0
+
+    def feed(self, chain, entries):
+        """
+        Verifies ENTRY_FIELDS tuples of one chain in seq order.
+        Returns a description of the first broken link, or None.
+        """
+        seq = self.sequences.get(chain, 0)
+        balance = self.balances.get(chain)
+        for unique_id, entry_seq, amount, balance_after in entries:
+            if entry_seq != seq + 1:
+                return f"chain '{chain}' is missing seq {seq + 1}"
+            if balance is not None and balance + amount != balance_after:
+                return f"entry {unique_id} on chain '{chain}': {balance} + {amount} != {balance_after}"
+            seq, balance = entry_seq, balance_after
+            self.verified += 1
+
+        self.sequences[chain] = seq
+        if balance is not None:
+            self.balances[chain] = balance
+        return None
+
+    def serialized_balances(self):
+        return {chain: str(balance) for chain, balance in self.balances.items()}
+
+
+def _chain_entries(seller_id, chain, after_seq):
+    """
+    A chain's entries after `after_seq`: a range scan of one of the seq unique indexes.
+    """
+    entries = TransactionLog.objects.filter(seller_id=seller_id, seq__gt=after_seq)
+    if chain == MAIN_CHAIN:
+        entries = entries.filter(shard__isnull=True)
+    else:
+        entries = entries.filter(shard=int(chain))
+    return entries.order_by('seq').values_list(*ENTRY_FIELDS)
+
+
+def _compare_tails(verifier, seller, shards):
+    """
+    Compares the chain tails with the live balances and seq counters of the locked
+    seller and shards. Sharded sellers keep their credit on the shards, so the Seller
+    chain must end at zero.
+    """
+    if seller.shard_count:
+        expected = {chain_key(shard.index): (shard.credit, shard.ledger_seq) for shard in shards}
+        expected[MAIN_CHAIN] = (Decimal('0.00'), seller.ledger_seq)
+    else:
+        expected = {MAIN_CHAIN: (seller.credit, seller.ledger_seq)}
+
+    for chain, (live, live_seq) in expected.items():
+        seq = verifier.sequences.get(chain, 0)
+        if seq != live_seq:
+            return f"chain '{chain}' ends at seq {seq} but {live_seq} were issued"
+        tail = verifier.balances.get(chain)
+        if tail is None:
+            # A chain without entries cannot be verified, unless it should hold credit
+            if live and (chain != MAIN_CHAIN or seller.shard_count):
+                return f"chain '{chain}' has no entries but holds {live}"
+            continue
+        if tail != live:
+            return f"chain '{chain}' ends at {tail} but the live balance is {live}"
+    return None
+
+
+def reconcile_seller(seller_id):
+    """
+    Verifies the seller's log entries added since the last checkpoint.
+    A seq is taken under its chain's row lock, so committed entries never leave gaps
+    and everything visible is checked without locks, in chunks that advance the checkpoint.
+    Entries committed meanwhile are then checked with the seller and its shards locked,
+    and the chain tails compared with their live balances.
+    Returns a ReconciliationResult; the checkpoint keeps the first mismatch found.
+    """
+    running_key = RUNNING_KEY.format(seller_id=seller_id)
+    if not cache.add(running_key, 1, timeout=RUNNING_TIMEOUT):
+        return ReconciliationResult(seller_id, 0, None)
+
+    try:
+        checkpoint, _ = ReconciliationCheckpoint.objects.get_or_create(seller_id=seller_id)
+        shard_indexes = SellerCreditShard.objects.filter(seller_id=seller_id).values_list('index', flat=True)
+        chains = [MAIN_CHAIN] + [chain_key(index) for index in shard_indexes]
+        chunk_size = settings.RECONCILIATION_CHUNK_SIZE
+        verified = 0
+
+        for chain in chains:
+            while True:
+                verifier = ChainVerifier(checkpoint.sequences, checkpoint.balances)
+                entries = list(_chain_entries(seller_id, chain, verifier.sequences.get(chain, 0))[:chunk_size])
+                error = verifier.feed(chain, entries)
+                verified += verifier.verified
+                if error:
+                    return _record(checkpoint, verified, error)
+                if entries:
+                    checkpoint.sequences = verifier.sequences
+                    checkpoint.balances = verifier.serialized_balances()
+                    checkpoint.entry_count += verifier.verified
+                    checkpoint.save(update_fields=['sequences', 'balances', 'entry_count'])
+                if len(entries) < chunk_size:
+                    break
+
+        tail_verified, error = _verify_tails(seller_id, checkpoint)
+        return _record(checkpoint, verified + tail_verified, error)
+    finally:
+        cache.delete(running_key)
+
+
+@retry_on_conflict
+def _verify_tails(seller_id, checkpoint):
+    """
+    Checks the entries committed since the checkpoint and the chain tails with the
+    seller and its shards locked the way the ledger locks them.
+    Returns (entries verified, error).
+    """
+    seller = lock_seller(seller_id)
+    shards = lock_shards(seller_id)
+    # Nothing can write to the seller's chains now, so their tails are complete
+    tail = ChainVerifier(checkpoint.sequences, checkpoint.balances)
+    error = None
+    for chain in [MAIN_CHAIN] + [chain_key(shard.index) for shard in shards]:
+        error = tail.feed(chain, _chain_entries(seller_id, chain, tail.sequences.get(chain, 0)).iterator())
+        if error:
+            break
+    return tail.verified, error or _compare_tails(tail, seller, shards)
+
+
+def _record(checkpoint, verified, error):
+    checkpoint.status = 'mismatch' if error else 'ok'
+    checkpoint.error = error or ''
+    checkpoint.checked_at = timezone.now()
+    checkpoint.save(update_fields=['status', 'error', 'checked_at'])
+    if error:
+        logger.error("Ledger mismatch for seller [%s]: %s", checkpoint.seller_id, error)
+    return ReconciliationResult(checkpoint.seller_id, verified, error)
+
+
+def reset_checkpoints(seller_ids=None):
+    """
+    Forgets the checkpoints so the next run verifies the full log again.
+    """
+    checkpoints = ReconciliationCheckpoint.objects.all()
+    if seller_ids:
+        checkpoints = checkpoints.filter(seller_id__in=seller_ids)
+    return checkpoints.delete()[0]
@@ -0,0 +1,204 @@
+import datetime
+from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import Seller, TransactionLog, LedgerRollup, LedgerRollupState
+
+ROLLUP_FIELDS = (
+    'amount', 'entry_count', 'opening_balance', 'closing_balance', 'first_entry_at', 'last_entry_at',
+)
+ROLLUP_CHUNK_SIZE = 2000
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def rollup_cutoff(now=None):
+    """
+    Start of the first day that is not complete yet. Entries get
+    LEDGER_ROLLUP_SETTLE_SECONDS to commit after midnight before their day is rolled up.
+    """
+    now = now or timezone.now()
+    settle = datetime.timedelta(seconds=settings.LEDGER_ROLLUP_SETTLE_SECONDS)
+    return day_start(timezone.localdate(now - settle))
+
+
+def summarize_entries(entries, opening=None, chain_openings=None):
+    """
+    Folds one seller's (transaction_type, amount, balance_after, created_at, shard) log
+    entries, in (created_at, unique_id) order, into per (day, transaction_type) totals.
+    `opening` is the seller's balance before the first entry. Without one it is the sum
+    of its balance chains' balances before the entries (a sharded seller has one chain
+    per shard besides the main one): `chain_openings` {shard: balance}, else the first
+    entry of each chain's balance_after - amount. A chain with neither is empty.
+    """
+    summary = {}
+    chains = dict(chain_openings or {})
+    # Relative to the opening balance until that is known
+    balance = opening if opening is not None else Decimal('0.00')
+    for transaction_type, amount, balance_after, created_at, shard in entries:
+        if opening is None:
+            chains.setdefault(shard, balance_after - amount)
+        key = timezone.localdate(created_at), transaction_type
+        row = summary.get(key)
+        if row is None:
+            row = summary[key] = {
+                'amount': Decimal('0.00'),
+                'entry_count': 0,
+                'opening_balance': balance,
+                'first_entry_at': created_at,
+            }
+        balance += amount
+        row['amount'] += amount
+        row['entry_count'] += 1
+        row['closing_balance'] = balance
+        row['last_entry_at'] = created_at
+
+    if opening is None:
+        opening = sum(chains.values(), Decimal('0.00'))
+        for row in summary.values():
+            row['opening_balance'] += opening
+            row['closing_balance'] += opening
+    return summary
+
+
+def _latest_rollups(**filters):
+    return LedgerRollup.objects.filter(**filters).order_by('-day', '-last_entry_at')
+
+
+def chain_balances(seller_id, before):
+    """
+    {shard: balance} of the seller's balance chains, from their last entries before `before`.
+    """
+    last_entries = TransactionLog.objects.filter(seller_id=seller_id, created_at__lt=before).annotate(
+        position=Window(RowNumber(), partition_by=[F('shard')], order_by=F('seq').desc())
+    ).filter(position=1)
+    return dict(last_entries.values_list('shard', 'balance_after'))
+
+
+def last_closing_balances(seller_ids):
+    """
+    The closing balance of the latest rolled up day of each seller, in one query.
+    """
+    latest = _latest_rollups(seller=OuterRef('pk')).values('closing_balance')[:1]
+    return dict(
+        Seller.objects.filter(pk__in=seller_ids)
+        .annotate(closing_balance=Subquery(latest))
+        .values_list('pk', 'closing_balance')
+    )
+
+
+def refresh_ledger_rollups(now=None):
+    """
+    Rolls up the log entries of the days completed since the last run.
+    Only entries past the stored watermark are read. Returns the number of rollup rows written.
+    """
+    cutoff = rollup_cutoff(now)
+    with transaction.atomic():
+        state, _ = LedgerRollupState.objects.select_for_update().get_or_create(pk=1)
+        if state.rolled_up_until and state.rolled_up_until >= cutoff:
+            return 0
+
+        entries = TransactionLog.objects.filter(created_at__lt=cutoff)
+        if state.rolled_up_until:
+            entries = entries.filter(created_at__gte=state.rolled_up_until)
+        openings = last_closing_balances(entries.values('seller_id'))
+
+        rollups = []
+        rows = entries.order_by('seller_id', 'created_at', 'unique_id').values_list(
+            'seller_id', 'transaction_type', 'amount', 'balance_after', 'created_at', 'shard'
+        )
+        for seller_id, seller_rows in groupby(rows.iterator(chunk_size=ROLLUP_CHUNK_SIZE), key=itemgetter(0)):
+            summary = summarize_entries((row[1:] for row in seller_rows), openings.get(seller_id))
+            rollups.extend(
+                LedgerRollup(seller_id=seller_id, day=day, transaction_type=transaction_type, **values)
+                for (day, transaction_type), values in summary.items()
+            )
+
+        # Re-running a day (e.g. after the watermark was reset) overwrites its rows
+        LedgerRollup.objects.bulk_create(
+            rollups,
+            batch_size=ROLLUP_CHUNK_SIZE,
+            update_conflicts=True,
+            unique_fields=['seller', 'day', 'transaction_type'],
+            update_fields=ROLLUP_FIELDS,
+        )
+        state.rolled_up_until = cutoff
+        state.save(update_fields=['rolled_up_until'])
+    return len(rollups)
+
+
+def seller_statement(seller_id, start, end):
+    """
+    A seller's per-day, per-type totals between two dates (inclusive).
+    Rolled up days are read from the rollups, only the rest (normally today)
+    from the transaction log, so the cost does not grow with the length of the range.
+    """
+    rolled_up_until = LedgerRollupState.objects.filter(pk=1).values_list('rolled_up_until', flat=True).first()
+    # First day that has no rollups yet
+    raw_start = timezone.localdate(rolled_up_until) if rolled_up_until else start
+
+    rows = {}
+    if start < raw_start:
+        rollups = LedgerRollup.objects.filter(
+            seller_id=seller_id, day__gte=start, day__lte=min(end, raw_start - datetime.timedelta(days=1))
+        ).values_list('day', 'transaction_type', *ROLLUP_FIELDS)
+        for day, transaction_type, *values in rollups:
+            rows[day, transaction_type] = dict(zip(ROLLUP_FIELDS, values))
+
+    if end >= raw_start:
+        raw_start = max(start, raw_start)
+        opening, chains = None, None
+        if rolled_up_until:
+            opening = _latest_rollups(seller_id=seller_id, day__lt=raw_start) \
+                .values_list('closing_balance', flat=True).first()
+        else:
+            # Nothing is rolled up: the range may start in the middle of the chains
+            chains = chain_balances(seller_id, day_start(raw_start))
+        entries = TransactionLog.objects.filter(
+            seller_id=seller_id,
+            created_at__gte=day_start(raw_start),
+            created_at__lt=day_start(end + datetime.timedelta(days=1)),
+        ).order_by('created_at', 'unique_id').values_list(
+            'transaction_type', 'amount', 'balance_after', 'created_at', 'shard'
+        )
+        rows.update(summarize_entries(entries.iterator(chunk_size=ROLLUP_CHUNK_SIZE), opening, chains))
+
+    days = [
+        {
+            "day": day.isoformat(),
+            "transaction_type": transaction_type,
+            "amount": str(row['amount']),
+            "count": row['entry_count'],
+            "opening_balance": str(row['opening_balance']),
+            "closing_balance": str(row['closing_balance']),
+        }
+        for (day, transaction_type), row in sorted(rows.items())
+    ]
+    totals = {}
+    for (_, transaction_type), row in rows.items():
+        total = totals.setdefault(transaction_type, {"amount": Decimal('0.00'), "count": 0})
+        total["amount"] += row['amount']
+        total["count"] += row['entry_count']
+
+    first = min(rows.values(), key=itemgetter('first_entry_at'), default=None)
+    last = max(rows.values(), key=itemgetter('last_entry_at'), default=None)
+    return {
+        "start_date": start.isoformat(),
+        "end_date": end.isoformat(),
+        "opening_balance": str(first['opening_balance']) if first else None,
+        "closing_balance": str(last['closing_balance']) if last else None,
+        "totals": {
+            transaction_type: {"amount": str(total["amount"]), "count": total["count"]}
+            for transaction_type, total in totals.items()
+        },
+        "days": days,
+    }
@@ -1,14 +1,15 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
 from decimal import Decimal
 from .models import Seller, CreditRequest, TransactionLog
 from decimal import Decimal
-from .models import Seller, CreditRequest, TransactionLog
+from .models import Seller, CreditRequest, TransactionLog, ChargeBatch
 
 class ChargeSerializer(serializers.Serializer):
     """
     Serializer for the phone charging endpoint.
-    Validates amount, phone number for idempotency.
+    Validates amount and phone number; retries are deduplicated by the Idempotency-Key header.
     """
     phone_number = serializers.CharField(max_length=11)
     amount = serializers.DecimalField(
@@ -17,6 +18,57 @@ class ChargeSerializer(serializers.Serializer):
         min_value=Decimal("0.01")
     )
 
+class ChargeBatchSerializer(serializers.Serializer):
+    """
+    Serializer for the batch charging endpoint.
+    Validates every line in one pass; errors are reported per line, in order.
+    """
+    mode = serializers.ChoiceField(choices=ChargeBatch.MODE_CHOICES, default='partial')
+    charges = ChargeSerializer(many=True, allow_empty=False)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # Checked before any line is validated
+        fields['charges'].max_length = settings.CHARGE_BATCH_MAX_LINES
+        return fields
+
+class TransferSerializer(serializers.Serializer):
+    """
+    One transfer of credit to a sub-reseller.
+    """
+    to_seller = serializers.IntegerField()
+    amount = serializers.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        min_value=Decimal("0.01")
+    )
+
+class TransferBatchSerializer(serializers.Serializer):
+    """
+    Serializer for the transfer endpoint: a fan-out of transfers from the
+    sender in the context to its sub-resellers, checked with one query.
+    """
+    transfers = TransferSerializer(many=True, allow_empty=False)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        fields['transfers'].max_length = settings.TRANSFER_MAX_RECIPIENTS
+        return fields
+
+    def validate_transfers(self, transfers):
+        sender = self.context['sender']
+        recipients = {transfer['to_seller'] for transfer in transfers}
+        children = set(
+            Seller.objects.filter(pk__in=recipients, parent_id=sender.pk)
+            .exclude(pk=sender.pk).values_list('pk', flat=True)
+        )
+        unknown = sorted(recipients - children)
+        if unknown:
+            raise serializers.ValidationError(
+                f"Not sub-resellers of this seller: {', '.join(map(str, unknown))}"
+            )
+        return transfers
+
 class CreateSellerSerializer(serializers.Serializer):
     """
     Serializer for creating new sellers with their user accounts.
@@ -48,6 +100,7 @@ class SellerSerializer(serializers.ModelSerializer):
     Serializer for general seller operations.
     """
     user = UserSerializer(read_only=True)
+    credit = serializers.DecimalField(source='live_credit', max_digits=10, decimal_places=2, read_only=True)
 
     class Meta:
         model = Seller
@@ -73,5 +126,5 @@ class TransactionLogSerializer(serializers.ModelSerializer):
     class Meta:
         model = TransactionLog
         fields = ('unique_id', 'seller', 'seller_name', 'transaction_type', 
-                 'amount', 'balance_after', 'created_at')
-        read_only_fields = ('unique_id', 'balance_after', 'created_at')
\ No newline at end of file
+                 'amount', 'balance_after', 'shard', 'seq', 'created_at')
+        read_only_fields = ('unique_id', 'balance_after', 'seq', 'created_at')
\ No newline at end of file
@@ -0,0 +1,55 @@
+from django.db import transaction
+from .authentication import invalidate_user_tokens
+from .ledger import Posting, apply_postings, rebalance_shards, retry_on_conflict, split_into_shards
+# The shard primitives are in the ledger, with every other change of credit
+from .ledger import credit_credit_shard, debit_credit_shard  # noqa: F401
+from .idempotency import create_charge
+from .metrics import CHARGES_TOTAL
+
+
+def enable_credit_sharding(seller_id, shard_count):
+    """
+    Moves a seller's credit into `shard_count` shards (see ledger.split_into_shards),
+    in a transaction of its own retried on conflicts.
+    """
+    if shard_count < 1:
+        raise ValueError("shard_count must be at least 1")
+
+    seller = retry_on_conflict(split_into_shards)(seller_id, shard_count)
+    # cached token identities carry the shard count
+    transaction.on_commit(lambda: invalidate_user_tokens(seller.user_id))
+
+
+def charge_sharded_seller(seller_id, amount, phone_number, idempotency_key=None, charge_id=None):
+    """
+    Processes a charge for a sharded seller without locking the Seller row, in a
+    transaction of its own retried on conflicts.
+    `charge_id` is the id assigned when the charge was accepted, if any.
+    Returns the Charge and the debited shard's balance after it (None if the charge failed).
+    """
+    charge, balance_after = _charge_sharded_seller(seller_id, amount, phone_number, idempotency_key, charge_id)
+    CHARGES_TOTAL.inc(outcome='insufficient_credit' if balance_after is None else 'completed')
+    return charge, balance_after
+
+
+@retry_on_conflict
+def _charge_sharded_seller(seller_id, amount, phone_number, idempotency_key, charge_id):
+    posted = apply_postings([Posting(seller_id, -amount, 'charge_sale', phone_number)], sharded=True)
+    balance_after = posted.logs[0].balance_after if posted.applied else None
+    charge = create_charge(
+        unique_id=charge_id,
+        seller_id=seller_id,
+        phone_number=phone_number,
+        amount=amount,
+        status='failed' if balance_after is None else 'completed',
+        idempotency_key=idempotency_key
+    )
+    return charge, balance_after
+
+
+def rebalance_credit_shards(seller_id):
+    """
+    Evens out a sharded seller's shards (see ledger.rebalance_shards), in a
+    transaction of its own retried on conflicts.
+    """
+    retry_on_conflict(rebalance_shards)(seller_id)
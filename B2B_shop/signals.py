@@ -0,0 +1,44 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import invalidate_token, invalidate_user_tokens
+from .auto_approval import invalidate_approval_rules
+from .balances import publish_balance
+from .models import CreditApprovalRule, Seller
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    # deleting clears instance.pk, which is the key
+    key = instance.key
+    transaction.on_commit(lambda: invalidate_token(key))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_user_tokens(user_id))
+
+
+@receiver(post_save, sender=Seller)
+@receiver(post_delete, sender=Seller)
+def seller_changed(sender, instance, update_fields=None, **kwargs):
+    # Balance-only saves do not change the cached identity
+    if update_fields and set(update_fields) <= {'credit', 'ledger_seq'}:
+        return
+    # Full saves (e.g. admin edits) may change the credit, balance-only saves publish themselves
+    if update_fields is None and kwargs.get('signal') is post_save:
+        publish_balance(instance.pk)
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_user_tokens(user_id))
+
+
+@receiver(post_save, sender=CreditApprovalRule)
+@receiver(post_delete, sender=CreditApprovalRule)
+def approval_rule_changed(sender, instance, **kwargs):
+    transaction.on_commit(invalidate_approval_rules)
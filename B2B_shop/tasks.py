@@ -1,68 +1,242 @@
 from celery import shared_task
-from django.db import transaction
-from .models import Seller, TransactionLog, Charge
+from django.conf import settings
+from django.db import IntegrityError
+from .models import Seller, ChargeBatch
+from .charging import clear_charge_flush, process_pending_charges, process_charge_batch, settle_outbox_charges
+from .sharding import charge_sharded_seller, rebalance_credit_shards
+from .rollups import refresh_ledger_rollups
+from .reconciliation import reconcile_seller
+from .partitioning import ensure_partitions
+from .charge_status import failed_result, publish_charge_result, publish_charge_results
+from .idempotency import charge_result, create_charge
+from .ledger import Posting, apply_postings, retry_on_conflict
+from .uuids import uuid7
+from .metrics import CHARGE_PHASE_SECONDS, CHARGES_TOTAL
 from decimal import Decimal
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
-@shared_task
-def process_charge_task(seller_id, amount_str, phone_number):
+def _observe_queue_wait(enqueued_at):
+    if enqueued_at is not None:
+        # Wall clock of the API process against this worker's, so it includes clock skew
+        CHARGE_PHASE_SECONDS.observe(max(time.time() - enqueued_at, 0.0), phase='queue_wait')
+
+
+@shared_task(seller_routed=True)
+def process_charge_task(seller_id, amount_str, phone_number, idempotency_key=None, charge_id=None,
+                        enqueued_at=None):
     """
     Celery task to process a charge asynchronously.
     This handles the database logic, ensuring the API can return quickly.
+    Returns the charge's outcome as charge_result data, which is also published
+    to the clients waiting on /api/charge/<charge_id>/.
+    The phases and the outcome are recorded in B2B_shop.metrics.
     """
-    print("\n\n\n")
-    print('in the task\n')
+    _observe_queue_wait(enqueued_at)
     amount = Decimal(amount_str)
-    print('amount:', amount)
+    charge_id = charge_id or str(uuid7())
     try:
-        with transaction.atomic():
-            seller = Seller.objects.select_for_update().get(pk=seller_id)
-            print('seller: ', seller.name)
-            print('seller.credit: ', seller.credit)
-
-            if seller.credit < amount:
-                print('seller.credit < amount is TRUE')
-                Charge.objects.create(
-                    seller=seller,
-                    phone_number=phone_number,
-                    amount=amount,
-                    status="failed"
-                    )
-                logger.warning("Charge failed for seller [%s]: insufficient credit (%s)", seller_id, amount)
-                return ("Charge failed for seller [%s]: insufficient credit (%s)", seller_id, amount)
-
-            charge = Charge.objects.create(
-                seller=seller,
-                phone_number=phone_number,
-                amount=amount,
-                status="completed" # i assume that charging is working well
-            )
-
-            new_balance = seller.credit - amount
-            print("new_balance: ", new_balance)
-
-            # get or Create log and update seller credit
-            TransactionLog.objects.create(
-                seller=seller,
-                transaction_type='charge_sale',
-                amount=-amount,
-                balance_after=new_balance, 
-                phone_number=phone_number
-            )
-
-
-            seller.credit = new_balance
-            seller.save()
-            print('seller saved\n')
-            print('seller.credit: ', seller.credit)
-            print("\n\n\n")
-
-            return (f"Charge successful for {phone_number}. amount: {amount}")
-            
+        charge, balance_after, commit_started = _settle_charge(
+            seller_id, amount, phone_number, idempotency_key, charge_id
+        )
+        CHARGE_PHASE_SECONDS.observe(time.perf_counter() - commit_started, phase='commit')
+
     except Seller.DoesNotExist:
-        return (f"Charge failed for {seller_id}: Seller not found.")
+        return _charge_failed(seller_id, charge_id, amount, 'seller_not_found', "Seller not found")
+    except IntegrityError:
+        # A charge with this idempotency key already exists, nothing was debited
+        return _charge_failed(
+            seller_id, charge_id, amount, 'duplicate', f"Duplicate idempotency key {idempotency_key}"
+        )
     except Exception as e:
         # The transaction will roll back automatically on error.
-        return (f"An unexpected error occurred during charge for seller {seller_id}: {e}")
\ No newline at end of file
+        logger.exception("Charge failed for seller [%s]", seller_id)
+        return _charge_failed(seller_id, charge_id, amount, 'error', f"An unexpected error occurred: {e}")
+
+    if balance_after is None:
+        logger.warning("Charge failed for seller [%s]: insufficient credit (%s)", seller_id, amount)
+    CHARGES_TOTAL.inc(outcome='insufficient_credit' if balance_after is None else 'completed')
+    return charge_result(charge, balance_after)[0]
+
+
+@retry_on_conflict
+def _settle_charge(seller_id, amount, phone_number, idempotency_key, charge_id):
+    """
+    Debits the charge through the ledger and stores it, in a transaction that is run
+    again on lock conflicts. Returns the Charge, the balance after it (None if it
+    failed) and when the commit started.
+    """
+    with CHARGE_PHASE_SECONDS.time(phase='lock'):
+        posted = apply_postings([Posting(seller_id, -amount, 'charge_sale', phone_number)])
+    balance_after = posted.logs[0].balance_after if posted.applied else None
+
+    with CHARGE_PHASE_SECONDS.time(phase='insert'):
+        charge = create_charge(
+            unique_id=charge_id,
+            seller_id=seller_id,
+            phone_number=phone_number,
+            amount=amount,
+            status="failed" if balance_after is None else "completed",
+            idempotency_key=idempotency_key
+        )
+    publish_charge_result(charge, balance_after)
+    return charge, balance_after, time.perf_counter()
+
+
+def _charge_failed(seller_id, charge_id, amount, outcome, error):
+    """
+    Publishes and returns the outcome of a charge that was not written.
+    """
+    CHARGES_TOTAL.inc(outcome=outcome)
+    result = failed_result(charge_id, amount, error)
+    publish_charge_results(seller_id, [result])
+    return result
+
+
+# Re-running a flush is harmless, so it is only acknowledged once done
+@shared_task(seller_routed=True, acks_late=True)
+def flush_pending_charges_task(seller_id):
+    """
+    Celery task that drains a seller's buffered charges.
+    Each round locks the seller once and settles up to CHARGE_BATCH_MAX_SIZE charges.
+    """
+    clear_charge_flush(seller_id)
+    batch_size = settings.CHARGE_BATCH_MAX_SIZE
+    settled = 0
+    try:
+        while True:
+            processed = process_pending_charges(seller_id, batch_size)
+            settled += processed
+            if processed < batch_size:
+                break
+    except Seller.DoesNotExist:
+        return (f"Flush failed for {seller_id}: Seller not found.")
+    except Exception as e:
+        logger.exception("Flush failed for seller [%s]", seller_id)
+        return (f"An unexpected error occurred during flush for seller {seller_id}: {e}")
+
+    return (f"Flushed {settled} charges for seller {seller_id}.")
+
+
+# Relayed charges are published at least once; later deliveries find them settled
+@shared_task(seller_routed=True, acks_late=True)
+def settle_outbox_charges_task(seller_id, charge_ids, enqueued_at=None):
+    """
+    Celery task that settles charges handed over by the outbox relay,
+    in arrival order under one seller lock.
+    """
+    _observe_queue_wait(enqueued_at)
+    try:
+        settled = settle_outbox_charges(seller_id, charge_ids)
+    except Seller.DoesNotExist:
+        return (f"Outbox charges skipped for {seller_id}: Seller not found.")
+    except Exception as e:
+        # The charges stay pending and are relayed again after CHARGE_OUTBOX_REDELIVER_AFTER
+        logger.exception("Outbox charges failed for seller [%s]", seller_id)
+        return (f"An unexpected error occurred settling outbox charges for seller {seller_id}: {e}")
+
+    return (f"Settled {settled} of {len(charge_ids)} outbox charges for seller {seller_id}.")
+
+
+@shared_task
+def process_charge_batch_task(batch_id):
+    """
+    Celery task that settles the lines of a submitted charge batch.
+    """
+    try:
+        batch = process_charge_batch(batch_id)
+    except ChargeBatch.DoesNotExist:
+        return (f"Charge batch {batch_id} not found.")
+    except Exception as e:
+        logger.exception("Charge batch [%s] failed", batch_id)
+        return (f"An unexpected error occurred during charge batch {batch_id}: {e}")
+
+    return (f"Charge batch {batch_id}: {batch.completed_count} completed, {batch.failed_count} failed.")
+
+
+@shared_task
+def process_sharded_charge_task(seller_id, amount_str, phone_number, idempotency_key=None, charge_id=None,
+                                enqueued_at=None):
+    """
+    Celery task to process a charge for a seller with sharded credit.
+    Only one credit shard is locked, so charges of the same seller run in parallel.
+    Returns the charge's outcome like process_charge_task.
+    """
+    _observe_queue_wait(enqueued_at)
+    amount = Decimal(amount_str)
+    charge_id = charge_id or str(uuid7())
+    try:
+        charge, shard_balance = charge_sharded_seller(seller_id, amount, phone_number, idempotency_key, charge_id)
+    except IntegrityError:
+        return _charge_failed(
+            seller_id, charge_id, amount, 'duplicate', f"Duplicate idempotency key {idempotency_key}"
+        )
+    except Exception as e:
+        logger.exception("Charge failed for seller [%s]", seller_id)
+        return _charge_failed(seller_id, charge_id, amount, 'error', f"An unexpected error occurred: {e}")
+
+    if shard_balance is None:
+        logger.warning("Charge failed for seller [%s]: no shard with enough credit (%s)", seller_id, amount)
+    publish_charge_result(charge, shard_balance_after=shard_balance)
+    return charge_result(charge, shard_balance_after=shard_balance)[0]
+
+
+@shared_task
+def rebalance_credit_shards_task(seller_id):
+    """
+    Celery task that evens out one seller's credit shards.
+    """
+    rebalance_credit_shards(seller_id)
+
+
+@shared_task
+def rebalance_all_credit_shards_task():
+    """
+    Periodic task that queues a rebalance for every sharded seller.
+    """
+    for seller_id in Seller.objects.filter(shard_count__gt=0).values_list('id', flat=True):
+        rebalance_credit_shards_task.delay(seller_id)
+
+
+@shared_task
+def refresh_ledger_rollups_task():
+    """
+    Periodic task that rolls up the transaction log of newly completed days.
+    """
+    written = refresh_ledger_rollups()
+    return (f"Wrote {written} ledger rollups.")
+
+
+@shared_task
+def reconcile_seller_task(seller_id):
+    """
+    Celery task that verifies one seller's new log entries.
+    """
+    try:
+        result = reconcile_seller(seller_id)
+    except Seller.DoesNotExist:
+        return (f"Reconciliation skipped for {seller_id}: Seller not found.")
+
+    if result.error:
+        return (f"Ledger mismatch for seller {seller_id}: {result.error}")
+    return (f"Reconciled {result.verified} entries for seller {seller_id}.")
+
+
+@shared_task
+def reconcile_all_sellers_task():
+    """
+    Periodic task that queues a reconciliation for every seller, spread across the workers.
+    """
+    for seller_id in Seller.objects.values_list('id', flat=True):
+        reconcile_seller_task.delay(seller_id)
+
+
+@shared_task
+def ensure_partitions_task():
+    """
+    Periodic task that creates the coming months' transaction log and charge partitions.
+    """
+    created = ensure_partitions()
+    return (f"Created {len(created)} partitions.")
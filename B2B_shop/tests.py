@@ -1,13 +1,67 @@
 import asyncio
+import datetime
+import gzip
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
 import uuid
 from decimal import Decimal
 
-from asgiref.sync import sync_to_async
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib import admin
 from django.contrib.auth.models import User
-from django.test import TestCase
-from django.db import transaction
+from django.core.cache import cache
+from unittest import skipUnless
+
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from b2b_project.celery import HashRing, app as celery_app
+from django.db import connection, transaction, IntegrityError, OperationalError
 from django.db.models import F, Sum
-from .models import Seller, TransactionLog
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from .models import (
+    Seller, SellerCreditShard, TransactionLog, Charge, ChargeBatch, CreditRequest, CreditApprovalRule, CreditTransfer,
+    LedgerRollup, LedgerRollupState, ReconciliationCheckpoint
+)
+from .charging import (
+    process_pending_charges, charge_now, create_charge_batch, process_charge_batch, enqueue_outbox_charge
+)
+from .tasks import (
+    process_charge_task, flush_pending_charges_task, process_sharded_charge_task, settle_outbox_charges_task
+)
+from .approvals import approve_credit_requests, MAX_CREDIT
+from .auto_approval import (
+    AUTO_APPROVALS_TOTAL, DAILY_TOTAL_KEY, VERSION_KEY, approval_rules, submit_credit_request
+)
+from .ledger import (
+    LEDGER_RETRIES_TOTAL, LOCK_NOWAIT, LOCK_SKIP_LOCKED, Posting, apply_postings, post, retry_on_conflict
+)
+from .authentication import local_tokens
+from .history import astream_export, seller_transactions, keyset_page
+from .rollups import day_start, refresh_ledger_rollups, seller_statement
+from .reconciliation import reconcile_seller
+from . import idempotency, metrics
+from .balances import cached_balance, store_balance
+from .profiling import REQUEST_QUERIES, QueryBudgetExceeded, query_budget
+from .serializers import TransactionLogSerializer
+from .charge_status import lookup_charge, publish_charge_results, remember_pending
+from .outbox import relay_charge_outbox
+from .ratelimit import RATE_LIMITED_TOTAL
+from .partitioning import archive_blockers, ensure_partitions, is_partitioned, month_start, partition_name
+from .sharding import (
+    enable_credit_sharding, debit_credit_shard, charge_sharded_seller, rebalance_credit_shards
+)
+from .transfers import transfer_credit
 
 
 class AccountingIntegrityTest(TestCase):
@@ -75,22 +129,26 @@ class AccountingIntegrityTest(TestCase):
             for _ in range(10):
                 credit_amount1 = Decimal('10000.00')
                 seller1.credit += credit_amount1
+                seller1.ledger_seq += 1
                 initial_credit1 += credit_amount1
                 TransactionLog.objects.create(
                     seller=seller1,
                     transaction_type='add_credit',
                     amount=credit_amount1,
-                    balance_after=seller1.credit
+                    balance_after=seller1.credit,
+                    seq=seller1.ledger_seq
                 )
 
                 credit_amount2 = Decimal('15000.00')
                 seller2.credit += credit_amount2
+                seller2.ledger_seq += 1
                 initial_credit2 += credit_amount2
                 TransactionLog.objects.create(
                     seller=seller2,
                     transaction_type='add_credit',
                     amount=credit_amount2,
-                    balance_after=seller2.credit
+                    balance_after=seller2.credit,
+                    seq=seller2.ledger_seq
                 )
 
             seller1.save()
@@ -105,14 +163,1985 @@ class AccountingIntegrityTest(TestCase):
                 seller = Seller.objects.select_for_update().get(pk=seller_id)
                 if seller.credit >= amount:
                     new_balance = seller.credit - amount
+                    seller.ledger_seq += 1
                     TransactionLog.objects.create(
                         unique_id=uuid.uuid4(),
                         seller=seller,
                         transaction_type='charge_sale',
                         amount=-amount,
-                        balance_after=new_balance
+                        balance_after=new_balance,
+                        seq=seller.ledger_seq
                     )
                     seller.credit = new_balance
                     seller.save()
         except Exception as e:
             print(f"Simulated charge failed: {e}")
+
+
+class BatchedChargeProcessingTest(TestCase):
+    """
+    Verifies that a flush settles buffered charges in order with a correct balance chain.
+    """
+
+    def setUp(self):
+        user = User.objects.create(username="batch_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Batch Seller", credit=Decimal('100.00'))
+
+    def test_flush_accepts_charges_until_credit_runs_out(self):
+        for amount in ('40.00', '40.00', '40.00', '20.00'):
+            Charge.objects.create(
+                seller=self.seller,
+                phone_number='09120000000',
+                amount=Decimal(amount),
+                status='pending'
+            )
+
+        settled = process_pending_charges(self.seller.id, limit=10)
+
+        self.assertEqual(settled, 4)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('0.00'))
+
+        statuses = list(Charge.objects.order_by('created_at').values_list('status', flat=True))
+        self.assertEqual(statuses, ['completed', 'completed', 'failed', 'completed'])
+
+        balances = list(TransactionLog.objects.order_by('created_at').values_list('balance_after', flat=True))
+        self.assertEqual(balances, [Decimal('60.00'), Decimal('20.00'), Decimal('0.00')])
+
+    def test_flush_respects_limit(self):
+        for _ in range(3):
+            Charge.objects.create(seller=self.seller, phone_number='09120000000', amount=Decimal('10.00'), status='pending')
+
+        self.assertEqual(process_pending_charges(self.seller.id, limit=2), 2)
+        self.assertEqual(Charge.objects.filter(status='pending').count(), 1)
+        self.assertEqual(process_pending_charges(self.seller.id, limit=2), 1)
+        self.assertEqual(process_pending_charges(self.seller.id, limit=2), 0)
+
+
+class ShardedCreditTest(TestCase):
+    """
+    Verifies that sharded credit keeps the seller's total and log sum consistent.
+    """
+
+    def setUp(self):
+        user = User.objects.create(username="shard_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Shard Seller", credit=Decimal('100.01'))
+
+    def test_sharding_preserves_total_and_log_sum(self):
+        enable_credit_sharding(self.seller.id, 4)
+        self.seller.refresh_from_db()
+
+        shards = list(SellerCreditShard.objects.filter(seller=self.seller).values_list('credit', flat=True))
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(sum(shards), Decimal('100.01'))
+        self.assertEqual(self.seller.live_credit, Decimal('100.01'))
+
+        charge, shard = charge_sharded_seller(self.seller.id, Decimal('20.00'), '09120000000')
+        self.assertEqual(charge.status, 'completed')
+        # no single shard holds 30.00 any more
+        charge, shard = charge_sharded_seller(self.seller.id, Decimal('30.00'), '09120000000')
+        self.assertEqual(charge.status, 'failed')
+        self.assertIsNone(shard)
+
+        rebalance_credit_shards(self.seller.id)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('80.01'))
+        self.assertEqual(self.seller.live_credit, Decimal('80.01'))
+
+        log_sum = TransactionLog.objects.filter(seller=self.seller).aggregate(total=Sum('amount'))['total']
+        self.assertEqual(log_sum, Decimal('-20.00'))
+        for shard in SellerCreditShard.objects.filter(seller=self.seller):
+            last_log = TransactionLog.objects.filter(seller=self.seller, shard=shard.index).latest('created_at')
+            self.assertEqual(last_log.balance_after, shard.credit)
+
+
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+class ShardedCreditConcurrencyTest(TransactionTestCase):
+    """
+    Shows that concurrent debits of one seller run in parallel across shards
+    while they serialize on a single shard.
+    """
+    hold_seconds = 0.2
+    concurrent_debits = 4
+
+    def elapsed_for_concurrent_debits(self, shard_count):
+        user = User.objects.create(username=f"concurrent_{shard_count}", password="password")
+        seller = Seller.objects.create(user=user, name="Concurrent Seller", credit=Decimal('1000.00'))
+        enable_credit_sharding(seller.id, shard_count)
+
+        barrier = threading.Barrier(self.concurrent_debits)
+
+        def debit():
+            try:
+                barrier.wait()
+                with transaction.atomic():
+                    debit_credit_shard(seller.id, Decimal('1.00'))
+                    time.sleep(self.hold_seconds)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=debit) for _ in range(self.concurrent_debits)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+
+        seller.refresh_from_db()
+        self.assertEqual(seller.live_credit, Decimal('1000.00') - self.concurrent_debits)
+        return elapsed
+
+    def test_concurrent_debits_scale_with_shard_count(self):
+        single_shard = self.elapsed_for_concurrent_debits(1)
+        sharded = self.elapsed_for_concurrent_debits(self.concurrent_debits)
+
+        self.assertGreaterEqual(single_shard, self.concurrent_debits * self.hold_seconds * 0.9)
+        self.assertLess(sharded, 2 * self.hold_seconds)
+
+
+@skipUnless(connection.vendor == 'postgresql', "row lock conflicts need PostgreSQL")
+class ShardMaintenanceConcurrencyTest(TransactionTestCase):
+    """
+    Verifies that sharded charges deadlock neither with rebalances nor with batches
+    of the same seller, which lock the Seller row before its shards.
+    """
+    rounds = 30
+
+    def setUp(self):
+        user = User.objects.create(username="shard_maintenance", password="password")
+        self.seller = Seller.objects.create(user=user, name="Maintained Seller", credit=Decimal('1000.00'))
+        enable_credit_sharding(self.seller.id, 4)
+
+    def charge(self):
+        charge_sharded_seller(self.seller.id, Decimal('1.00'), '09120000000')
+
+    def run_concurrently(self, *workers):
+        LEDGER_RETRIES_TOTAL.clear()
+        errors = []
+
+        def run(worker):
+            try:
+                for _ in range(self.rounds):
+                    worker()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(LEDGER_RETRIES_TOTAL.value(sqlstate='40P01'), 0)
+        self.seller.refresh_from_db()
+        completed = Charge.objects.filter(seller=self.seller, status='completed').aggregate(total=Sum('amount'))
+        self.assertEqual(self.seller.live_credit, Decimal('1000.00') - completed['total'])
+        self.assertIsNone(reconcile_seller(self.seller.id).error)
+
+    def test_charges_during_rebalances(self):
+        self.run_concurrently(self.charge, self.charge, lambda: rebalance_credit_shards(self.seller.id))
+
+    def test_charges_during_batches(self):
+        def batch():
+            process_charge_batch(create_charge_batch(self.seller.id, [('09120000000', Decimal('1.00'))] * 3).pk)
+
+        self.run_concurrently(self.charge, self.charge, batch)
+        self.assertEqual(Charge.objects.filter(seller=self.seller, status='completed').count(), (2 + 3) * self.rounds)
+
+
+@override_settings(CHARGE_PROCESSING_MODE='sync')
+class SyncChargeTest(TestCase):
+    """
+    Verifies the synchronous charge path and its inline outcome.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="sync_user", password="password")
+        self.seller = Seller.objects.create(user=self.user, name="Sync Seller", credit=Decimal('50.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_charge_now_debits_with_conditional_update(self):
+        charge, balance_after = charge_now(self.seller.id, Decimal('30.00'), '09120000000')
+        self.assertEqual(charge.status, 'completed')
+        self.assertEqual(balance_after, Decimal('20.00'))
+
+        charge, balance_after = charge_now(self.seller.id, Decimal('30.00'), '09120000000')
+        self.assertEqual(charge.status, 'failed')
+        self.assertIsNone(balance_after)
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('20.00'))
+        self.assertEqual(TransactionLog.objects.get(seller=self.seller).balance_after, Decimal('20.00'))
+
+    def test_charge_endpoint_returns_outcome(self):
+        response = self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '20.00'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['status'], 'completed')
+        self.assertEqual(response.data['balance_after'], '30.00')
+
+        response = self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '40.00'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['status'], 'failed')
+
+    def test_sharded_charge_reports_the_shard_balance(self):
+        enable_credit_sharding(self.seller.id, 2)
+        self.client.force_authenticate(user=User.objects.get(pk=self.user.pk))
+        response = self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '5.00'})
+        self.assertEqual(response.status_code, 201)
+        # Only the debited shard was locked, the seller's total is not known
+        self.assertIsNone(response.data['balance_after'])
+        charge = TransactionLog.objects.get(seller=self.seller, transaction_type='charge_sale')
+        self.assertEqual(response.data['shard_balance_after'], str(charge.balance_after))
+        self.assertEqual(charge.balance_after, Decimal('20.00'))
+
+
+@override_settings(CHARGE_PROCESSING_MODE='sync')
+class AsyncViewsTest(TestCase):
+    """
+    Exercises the async-native endpoints with token authentication.
+    """
+
+    def setUp(self):
+        user = User.objects.create(username="async_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Async Seller", credit=Decimal('25.00'))
+        self.headers = {'Authorization': f"Token {Token.objects.create(user=user).key}"}
+
+    async def test_charge_and_list_transactions(self):
+        response = await self.async_client.post(
+            '/api/async/charge/',
+            {'phone_number': '09120000000', 'amount': '10.00'},
+            content_type='application/json',
+            headers=self.headers
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['balance_after'], '15.00')
+
+        response = await self.async_client.get('/api/async/transactions/', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([log['amount'] for log in response.json()['results']], ['-10.00'])
+
+    async def test_credit_request_requires_token(self):
+        response = await self.async_client.post(
+            '/api/async/credit-request/', {'amount': '5.00'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 401)
+
+        response = await self.async_client.post(
+            '/api/async/credit-request/', {'amount': '5.00'},
+            content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['status'], 'pending')
+
+    def test_credit_request_integrity_error_is_a_bad_request(self):
+        def reject_insert(execute, sql, params, many, context):
+            if sql.startswith('INSERT') and 'creditrequest' in sql:
+                raise IntegrityError("CHECK constraint failed")
+            return execute(sql, params, many, context)
+
+        # Sync test: the view's database work runs on this thread and its connection
+        with connection.execute_wrapper(reject_insert):
+            response = async_to_sync(self.async_client.post)(
+                '/api/async/credit-request/', {'amount': '5.00'},
+                content_type='application/json', headers=self.headers
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("constraint", response.json()['error'])
+
+
+class TransactionHistoryTest(TestCase):
+    """
+    Verifies cursor pagination and the streaming export of the transaction history.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="history_user", password="password")
+        seller = Seller.objects.create(user=self.user, name="History Seller")
+        TransactionLog.objects.bulk_create([
+            TransactionLog(
+                seller=seller, transaction_type='add_credit', amount=Decimal(i), balance_after=Decimal(i), seq=i
+            )
+            for i in range(1, 8)
+        ])
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_cursor_pagination_walks_every_row_once(self):
+        amounts, cursor = [], None
+        while True:
+            params = {'page_size': 3}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get('/api/transactions/', params)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            amounts += [log['amount'] for log in response.data['results']]
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(sorted(amounts, key=Decimal), [f"{i}.00" for i in range(1, 8)])
+        self.assertEqual(len(set(amounts)), 7)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/transactions/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_streaming_export(self):
+        response = self.client.get('/api/transactions/', {'export': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 7)
+
+        response = self.client.get('/api/transactions/', {'export': 'csv'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(','), ['unique_id', 'transaction_type', 'amount', 'balance_after',
+                                               'phone_number', 'shard', 'seq', 'created_at'])
+        self.assertEqual(len(lines), 8)
+
+    async def test_export_streams_asynchronously_under_asgi(self):
+        token = await Token.objects.acreate(user=self.user)
+        response = await self.async_client.get(
+            '/api/transactions/', {'export': 'ndjson'}, headers={'Authorization': f"Token {token.key}"}
+        )
+        # A sync iterator would have been read whole before sending
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(len(b''.join(chunks).decode().splitlines()), 7)
+
+        transactions = seller_transactions(await Seller.objects.aget(user=self.user), {})
+        chunks = [chunk async for chunk in astream_export(transactions, 'ndjson', chunk_size=3)]
+        self.assertEqual([len(chunk.splitlines()) for chunk in chunks], [3, 3, 1])
+        amounts = [json.loads(line)['amount'] for line in ''.join(chunks).splitlines()]
+        self.assertEqual(amounts, [f"{i}.00" for i in range(1, 8)])
+
+
+@override_settings(CHARGE_PROCESSING_MODE='sync')
+class QueryBudgetTest(TestCase):
+    """
+    Pins the number of queries of each endpoint with many rows to show, so an N+1
+    fails here instead of in production.
+    """
+    rows = 30
+    # (method, path, data, budget); paths are formatted with the test's attributes
+    budgets = [
+        ('get', '/api/transactions/', None, 2),
+        ('get', '/api/statement/', None, 3),
+        ('get', '/api/balance/', None, 1),
+        ('get', '/api/charge/{charge.pk}/', None, 1),
+        ('get', '/api/charge/batch/{batch.pk}/', None, 2),
+        ('post', '/api/charge/', {'phone_number': '09120000000', 'amount': '1.00'}, 5),
+        ('post', '/api/charge/batch/', [{'phone_number': '09120000000', 'amount': '1.00'}] * rows, 13),
+        # A fan-out to every child, see setUp
+        ('post', '/api/transfer/', None, 7),
+    ]
+    admin_budgets = [
+        ('/admin/B2B_shop/transactionlog/', 6),
+        ('/admin/B2B_shop/charge/', 5),
+        ('/admin/B2B_shop/creditrequest/', 5),
+    ]
+
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        user = User.objects.create(username="budget_user", password="password")
+        self.seller = Seller.objects.create(
+            user=user, name="Budget Seller", credit=Decimal('1000.00'), ledger_seq=self.rows
+        )
+        self.headers = {'Authorization': f"Token {Token.objects.create(user=user).key}"}
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=self.headers['Authorization'])
+
+        TransactionLog.objects.bulk_create([
+            TransactionLog(seller=self.seller, transaction_type='add_credit', amount=Decimal('1.00'),
+                           balance_after=Decimal('1.00'), seq=i + 1)
+            for i in range(self.rows)
+        ])
+        self.charge = Charge.objects.create(seller=self.seller, phone_number='09120000000', amount=Decimal('1.00'))
+        self.batch = create_charge_batch(self.seller.id, [('09120000000', Decimal('1.00'))] * self.rows)
+        CreditRequest.objects.bulk_create([
+            CreditRequest(seller=self.seller, amount=Decimal('1.00')) for _ in range(self.rows)
+        ])
+        children = User.objects.bulk_create([User(username=f"budget_child_{i}") for i in range(self.rows)])
+        self.children = Seller.objects.bulk_create([
+            Seller(user=child, name=child.username, parent=self.seller) for child in children
+        ])
+
+    def test_endpoint_budgets(self):
+        for method, path, data, budget in self.budgets:
+            path = path.format(charge=self.charge, batch=self.batch)
+            if path == '/api/transfer/':
+                data = [{'to_seller': child.pk, 'amount': '1.00'} for child in self.children]
+            with self.subTest(method=method, path=path), query_budget(budget):
+                response = getattr(self.client, method)(path, data, format='json')
+                self.assertLess(response.status_code, 300, response.content)
+
+    def test_admin_budgets(self):
+        admin = User.objects.create_superuser(username="budget_admin", password="password")
+        self.client.force_login(admin)
+        for path, budget in self.admin_budgets:
+            with self.subTest(path=path), query_budget(budget):
+                self.assertEqual(self.client.get(path).status_code, 200)
+
+    def test_budget_catches_n_plus_one(self):
+        logs = TransactionLog.objects.filter(seller=self.seller)
+        with self.assertRaisesMessage(QueryBudgetExceeded, "exceed the budget of 2"):
+            with query_budget(2):
+                TransactionLogSerializer(logs, many=True).data
+        with query_budget(1):
+            TransactionLogSerializer(logs.select_related('seller'), many=True).data
+
+    @override_settings(DEBUG=True)
+    def test_debug_headers(self):
+        response = self.client.get('/api/transactions/')
+        self.assertEqual(response['X-DB-Query-Count'], '2')
+        self.assertIn('SELECT', response['X-DB-Slowest'])
+        self.assertTrue(response['Server-Timing'].startswith('db;dur='))
+
+    @override_settings(DEBUG=True)
+    async def test_async_view_queries_are_counted(self):
+        response = await self.async_client.get('/api/async/transactions/', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-DB-Query-Count'], '2')
+
+    def test_stats_per_endpoint(self):
+        metrics.clear()
+        self.client.get('/api/transactions/')
+        self.client.get('/api/transactions/')
+        self.assertEqual(REQUEST_QUERIES.count(endpoint='api/transactions/'), 2)
+        self.assertNotIn('X-DB-Query-Count', self.client.get('/api/balance/'))
+
+
+@skipUnless(connection.vendor == 'postgresql', "query plans are checked against PostgreSQL")
+class QueryPlanRegressionTest(TestCase):
+    """
+    Seeds a large dataset and checks with EXPLAIN that none of the seller-scoped
+    hot queries falls back to a sequential scan of its table.
+    """
+    sellers = 100
+    logs_per_seller = 500
+    charges_per_seller = 200
+    requests_per_seller = 100
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create([User(username=f"plan_user_{i}") for i in range(cls.sellers)])
+        sellers = Seller.objects.bulk_create([Seller(user=user, name=user.username) for user in users])
+        cls.seller = sellers[0]
+
+        TransactionLog.objects.bulk_create([
+            TransactionLog(
+                seller=seller,
+                transaction_type='charge_sale' if i % 10 else 'add_credit',
+                amount=Decimal('1.00'),
+                balance_after=Decimal('1.00'),
+                seq=i + 1,
+            )
+            for seller in sellers for i in range(cls.logs_per_seller)
+        ], batch_size=5000)
+        Charge.objects.bulk_create([
+            Charge(
+                seller=seller,
+                phone_number=f"0912{seller.id:03d}{i:04d}",
+                amount=Decimal('1.00'),
+                status='pending' if i == 0 else 'completed',
+            )
+            for seller in sellers for i in range(cls.charges_per_seller)
+        ], batch_size=5000)
+        CreditRequest.objects.bulk_create([
+            CreditRequest(seller=seller, amount=Decimal('1.00'), status='pending' if i == 0 else 'approved')
+            for seller in sellers for i in range(cls.requests_per_seller)
+        ], batch_size=5000)
+
+        with connection.cursor() as cursor:
+            for model in (TransactionLog, Charge, CreditRequest):
+                cursor.execute(f"ANALYZE {connection.ops.quote_name(model._meta.db_table)}")
+
+    def assertNoSeqScan(self, queryset):
+        plan = queryset.explain()
+        table = queryset.model._meta.db_table
+        # Partitioned tables: scanning an empty partition sequentially is free
+        scanned = re.findall(rf'Seq Scan on "?({table}(?:_p\d{{6}}|_default)?)\b', plan)
+        with connection.cursor() as cursor:
+            for relation in scanned:
+                cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {connection.ops.quote_name(relation)})")
+                self.assertFalse(cursor.fetchone()[0], plan)
+
+    def test_transaction_history_page(self):
+        transactions = seller_transactions(self.seller, {'start_date': '2000-01-01T00:00Z', 'end_date': '2100-01-01T00:00Z'})
+        self.assertNoSeqScan(keyset_page(transactions, None, 100))
+
+    def test_admin_transaction_type_filter(self):
+        self.assertNoSeqScan(TransactionLog.objects.filter(transaction_type='add_credit').order_by('-created_at')[:100])
+
+    def test_charge_lookup_by_phone_number(self):
+        self.assertNoSeqScan(Charge.objects.filter(phone_number='09120010001'))
+
+    def test_seller_charges_by_date(self):
+        self.assertNoSeqScan(Charge.objects.filter(seller=self.seller, created_at__gte='2000-01-01T00:00Z').order_by('created_at'))
+
+    def test_pending_charges_for_flush(self):
+        self.assertNoSeqScan(
+            Charge.objects.filter(seller=self.seller, status='pending').order_by('created_at', 'unique_id')[:500]
+        )
+
+    def test_pending_credit_requests(self):
+        self.assertNoSeqScan(CreditRequest.objects.filter(status='pending').order_by('created_at')[:100])
+
+
+@override_settings(CHARGE_PROCESSING_MODE='sync')
+class IdempotentChargeTest(TestCase):
+    """
+    Verifies that retries with the same Idempotency-Key never charge twice.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="idempotent_user", password="password")
+        self.seller = Seller.objects.create(user=self.user, name="Idempotent Seller", credit=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def charge(self, key):
+        return self.client.post(
+            '/api/charge/', {'phone_number': '09120000000', 'amount': '10.00'},
+            HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_replay_returns_original_outcome(self):
+        first = self.charge('retry-1')
+        self.assertEqual(first.status_code, 201)
+
+        replayed = self.charge('retry-1')
+        self.assertEqual(replayed.status_code, 201)
+        self.assertEqual(replayed.data, first.data)
+
+        # once the cached outcome is gone the unique constraint still catches the retry
+        cache.clear()
+        replayed = self.charge('retry-1')
+        self.assertEqual(replayed.data['charge_id'], first.data['charge_id'])
+
+        self.assertEqual(self.charge('retry-2').status_code, 201)
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('80.00'))
+        self.assertEqual(Charge.objects.filter(seller=self.seller).count(), 2)
+
+    def test_task_skips_duplicate_key(self):
+        process_charge_task(self.seller.id, '10.00', '09120000000', idempotency_key='task-1')
+        result = process_charge_task(self.seller.id, '10.00', '09120000000', idempotency_key='task-1')
+
+        self.assertIn('Duplicate idempotency key', result['error'])
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('90.00'))
+
+
+@override_settings(CHARGE_PROCESSING_MODE='sync')
+class ChargeBatchTest(TestCase):
+    """
+    Verifies batch submissions: one-pass validation, partial and all-or-nothing settlement
+    and per-line outcomes.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username="batch_user", password="password")
+        self.seller = Seller.objects.create(user=self.user, name="Batch Seller", credit=Decimal('25.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.lines = [
+            {'phone_number': f'0912000000{i}', 'amount': '10.00'} for i in range(3)
+        ]
+
+    def test_partial_batch(self):
+        response = self.client.post('/api/charge/batch/', self.lines, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['completed_count'], response.data['failed_count']), (2, 1))
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('5.00'))
+        logs = TransactionLog.objects.filter(seller=self.seller).order_by('balance_after')
+        self.assertEqual([log.balance_after for log in logs], [Decimal('5.00'), Decimal('15.00')])
+
+        detail = self.client.get(f"/api/charge/batch/{response.data['batch_id']}/")
+        self.assertEqual(detail.status_code, 200)
+        self.assertEqual(
+            [(line['line'], line['status']) for line in detail.data['lines']],
+            [(1, 'completed'), (2, 'completed'), (3, 'failed')]
+        )
+
+    def test_all_or_nothing_batch(self):
+        response = self.client.post(
+            '/api/charge/batch/', {'mode': 'all_or_nothing', 'charges': self.lines}, format='json'
+        )
+        self.assertEqual((response.data['completed_count'], response.data['failed_count']), (0, 3))
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('25.00'))
+        self.assertFalse(TransactionLog.objects.filter(seller=self.seller).exists())
+
+        response = self.client.post(
+            '/api/charge/batch/', {'mode': 'all_or_nothing', 'charges': self.lines[:2]}, format='json'
+        )
+        self.assertEqual(response.data['completed_count'], 2)
+
+    def test_csv_upload(self):
+        upload = SimpleUploadedFile(
+            'charges.csv', b"phone_number,amount\n09120000000,5.00\n09120000001,7.50\n", content_type='text/csv'
+        )
+        response = self.client.post('/api/charge/batch/', {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_amount'], '12.50')
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('12.50'))
+
+    def test_invalid_lines_are_reported_per_line(self):
+        lines = self.lines + [{'phone_number': '09120000009', 'amount': '-1'}]
+        response = self.client.post('/api/charge/batch/', lines, format='json')
+        self.assertEqual(response.status_code, 400)
+        # errors are keyed by the 0-based index of the offending line
+        errors = response.data['charges']
+        self.assertEqual(list(errors), [3])
+        self.assertIn('amount', errors[3])
+        self.assertFalse(ChargeBatch.objects.exists())
+
+        with override_settings(CHARGE_BATCH_MAX_LINES=2):
+            response = self.client.post('/api/charge/batch/', self.lines, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_lines_are_not_flushed_with_buffered_charges(self):
+        batch = create_charge_batch(self.seller.id, [('09120000000', Decimal('10.00'))])
+        self.assertEqual(process_pending_charges(self.seller.id, 100), 0)
+
+        batch = process_charge_batch(batch.pk)
+        self.assertEqual(batch.completed_count, 1)
+        # processing is not repeated
+        self.assertEqual(process_charge_batch(batch.pk).processed_at, batch.processed_at)
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('15.00'))
+
+    def test_other_sellers_cannot_read_batch(self):
+        batch = create_charge_batch(self.seller.id, [('09120000000', Decimal('10.00'))])
+        other = User.objects.create(username="other_batch_user", password="password")
+        Seller.objects.create(user=other, name="Other Seller")
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.get(f"/api/charge/batch/{batch.pk}/").status_code, 404)
+
+
+class BulkCreditApprovalTest(TestCase):
+    """
+    Verifies the set-based approval of a selection of credit requests.
+    """
+
+    def setUp(self):
+        users = [User.objects.create(username=f"approval_user_{i}", password="password") for i in range(3)]
+        self.seller1 = Seller.objects.create(user=users[0], name="Approval One", credit=Decimal('5.00'))
+        self.seller2 = Seller.objects.create(user=users[1], name="Approval Two")
+        self.full_seller = Seller.objects.create(user=users[2], name="Approval Full", credit=MAX_CREDIT)
+
+    def test_approves_pending_requests_with_chained_balances(self):
+        requests = [
+            CreditRequest.objects.create(seller=self.seller1, amount=Decimal('10.00')),
+            CreditRequest.objects.create(seller=self.seller2, amount=Decimal('7.00')),
+            CreditRequest.objects.create(seller=self.seller1, amount=Decimal('20.00')),
+            CreditRequest.objects.create(seller=self.seller1, amount=Decimal('99.00'), status='approved'),
+            CreditRequest.objects.create(seller=self.full_seller, amount=Decimal('1.00')),
+        ]
+
+        # lock requests, lock sellers, one credit UPDATE, one INSERT, one status UPDATE
+        with self.assertNumQueries(5 + 2):  # + SAVEPOINT/RELEASE inside the test transaction
+            result = approve_credit_requests([r.pk for r in requests])
+
+        self.assertEqual((result.approved, result.skipped, result.failed), (3, 1, 1))
+        self.seller1.refresh_from_db()
+        self.seller2.refresh_from_db()
+        self.assertEqual(self.seller1.credit, Decimal('35.00'))
+        self.assertEqual(self.seller2.credit, Decimal('7.00'))
+
+        balances = list(
+            TransactionLog.objects.filter(seller=self.seller1).order_by('balance_after')
+            .values_list('balance_after', flat=True)
+        )
+        self.assertEqual(balances, [Decimal('15.00'), Decimal('35.00')])
+        self.assertEqual(CreditRequest.objects.filter(status='approved').count(), 4)
+        self.assertEqual(CreditRequest.objects.get(seller=self.full_seller).status, 'pending')
+
+        # a second run finds nothing left to approve
+        result = approve_credit_requests([r.pk for r in requests])
+        self.assertEqual((result.approved, result.skipped), (0, 4))
+
+
+class AutoApprovalTest(TestCase):
+    """
+    Verifies that new credit requests matching an approval rule are approved at once,
+    and that the compiled rules follow admin edits.
+    """
+
+    def setUp(self):
+        cache.clear()
+        metrics.clear()
+        approval_rules.clear()
+        users = [User.objects.create(username=f"auto_user_{i}", password="password") for i in range(2)]
+        self.seller = Seller.objects.create(user=users[0], name="Auto One", credit=Decimal('10.00'))
+        self.other = Seller.objects.create(user=users[1], name="Auto Two")
+        self.client = APIClient()
+        self.client.force_authenticate(user=users[0])
+
+    def tearDown(self):
+        approval_rules.clear()
+
+    def request_credit(self, amount):
+        response = self.client.post('/api/credit-request/', {'amount': amount})
+        self.assertEqual(response.status_code, 201)
+        return response.data['status']
+
+    def test_trusted_seller_is_approved_at_once(self):
+        CreditApprovalRule.objects.create(seller=self.seller, trusted=True)
+        self.assertEqual(self.request_credit('500.00'), 'approved')
+
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('510.00'))
+        credit_request = CreditRequest.objects.get()
+        self.assertTrue(credit_request.auto_approved)
+        log = TransactionLog.objects.get(seller=self.seller)
+        self.assertEqual((log.transaction_type, log.balance_after), ('add_credit', Decimal('510.00')))
+        self.assertEqual(AUTO_APPROVALS_TOTAL.value(outcome='approved'), 1)
+
+    def test_seller_rule_replaces_the_default_rule(self):
+        CreditApprovalRule.objects.create(max_amount=Decimal('50.00'))
+        self.assertEqual(self.request_credit('50.00'), 'approved')
+        self.assertEqual(self.request_credit('50.01'), 'pending')
+
+        # A rule with no limits keeps every request for review
+        with self.captureOnCommitCallbacks(execute=True):
+            CreditApprovalRule.objects.create(seller=self.other)
+        credit_request = submit_credit_request(self.other, Decimal('1.00'))
+        self.assertEqual((credit_request.status, credit_request.auto_approved), ('pending', False))
+        self.assertEqual(AUTO_APPROVALS_TOTAL.value(outcome='pending'), 2)
+
+    def test_daily_cap(self):
+        CreditApprovalRule.objects.create(max_amount=Decimal('50.00'), daily_cap=Decimal('80.00'))
+        statuses = [self.request_credit(amount) for amount in ('50.00', '40.00', '30.00', '0.01')]
+        self.assertEqual(statuses, ['approved', 'pending', 'approved', 'pending'])
+        self.seller.refresh_from_db()
+        self.assertEqual(self.seller.credit, Decimal('90.00'))
+
+        # Each seller has a cap of its own
+        self.assertEqual(submit_credit_request(self.other, Decimal('50.00')).status, 'approved')
+
+    def test_overflow_stays_pending_and_frees_the_cap(self):
+        Seller.objects.filter(pk=self.seller.pk).update(credit=MAX_CREDIT - Decimal('10.00'))
+        CreditApprovalRule.objects.create(trusted=True, daily_cap=Decimal('25.00'))
+        self.assertEqual(self.request_credit('20.00'), 'pending')
+        self.assertEqual(AUTO_APPROVALS_TOTAL.value(outcome='failed'), 1)
+
+        self.assertEqual(self.request_credit('10.00'), 'approved')
+        day = timezone.localdate().isoformat()
+        self.assertEqual(cache.get(DAILY_TOTAL_KEY.format(seller_id=self.seller.pk, day=day)), 1000)
+
+    def test_failed_transaction_releases_the_cap(self):
+        CreditApprovalRule.objects.create(trusted=True, daily_cap=Decimal('25.00'))
+        key = DAILY_TOTAL_KEY.format(seller_id=self.seller.pk, day=timezone.localdate().isoformat())
+
+        # Fails the n-th savepoint release after the approval's status UPDATE: the first
+        # ends approve_credit_requests(), the second submit_credit_request()
+        for releases in (1, 2):
+            seen = {'approved': False, 'releases': 0}
+
+            def fail_after_approval(execute, sql, params, many, context):
+                if sql.startswith('UPDATE') and 'creditrequest' in sql:
+                    seen['approved'] = True
+                elif seen['approved'] and sql.startswith('RELEASE SAVEPOINT'):
+                    seen['releases'] += 1
+                    if seen['releases'] == releases:
+                        raise OperationalError("connection lost")
+                return execute(sql, params, many, context)
+
+            with self.assertRaises(OperationalError), connection.execute_wrapper(fail_after_approval):
+                submit_credit_request(self.seller, Decimal('20.00'))
+            self.assertEqual(cache.get(key), 0)
+
+        self.assertFalse(CreditRequest.objects.filter(status='approved').exists())
+        self.assertEqual(submit_credit_request(self.seller, Decimal('20.00')).status, 'approved')
+
+    @override_settings(AUTO_APPROVAL_ENABLED=False)
+    def test_disabled(self):
+        CreditApprovalRule.objects.create(trusted=True)
+        self.assertEqual(self.request_credit('5.00'), 'pending')
+
+    @override_settings(AUTO_APPROVAL_RULES_CHECK_INTERVAL=60)
+    def test_rules_are_compiled_once_and_follow_edits(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            rule = CreditApprovalRule.objects.create(max_amount=Decimal('10.00'))
+        self.assertEqual(approval_rules.get(self.seller.pk).max_amount, Decimal('10.00'))
+        with self.assertNumQueries(0):
+            self.assertEqual(approval_rules.get(self.other.pk).max_amount, Decimal('10.00'))
+
+        # An admin edit in this process is seen at once
+        with self.captureOnCommitCallbacks(execute=True):
+            rule.max_amount = Decimal('20.00')
+            rule.save()
+        self.assertEqual(approval_rules.get(self.seller.pk).max_amount, Decimal('20.00'))
+
+        # One in another process once the version is checked again
+        CreditApprovalRule.objects.filter(pk=rule.pk).update(max_amount=Decimal('30.00'))
+        cache.set(VERSION_KEY, 'edited elsewhere')
+        self.assertEqual(approval_rules.get(self.seller.pk).max_amount, Decimal('20.00'))
+        with override_settings(AUTO_APPROVAL_RULES_CHECK_INTERVAL=0):
+            self.assertEqual(approval_rules.get(self.seller.pk).max_amount, Decimal('30.00'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rule.delete()
+        self.assertIsNone(approval_rules.get(self.seller.pk))
+
+
+class LedgerTest(TestCase):
+    """
+    Verifies that postings are applied per seller in one UPDATE with chained logs.
+    """
+
+    def setUp(self):
+        users = [User.objects.create(username=f"ledger_user_{i}", password="password") for i in range(3)]
+        self.seller1 = Seller.objects.create(user=users[0], name="Ledger One", credit=Decimal('10.00'))
+        self.seller2 = Seller.objects.create(user=users[1], name="Ledger Two", credit=Decimal('50.00'))
+        self.sharded = Seller.objects.create(user=users[2], name="Ledger Sharded", credit=Decimal('40.00'))
+        enable_credit_sharding(self.sharded.id, 2)
+
+    def chain(self, seller):
+        return list(
+            TransactionLog.objects.filter(seller=seller, shard__isnull=True).order_by('seq')
+            .values_list('seq', 'amount', 'balance_after')
+        )
+
+    def test_locks_sellers_in_order_and_updates_each_once(self):
+        postings = [
+            Posting(self.seller2.id, Decimal('-20.00'), 'charge_sale', '09120000000'),
+            Posting(self.seller1.id, Decimal('5.00'), 'add_credit'),
+            Posting(self.seller2.id, Decimal('3.00'), 'add_credit'),
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            result = apply_postings(postings)
+
+        # lock both sellers, one UPDATE for both, one INSERT of the logs
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(len(result.applied), 3)
+        self.assertEqual([log.amount for log in result.logs], [Decimal('5.00'), Decimal('-20.00'), Decimal('3.00')])
+        self.seller1.refresh_from_db()
+        self.seller2.refresh_from_db()
+        self.assertEqual((self.seller1.credit, self.seller1.ledger_seq), (Decimal('15.00'), 1))
+        self.assertEqual((self.seller2.credit, self.seller2.ledger_seq), (Decimal('33.00'), 2))
+        self.assertEqual(self.chain(self.seller2), [
+            (1, Decimal('-20.00'), Decimal('30.00')), (2, Decimal('3.00'), Decimal('33.00'))
+        ])
+
+    def test_rejects_a_seller_whose_running_balance_goes_negative(self):
+        # The total is positive, but the debit comes first
+        postings = [
+            Posting(self.seller1.id, Decimal('-15.00'), 'charge_sale', reference=1),
+            Posting(self.seller1.id, Decimal('20.00'), 'add_credit', reference=2),
+            Posting(self.seller2.id, Decimal('-5.00'), 'charge_sale', reference=3),
+        ]
+        result = apply_postings(postings)
+
+        self.assertEqual([posting.reference for posting in result.rejected], [1, 2])
+        self.assertEqual([posting.reference for posting in result.applied], [3])
+        self.seller1.refresh_from_db()
+        self.assertEqual((self.seller1.credit, self.chain(self.seller1)), (Decimal('10.00'), []))
+
+        # A single seller takes the conditional UPDATE path
+        result = apply_postings(postings[:2])
+        self.assertEqual((len(result.applied), len(result.rejected)), (0, 2))
+        result = apply_postings(postings[1::-1])
+        self.assertEqual(result.logs[-1].balance_after, Decimal('15.00'))
+
+    def test_all_or_nothing(self):
+        postings = [
+            Posting(self.seller1.id, Decimal('-5.00'), 'charge_sale'),
+            Posting(self.seller2.id, Decimal('-60.00'), 'charge_sale'),
+        ]
+        result = apply_postings(postings, all_or_nothing=True)
+        self.assertEqual((len(result.applied), len(result.rejected)), (0, 2))
+        self.seller1.refresh_from_db()
+        self.assertEqual(self.seller1.credit, Decimal('10.00'))
+
+        # A shard debit that fails undoes the sellers posted before it
+        postings = [
+            Posting(self.seller1.id, Decimal('-5.00'), 'charge_sale'),
+            Posting(self.sharded.id, Decimal('-30.00'), 'charge_sale'),
+        ]
+        result = apply_postings(postings, all_or_nothing=True)
+        self.assertEqual(len(result.rejected), 2)
+        self.seller1.refresh_from_db()
+        self.assertEqual(self.seller1.credit, Decimal('10.00'))
+        self.assertFalse(TransactionLog.objects.filter(transaction_type='charge_sale').exists())
+
+    def test_sharded_sellers_are_posted_to_their_shards(self):
+        postings = [
+            Posting(self.sharded.id, Decimal('-15.00'), 'charge_sale'),
+            Posting(self.sharded.id, Decimal('-30.00'), 'charge_sale'),
+            Posting(self.sharded.id, Decimal('7.00'), 'add_credit'),
+            Posting(self.seller1.id, Decimal('1.00'), 'add_credit'),
+        ]
+        result = apply_postings(postings)
+
+        # No shard holds 30.00, the other debit applies on its own
+        self.assertEqual([posting.amount for posting in result.rejected], [Decimal('-30.00')])
+        self.sharded.refresh_from_db()
+        self.assertEqual(self.sharded.live_credit, Decimal('32.00'))
+        for log in result.logs:
+            if log.seller_id == self.sharded.id:
+                shard = SellerCreditShard.objects.get(seller=self.sharded, index=log.shard)
+                self.assertLessEqual(log.seq, shard.ledger_seq)
+        self.assertIsNone(reconcile_seller(self.sharded.id).error)
+
+    def test_unknown_seller(self):
+        with self.assertRaises(Seller.DoesNotExist):
+            apply_postings([Posting(0, Decimal('1.00'), 'add_credit')])
+        with self.assertRaises(Seller.DoesNotExist):
+            apply_postings([
+                Posting(0, Decimal('1.00'), 'add_credit'), Posting(self.seller1.id, Decimal('1.00'), 'add_credit')
+            ])
+
+
+class _Conflict(Exception):
+    pgcode = '40P01'
+
+
+@override_settings(LEDGER_MAX_RETRIES=2, LEDGER_RETRY_BACKOFF_MS=1)
+class LedgerRetryTest(TransactionTestCase):
+    """
+    Verifies that ledger transactions are run again after conflicts, a bounded number of times.
+    """
+
+    def setUp(self):
+        metrics.clear()
+        self.attempts = 0
+
+    def conflicting(self, failures, cause=_Conflict):
+        @retry_on_conflict
+        def run():
+            self.attempts += 1
+            if self.attempts <= failures:
+                raise OperationalError("deadlock detected") from cause()
+            return 'done'
+        return run
+
+    def test_retries_conflicts(self):
+        self.assertEqual(self.conflicting(2)(), 'done')
+        self.assertEqual(self.attempts, 3)
+        self.assertEqual(LEDGER_RETRIES_TOTAL.value(sqlstate='40P01'), 2)
+
+    def test_gives_up_after_the_last_retry(self):
+        with self.assertRaises(OperationalError):
+            self.conflicting(3)()
+        self.assertEqual(self.attempts, 3)
+
+    def test_other_errors_and_nested_transactions_are_not_retried(self):
+        with self.assertRaises(OperationalError):
+            self.conflicting(1, cause=Exception)()
+        self.assertEqual(self.attempts, 1)
+
+        self.attempts = 0
+        with self.assertRaises(OperationalError), transaction.atomic():
+            self.conflicting(1)()
+        self.assertEqual(self.attempts, 1)
+
+
+@skipUnless(connection.vendor == 'postgresql', "row lock conflicts need PostgreSQL")
+class LedgerConcurrencyTest(TransactionTestCase):
+    """
+    Verifies the lock modes against a seller held by another transaction, and that
+    many processes posting to the same sellers neither deadlock nor break the ledger.
+    """
+
+    def setUp(self):
+        users = [User.objects.create(username=f"ledger_lock_{i}", password="password") for i in range(2)]
+        self.busy = Seller.objects.create(user=users[0], name="Busy", credit=Decimal('10.00'))
+        self.free = Seller.objects.create(user=users[1], name="Free", credit=Decimal('10.00'))
+
+    def hold(self, seller_id, locked, release):
+        try:
+            with transaction.atomic():
+                Seller.objects.select_for_update().get(pk=seller_id)
+                locked.set()
+                release.wait(5)
+        finally:
+            connection.close()
+
+    @override_settings(LEDGER_MAX_RETRIES=1, LEDGER_RETRY_BACKOFF_MS=1)
+    def test_lock_modes(self):
+        locked, release = threading.Event(), threading.Event()
+        holder = threading.Thread(target=self.hold, args=(self.busy.id, locked, release))
+        holder.start()
+        try:
+            locked.wait(5)
+            postings = [
+                Posting(self.busy.id, Decimal('1.00'), 'add_credit'),
+                Posting(self.free.id, Decimal('1.00'), 'add_credit'),
+            ]
+            result = post(postings, lock=LOCK_SKIP_LOCKED)
+            self.assertEqual([posting.seller_id for posting in result.skipped], [self.busy.id])
+            self.assertEqual([posting.seller_id for posting in result.applied], [self.free.id])
+
+            with self.assertRaises(OperationalError):
+                post(postings, lock=LOCK_NOWAIT)
+            self.assertEqual(LEDGER_RETRIES_TOTAL.value(sqlstate='55P03'), 1)
+        finally:
+            release.set()
+            holder.join()
+
+    def test_stress(self):
+        out = io.StringIO()
+        call_command('stress_ledger', processes=4, transactions=50, sellers=3, sharded_sellers=1, stdout=out)
+        self.assertIn("Verified the ledgers of 3 sellers", out.getvalue())
+
+
+class TransferTest(TestCase):
+    """
+    Verifies credit transfers from a distributor to its sub-resellers.
+    """
+
+    def setUp(self):
+        users = [User.objects.create(username=f"transfer_user_{i}", password="password") for i in range(4)]
+        self.parent = Seller.objects.create(user=users[0], name="Distributor", credit=Decimal('100.00'))
+        self.child1 = Seller.objects.create(user=users[1], name="Reseller One", parent=self.parent)
+        self.child2 = Seller.objects.create(
+            user=users[2], name="Reseller Two", credit=Decimal('5.00'), parent=self.parent
+        )
+        self.stranger = Seller.objects.create(user=users[3], name="Stranger")
+        self.client = APIClient()
+        self.client.force_authenticate(user=users[0])
+
+    def credits(self):
+        return list(
+            Seller.objects.filter(pk__in=[self.parent.pk, self.child1.pk, self.child2.pk, self.stranger.pk])
+            .order_by('pk').values_list('credit', flat=True)
+        )
+
+    def test_single_transfer(self):
+        response = self.client.post('/api/transfer/', {'to_seller': self.child1.pk, 'amount': '30.00'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['balance_after'], '70.00')
+        self.assertEqual(self.credits(), [Decimal('70.00'), Decimal('30.00'), Decimal('5.00'), Decimal('0.00')])
+
+        transfer = CreditTransfer.objects.get()
+        self.assertEqual(str(transfer.unique_id), response.data['transfers'][0]['transfer_id'])
+        self.assertEqual((transfer.sender_id, transfer.recipient_id), (self.parent.pk, self.child1.pk))
+        self.assertEqual(
+            list(TransactionLog.objects.order_by('seller_id').values_list('seller_id', 'transaction_type', 'amount')),
+            [(self.parent.pk, 'transfer_out', Decimal('-30.00')), (self.child1.pk, 'transfer_in', Decimal('30.00'))]
+        )
+
+    def test_fan_out(self):
+        response = self.client.post('/api/transfer/', [
+            {'to_seller': self.child1.pk, 'amount': '10.00'},
+            {'to_seller': self.child2.pk, 'amount': '15.00'},
+            {'to_seller': self.child1.pk, 'amount': '5.00'},
+        ], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['total_amount'], response.data['balance_after']), ('30.00', '70.00'))
+        self.assertEqual(self.credits(), [Decimal('70.00'), Decimal('15.00'), Decimal('20.00'), Decimal('0.00')])
+        self.assertEqual(CreditTransfer.objects.count(), 3)
+        self.assertEqual(
+            list(TransactionLog.objects.filter(seller=self.parent).order_by('seq').values_list('balance_after', flat=True)),
+            [Decimal('90.00'), Decimal('75.00'), Decimal('70.00')]
+        )
+
+    def test_only_sub_resellers_receive_transfers(self):
+        response = self.client.post('/api/transfer/', {'transfers': [
+            {'to_seller': self.child1.pk, 'amount': '10.00'},
+            {'to_seller': self.stranger.pk, 'amount': '10.00'},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(self.stranger.pk), str(response.data['transfers']))
+
+        response = self.client.post('/api/transfer/', {'to_seller': self.parent.pk, 'amount': '10.00'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.credits(), [Decimal('100.00'), Decimal('0.00'), Decimal('5.00'), Decimal('0.00')])
+        self.assertFalse(TransactionLog.objects.exists())
+
+    def test_insufficient_credit_moves_nothing(self):
+        response = self.client.post('/api/transfer/', [
+            {'to_seller': self.child1.pk, 'amount': '60.00'},
+            {'to_seller': self.child2.pk, 'amount': '60.00'},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['status'], 'failed')
+        self.assertEqual(self.credits(), [Decimal('100.00'), Decimal('0.00'), Decimal('5.00'), Decimal('0.00')])
+        self.assertFalse(CreditTransfer.objects.exists())
+        self.assertFalse(TransactionLog.objects.exists())
+
+    def test_idempotency_key(self):
+        cache.clear()
+        fan_out = [
+            {'to_seller': self.child1.pk, 'amount': '10.00'},
+            {'to_seller': self.child1.pk, 'amount': '5.00'},
+        ]
+        first = self.client.post('/api/transfer/', fan_out, format='json', HTTP_IDEMPOTENCY_KEY='transfer-1')
+        self.assertEqual(first.status_code, 201)
+        retry = self.client.post('/api/transfer/', fan_out, format='json', HTTP_IDEMPOTENCY_KEY='transfer-1')
+        self.assertEqual((retry.status_code, retry.data), (201, first.data))
+        self.assertEqual(self.credits()[:2], [Decimal('85.00'), Decimal('15.00')])
+
+        # Once the cached outcome expired, the stored transfers answer without a balance
+        cache.clear()
+        retry = self.client.post('/api/transfer/', fan_out, format='json', HTTP_IDEMPOTENCY_KEY='transfer-1')
+        self.assertEqual(retry.data['transfers'], first.data['transfers'])
+        self.assertIsNone(retry.data['balance_after'])
+        self.assertEqual(CreditTransfer.objects.count(), 2)
+
+        # Without the cached reservation, the stored transfers still reject a second use
+        response = self.client.post(
+            '/api/transfer/', fan_out[:1], format='json', HTTP_IDEMPOTENCY_KEY='transfer-2'
+        )
+        self.assertEqual(response.status_code, 201)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            transfer_credit(self.parent.pk, [(self.child2.pk, Decimal('1.00'))], 'transfer-2')
+
+    def test_sharded_distributor(self):
+        enable_credit_sharding(self.parent.pk, 2)
+        result = transfer_credit(self.parent.pk, [(self.child1.pk, Decimal('20.00')), (self.child2.pk, Decimal('20.00'))])
+        self.assertEqual(len(result.transfers), 2)
+        self.parent.refresh_from_db()
+        self.assertEqual(self.parent.live_credit, Decimal('60.00'))
+        self.assertEqual(self.credits()[1:3], [Decimal('20.00'), Decimal('25.00')])
+        self.assertIsNone(reconcile_seller(self.parent.pk).error)
+
+
+@skipUnless(connection.vendor == 'postgresql', "row lock conflicts need PostgreSQL")
+class TransferConcurrencyTest(TransactionTestCase):
+    """
+    Verifies that opposite transfers between two sellers queue up rather than deadlock.
+    """
+
+    def setUp(self):
+        users = [User.objects.create(username=f"transfer_lock_{i}", password="password") for i in range(2)]
+        self.first = Seller.objects.create(user=users[0], name="First", credit=Decimal('100.00'))
+        self.second = Seller.objects.create(user=users[1], name="Second", credit=Decimal('100.00'))
+
+    def transfer(self, sender_id, recipient_id, errors):
+        try:
+            for _ in range(50):
+                transfer_credit(sender_id, [(recipient_id, Decimal('1.00'))])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_opposite_transfers(self):
+        LEDGER_RETRIES_TOTAL.clear()
+        errors = []
+        threads = [
+            threading.Thread(target=self.transfer, args=(sender, recipient, errors))
+            for sender, recipient in [(self.first.pk, self.second.pk), (self.second.pk, self.first.pk)] * 2
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(LEDGER_RETRIES_TOTAL.value(sqlstate='40P01'), 0)
+        self.assertEqual(CreditTransfer.objects.count(), 200)
+        self.assertEqual(Seller.objects.aggregate(total=Sum('credit'))['total'], Decimal('200.00'))
+        for seller in (self.first, self.second):
+            self.assertIsNone(reconcile_seller(seller.pk).error)
+
+
+@override_settings(CHARGE_PROCESSING_MODE='sync')
+class CachedTokenAuthenticationTest(TestCase):
+    """
+    Verifies that cached token authentication skips the database and honours invalidation.
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        user = User.objects.create(username="cached_auth_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Cached Auth Seller", credit=Decimal('100.00'))
+        self.token = Token.objects.create(user=user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def charge(self):
+        return self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '1.00'})
+
+    def test_charge_needs_no_query_before_the_debit(self):
+        self.assertEqual(self.charge().status_code, 201)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.charge().status_code, 201)
+        statements = [q['sql'] for q in queries.captured_queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertTrue(statements[0].startswith('UPDATE'), statements)
+        self.assertFalse(any('authtoken' in sql or 'auth_user' in sql for sql in statements), statements)
+
+    def test_deleted_token_is_rejected(self):
+        self.assertEqual(self.charge().status_code, 201)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        self.assertEqual(self.charge().status_code, 401)
+
+
+@override_settings(CHARGE_PROCESSING_MODE='sync')
+class BalanceCacheTest(TestCase):
+    """
+    Verifies that the balance endpoint is served from snapshots written through on commit.
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        user = User.objects.create(username="balance_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Balance Seller", credit=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=user).key}")
+
+    def balance(self):
+        response = self.client.get('/api/balance/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_charge_writes_the_balance_through(self):
+        first = self.balance()
+        self.assertEqual((first['credit'], first['last_seq'], first['source']), ('100.00', 0, 'database'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '30.00'})
+        with self.assertNumQueries(0):
+            cached = self.balance()
+        self.assertEqual((cached['credit'], cached['last_seq'], cached['source']), ('70.00', 1, 'cache'))
+        self.assertGreaterEqual(cached['age_seconds'], 0)
+
+    def test_rolled_back_debit_is_not_published(self):
+        self.balance()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                charge_now(self.seller.id, Decimal('30.00'), '09120000000')
+                raise RuntimeError
+        self.assertEqual(self.balance()['credit'], '100.00')
+
+    def test_task_and_approval_paths(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            process_charge_task(self.seller.id, '10.00', '09120000000')
+        self.assertEqual(self.balance()['credit'], '90.00')
+
+        CreditRequest.objects.create(seller=self.seller, amount=Decimal('25.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            approve_credit_requests(CreditRequest.objects.values_list('pk', flat=True))
+        self.assertEqual((self.balance()['credit'], self.balance()['last_seq']), ('115.00', 2))
+
+    def test_sharded_seller_balance_sums_the_shards(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enable_credit_sharding(self.seller.id, 4)
+            charge_sharded_seller(self.seller.id, Decimal('5.00'), '09120000000')
+        balance = self.balance()
+        # one main chain entry moving the credit out, four shard transfers and the charge
+        self.assertEqual((balance['credit'], balance['last_seq'], balance['source']), ('95.00', 6, 'cache'))
+
+    def test_older_snapshot_does_not_overwrite_newer(self):
+        store_balance(self.seller.id, {'credit': '50.00', 'last_seq': 5, 'updated_at': timezone.now().isoformat()})
+        store_balance(self.seller.id, {'credit': '60.00', 'last_seq': 4, 'updated_at': timezone.now().isoformat()})
+        self.assertEqual(cached_balance(self.seller.id)['credit'], '50.00')
+
+    def test_snapshots_published_out_of_order(self):
+        snapshots = [
+            {'credit': f'{seq}.00', 'last_seq': seq, 'updated_at': timezone.now().isoformat()}
+            for seq in range(1, 41)
+        ]
+        random.Random(7).shuffle(snapshots)
+        barrier = threading.Barrier(len(snapshots))
+
+        def publish(snapshot):
+            barrier.wait()
+            store_balance(self.seller.id, snapshot)
+
+        threads = [threading.Thread(target=publish, args=(snapshot,)) for snapshot in snapshots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cached_balance(self.seller.id)['last_seq'], 40)
+
+    def test_database_read_does_not_overwrite_a_newer_snapshot(self):
+        # Published while a cache miss was reading the database
+        store_balance(self.seller.id, {'credit': '80.00', 'last_seq': 3, 'updated_at': timezone.now().isoformat()})
+        stale = {'credit': '100.00', 'last_seq': 0, 'updated_at': timezone.now().isoformat()}
+        self.assertEqual(store_balance(self.seller.id, stale)['credit'], '80.00')
+        self.assertEqual(self.balance()['credit'], '80.00')
+
+
+class ChargeStatusTest(TestCase):
+    """
+    Verifies that accepted charges get an id that can be looked up and waited on.
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        user = User.objects.create(username="status_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Status Seller", credit=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=user).key}")
+
+    @override_settings(CHARGE_PROCESSING_MODE='task')
+    def test_accepted_charge_id_reports_the_task_outcome(self):
+        # Run the task inside the request, without a broker
+        self.addCleanup(celery_app.conf.update, CELERY_TASK_ALWAYS_EAGER=celery_app.conf.task_always_eager)
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '30.00'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        charge_id = response.data['charge_id']
+        self.assertTrue(Charge.objects.filter(pk=charge_id, status='completed').exists())
+
+        with self.assertNumQueries(0):
+            detail = self.client.get(f"/api/charge/{charge_id}/", {'wait': 5})
+        self.assertEqual(detail.status_code, 200)
+        self.assertEqual((detail.data['status'], detail.data['balance_after']), ('completed', '70.00'))
+
+    def test_structured_task_result(self):
+        result = process_charge_task(self.seller.id, '500.00', '09120000000', charge_id=str(uuid.uuid4()))
+        self.assertEqual((result['status'], result['error'], result['balance_after']), ('failed', 'Insufficient credit', None))
+        result = process_charge_task(0, '5.00', '09120000000')
+        self.assertEqual((result['status'], result['error']), ('failed', 'Seller not found'))
+
+    def test_long_poll_wakes_on_publish(self):
+        charge_id = uuid.uuid4()
+        remember_pending(self.seller.id, charge_id, Decimal('10.00'))
+        outcome = {'charge_id': str(charge_id), 'status': 'completed', 'amount': '10.00', 'balance_after': '90.00'}
+        publisher = threading.Timer(0.2, publish_charge_results, [self.seller.id, [outcome]])
+
+        started = time.monotonic()
+        publisher.start()
+        response = self.client.get(f"/api/charge/{charge_id}/", {'wait': 10})
+        publisher.join()
+        self.assertEqual(response.data['status'], 'completed')
+        self.assertLess(time.monotonic() - started, 5)
+
+    async def test_async_long_poll_wakes_on_publish(self):
+        charge_id = uuid.uuid4()
+        remember_pending(self.seller.id, charge_id, Decimal('10.00'))
+        outcome = {'charge_id': str(charge_id), 'status': 'completed', 'amount': '10.00', 'balance_after': '90.00'}
+        publisher = threading.Timer(0.2, publish_charge_results, [self.seller.id, [outcome]])
+        headers = {'Authorization': self.client._credentials['HTTP_AUTHORIZATION']}
+
+        started = time.monotonic()
+        publisher.start()
+        response = await self.async_client.get(f"/api/async/charge/{charge_id}/", {'wait': 10}, headers=headers)
+        publisher.join()
+        self.assertEqual(response.json()['status'], 'completed')
+        self.assertLess(time.monotonic() - started, 5)
+
+        response = await self.async_client.get(f"/api/async/charge/{uuid.uuid4()}/", headers=headers)
+        self.assertEqual(response.status_code, 404)
+        response = await self.async_client.get(f"/api/async/charge/{charge_id}/", {'wait': 'soon'}, headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_pending_timeout_other_sellers_and_bad_wait(self):
+        charge_id = uuid.uuid4()
+        remember_pending(self.seller.id, charge_id, Decimal('10.00'))
+        response = self.client.get(f"/api/charge/{charge_id}/", {'wait': 0.1})
+        self.assertEqual((response.status_code, response.data['status']), (200, 'pending'))
+        self.assertEqual(self.client.get(f"/api/charge/{charge_id}/", {'wait': 'soon'}).status_code, 400)
+
+        other = Seller.objects.create(user=User.objects.create(username="other_user"), name="Other")
+        remember_pending(other.id, uuid.uuid4(), Decimal('10.00'))
+        other_charge = Charge.objects.create(seller=other, phone_number='09120000000', amount=Decimal('1.00'))
+        self.assertEqual(self.client.get(f"/api/charge/{other_charge.pk}/").status_code, 404)
+        self.assertEqual(self.client.get(f"/api/charge/{uuid.uuid4()}/").status_code, 404)
+
+    def test_flush_publishes_each_outcome(self):
+        charges = [
+            Charge.objects.create(seller=self.seller, phone_number='09120000000', amount=Decimal(amount))
+            for amount in ('60.00', '60.00')
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            process_pending_charges(self.seller.id, limit=10)
+        with self.assertNumQueries(0):
+            statuses = [lookup_charge(self.seller.id, charge.pk)['status'] for charge in charges]
+        self.assertEqual(statuses, ['completed', 'failed'])
+
+
+class ChargeMetricsTest(TestCase):
+    """
+    Verifies that charge processing records its phases and outcomes and serves them at /metrics.
+    """
+
+    def setUp(self):
+        metrics.clear()
+        user = User.objects.create(username="metrics_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Metrics Seller", credit=Decimal('100.00'))
+
+    def test_task_records_phases_and_outcomes(self):
+        process_charge_task(self.seller.id, '60.00', '09120000000', enqueued_at=time.time() - 0.5)
+        process_charge_task(self.seller.id, '60.00', '09120000000')
+        process_charge_task(0, '1.00', '09120000000')
+
+        # the missing seller is only found out by the lock query
+        self.assertEqual(
+            [metrics.CHARGE_PHASE_SECONDS.count(phase=phase) for phase in ('queue_wait', 'lock', 'insert', 'commit')],
+            [1, 3, 2, 2]
+        )
+        self.assertEqual(
+            [metrics.CHARGES_TOTAL.value(outcome=outcome) for outcome in ('completed', 'insufficient_credit', 'seller_not_found')],
+            [1, 1, 1]
+        )
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('b2b_charges_total{outcome="completed"} 1\n', body)
+        self.assertIn('b2b_charge_phase_seconds_bucket{phase="queue_wait",le="+Inf"} 1\n', body)
+        self.assertIn('b2b_charge_phase_seconds_bucket{phase="queue_wait",le="0.25"} 0\n', body)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled_metrics_record_nothing(self):
+        process_charge_task(self.seller.id, '10.00', '09120000000', enqueued_at=time.time())
+        self.assertEqual(metrics.CHARGE_PHASE_SECONDS.count(phase='lock'), 0)
+        self.assertEqual(metrics.CHARGES_TOTAL.value(outcome='completed'), 0)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class ChargeQueueRoutingTest(TestCase):
+    """
+    Verifies that seller charge tasks are routed to a stable per-seller queue.
+    """
+
+    def queue_of(self, task, *args, **kwargs):
+        options = celery_app.amqp.router.route({}, task.name, args, kwargs, task_type=task)
+        return options['queue'].name
+
+    @override_settings(CHARGE_QUEUE_COUNT=4)
+    def test_seller_tasks_share_a_queue(self):
+        queue = self.queue_of(process_charge_task, seller_id=7, amount_str='1.00', phone_number='0912')
+        self.assertRegex(queue, r'^charges\.[0-3]$')
+        self.assertEqual(self.queue_of(flush_pending_charges_task, 7), queue)
+        # Sharded sellers debit shards in parallel, so their charges stay on the default queue
+        self.assertEqual(self.queue_of(process_sharded_charge_task, seller_id=7), 'celery')
+
+        queues = {self.queue_of(process_charge_task, seller_id=seller_id) for seller_id in range(100)}
+        self.assertEqual(queues, {f'charges.{i}' for i in range(4)})
+
+    @override_settings(CHARGE_QUEUE_COUNT=0)
+    def test_disabled_routing_uses_the_default_queue(self):
+        self.assertEqual(self.queue_of(process_charge_task, seller_id=7), 'celery')
+
+    def test_adding_a_queue_moves_few_sellers(self):
+        before = HashRing([f'charges.{i}' for i in range(4)])
+        after = HashRing([f'charges.{i}' for i in range(5)])
+        moved = sum(before.get(seller_id) != after.get(seller_id) for seller_id in range(10000))
+        # about a fifth of the sellers move to the new queue, none between the old ones
+        self.assertLess(moved, 3000)
+        self.assertTrue(all(
+            after.get(seller_id) == 'charges.4'
+            for seller_id in range(10000) if before.get(seller_id) != after.get(seller_id)
+        ))
+
+
+class ChargeOutboxTest(TestCase):
+    """
+    Verifies that outbox charges are stored by the request and relayed to the workers at least once.
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        user = User.objects.create(username="outbox_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Outbox Seller", credit=Decimal('100.00'))
+        other = User.objects.create(username="outbox_other", password="password")
+        self.other = Seller.objects.create(user=other, name="Outbox Other", credit=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=user).key}")
+        self.published = []
+
+    def publish(self, batches):
+        self.published.extend(batches)
+
+    def charge(self, seller, amount):
+        return str(enqueue_outbox_charge(seller.id, Decimal(amount), '09120000000').pk)
+
+    @override_settings(CHARGE_PROCESSING_MODE='outbox')
+    def test_charge_request_only_stores_the_charge(self):
+        # The test broker is unreachable, so a publish from the request would fail it
+        response = self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '30.00'})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.data['status'], response.data['balance_after']), ('pending', None))
+        charge = Charge.objects.get(pk=response.data['charge_id'])
+        self.assertEqual((charge.status, charge.dispatched_at), ('pending', None))
+        self.assertEqual(self.client.get(f"/api/charge/{charge.pk}/").data['status'], 'pending')
+
+    def test_relay_publishes_one_batch_per_seller(self):
+        first, second = self.charge(self.seller, '10.00'), self.charge(self.seller, '20.00')
+        other = self.charge(self.other, '5.00')
+        self.assertEqual(relay_charge_outbox(publisher=self.publish), 3)
+        self.assertEqual(self.published, [(self.seller.id, [first, second]), (self.other.id, [other])])
+        self.assertFalse(Charge.objects.filter(dispatched_at__isnull=True).exists())
+        # Dispatched charges are not published again until they are overdue
+        self.assertEqual(relay_charge_outbox(publisher=self.publish), 0)
+
+        Charge.objects.filter(pk=first).update(dispatched_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(relay_charge_outbox(publisher=self.publish), 1)
+        self.assertEqual(self.published[-1], (self.seller.id, [first]))
+
+    def test_failed_publish_keeps_charges_in_the_outbox(self):
+        charge_id = self.charge(self.seller, '10.00')
+
+        def broker_down(batches):
+            raise ConnectionError("broker unavailable")
+
+        with self.assertRaises(ConnectionError):
+            relay_charge_outbox(publisher=broker_down)
+        self.assertIsNone(Charge.objects.get(pk=charge_id).dispatched_at)
+        self.assertEqual(relay_charge_outbox(publisher=self.publish), 1)
+        self.assertEqual(self.published, [(self.seller.id, [charge_id])])
+
+    def test_redelivered_batch_settles_once(self):
+        charge_ids = [self.charge(self.seller, amount) for amount in ('60.00', '30.00', '20.00')]
+        with self.captureOnCommitCallbacks(execute=True):
+            result = settle_outbox_charges_task(self.seller.id, charge_ids)
+        self.assertEqual(result, f"Settled 3 of 3 outbox charges for seller {self.seller.id}.")
+        result = settle_outbox_charges_task(self.seller.id, charge_ids)
+        self.assertEqual(result, f"Settled 0 of 3 outbox charges for seller {self.seller.id}.")
+
+        self.seller.refresh_from_db()
+        self.assertEqual((self.seller.credit, self.seller.ledger_seq), (Decimal('10.00'), 2))
+        self.assertEqual(
+            [Charge.objects.get(pk=charge_id).status for charge_id in charge_ids], ['completed', 'completed', 'failed']
+        )
+        self.assertEqual(lookup_charge(self.seller.id, charge_ids[2])['status'], 'failed')
+
+    @override_settings(CHARGE_PROCESSING_MODE='outbox')
+    def test_relay_settles_through_the_workers(self):
+        self.addCleanup(celery_app.conf.update, CELERY_TASK_ALWAYS_EAGER=celery_app.conf.task_always_eager)
+        celery_app.conf.update(CELERY_TASK_ALWAYS_EAGER=True)
+        enable_credit_sharding(self.other.id, 2)
+        response = self.client.post('/api/charge/', {'phone_number': '09120000000', 'amount': '30.00'})
+        sharded = self.charge(self.other, '40.00')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(relay_charge_outbox(), 2)
+        detail = self.client.get(f"/api/charge/{response.data['charge_id']}/")
+        self.assertEqual((detail.data['status'], detail.data['balance_after']), ('completed', None))
+        self.assertEqual(Charge.objects.get(pk=sharded).status, 'completed')
+        self.seller.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.seller.credit, self.other.live_credit), (Decimal('70.00'), Decimal('60.00')))
+
+
+class RateLimitTest(TestCase):
+    """
+    Verifies the per-seller admission limits of the charge and credit request endpoints.
+    """
+
+    def setUp(self):
+        cache.clear()
+        local_tokens.clear()
+        metrics.clear()
+        user = User.objects.create(username="limited_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Limited Seller", credit=Decimal('100.00'))
+        self.client = self.client_for(Token.objects.create(user=user))
+
+    def client_for(self, token):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        return client
+
+    def charge(self, client=None, **headers):
+        return (client or self.client).post(
+            '/api/charge/', {'phone_number': '09120000000', 'amount': '1.00'}, headers=headers
+        )
+
+    @override_settings(CHARGE_PROCESSING_MODE='sync', CHARGE_RATE_LIMIT=60, CHARGE_RATE_BURST=2)
+    def test_seller_over_its_rate_gets_429(self):
+        self.assertEqual([self.charge().status_code for _ in range(2)], [201, 201])
+        response = self.charge()
+        self.assertEqual(response.status_code, 429)
+        # one charge per second refills the bucket
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(RATE_LIMITED_TOTAL.value(scope='charge', limit='rate'), 1)
+
+        # Other sellers have their own bucket
+        other = User.objects.create(username="other_limited", password="password")
+        Seller.objects.create(user=other, name="Other Seller", credit=Decimal('10.00'))
+        self.assertEqual(self.charge(self.client_for(Token.objects.create(user=other))).status_code, 201)
+
+    @override_settings(CHARGE_PROCESSING_MODE='sync', CHARGE_RATE_LIMIT=60, CHARGE_RATE_BURST=1)
+    def test_admin_limits_override_the_settings(self):
+        self.assertEqual([self.charge().status_code for _ in range(2)], [201, 429])
+
+        # Saving the seller, as the admin does, drops its cached token identity
+        self.seller.refresh_from_db()
+        self.seller.charge_rate_limit = 0
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seller.save()
+        self.assertEqual([self.charge().status_code for _ in range(3)], [201, 201, 201])
+
+        self.seller.refresh_from_db()
+        self.seller.charge_rate_limit, self.seller.charge_rate_burst = 60, 3
+        with self.captureOnCommitCallbacks(execute=True):
+            self.seller.save()
+        cache.clear()
+        self.assertEqual([self.charge().status_code for _ in range(4)], [201, 201, 201, 429])
+
+    @override_settings(CHARGE_PROCESSING_MODE='outbox', MAX_INFLIGHT_CHARGES=2, INFLIGHT_RETRY_AFTER=3)
+    def test_inflight_cap_until_charges_settle(self):
+        accepted = [self.charge(HTTP_IDEMPOTENCY_KEY=f"key-{i}") for i in range(2)]
+        self.assertEqual([response.status_code for response in accepted], [202, 202])
+        response = self.charge(HTTP_IDEMPOTENCY_KEY='key-2')
+        self.assertEqual((response.status_code, response['Retry-After']), (429, '3'))
+        # a refused key was not used up
+        self.assertFalse(Charge.objects.filter(idempotency_key='key-2').exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            settle_outbox_charges_task(self.seller.id, [accepted[0].data['charge_id']])
+        self.assertEqual(self.charge(HTTP_IDEMPOTENCY_KEY='key-2').status_code, 202)
+        self.assertEqual(self.charge().status_code, 429)
+        self.assertEqual(RATE_LIMITED_TOTAL.value(scope='charge', limit='inflight'), 2)
+
+    @override_settings(CREDIT_REQUEST_RATE_LIMIT=1, CREDIT_REQUEST_RATE_BURST=1)
+    def test_credit_requests_are_limited(self):
+        self.assertEqual(self.client.post('/api/credit-request/', {'amount': '5.00'}).status_code, 201)
+        response = self.client.post('/api/credit-request/', {'amount': '5.00'})
+        self.assertEqual((response.status_code, response['Retry-After']), (429, '60'))
+        self.assertEqual(CreditRequest.objects.count(), 1)
+
+    @override_settings(CHARGE_PROCESSING_MODE='sync', CHARGE_RATE_LIMIT=60, CHARGE_RATE_BURST=1)
+    async def test_async_views_share_the_limits(self):
+        headers = {'Authorization': f"Token {(await Token.objects.aget(user__seller=self.seller)).key}"}
+        body = {'phone_number': '09120000000', 'amount': '1.00'}
+        response = await self.async_client.post(
+            '/api/async/charge/', body, content_type='application/json', headers=headers
+        )
+        self.assertEqual(response.status_code, 201)
+        response = await self.async_client.post(
+            '/api/async/charge/', body, content_type='application/json', headers=headers
+        )
+        self.assertEqual((response.status_code, response['Retry-After']), (429, '1'))
+
+    @override_settings(RATE_LIMIT_ENABLED=False, CHARGE_PROCESSING_MODE='sync', CHARGE_RATE_BURST=1)
+    def test_disabled(self):
+        self.assertEqual([self.charge().status_code for _ in range(3)], [201, 201, 201])
+
+
+class SellerAdminTest(TestCase):
+    """
+    Verifies that the Seller admin cannot write the ledger's columns.
+    """
+
+    def setUp(self):
+        admin_user = User.objects.create_superuser(username="seller_admin", password="password")
+        self.client.force_login(admin_user)
+        user = User.objects.create(username="edited_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Edited Seller", credit=Decimal('100.00'))
+        self.url = f'/admin/B2B_shop/seller/{self.seller.pk}/change/'
+
+    def form_data(self, **fields):
+        return {
+            'user': self.seller.user_id, 'name': self.seller.name, 'parent': '',
+            'charge_rate_limit': '', 'charge_rate_burst': '', 'max_inflight_charges': '',
+            'credit_request_rate_limit': '',
+            'credit_shards-TOTAL_FORMS': 0, 'credit_shards-INITIAL_FORMS': 0,
+            **fields
+        }
+
+    def test_ledger_seq_is_read_only(self):
+        charge_now(self.seller.id, Decimal('10.00'), '09120000000')
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'name="ledger_seq"')
+
+        # A forged value is ignored, only the ledger moves the sequence
+        response = self.client.post(self.url, self.form_data(ledger_seq=99, credit='500.00'))
+        self.assertEqual(response.status_code, 302)
+        self.seller.refresh_from_db()
+        self.assertEqual((self.seller.credit, self.seller.ledger_seq), (Decimal('90.00'), 1))
+        _, balance_after = charge_now(self.seller.id, Decimal('10.00'), '09120000000')
+        self.assertEqual(balance_after, Decimal('80.00'))
+        self.assertEqual(list(self.seller.transactions.values_list('seq', flat=True).order_by('seq')), [1, 2])
+
+    def test_edit_keeps_concurrent_charges(self):
+        seller_admin = admin.site.get_model_admin(Seller)
+        loaded = Seller.objects.get(pk=self.seller.pk)
+        charge_now(self.seller.id, Decimal('10.00'), '09120000000')
+
+        loaded.charge_rate_limit = 30
+        with self.captureOnCommitCallbacks(execute=True):
+            seller_admin.save_model(None, loaded, None, change=True)
+        self.seller.refresh_from_db()
+        self.assertEqual(
+            (self.seller.credit, self.seller.ledger_seq, self.seller.charge_rate_limit), (Decimal('90.00'), 1, 30)
+        )
+        _, balance_after = charge_now(self.seller.id, Decimal('10.00'), '09120000000')
+        self.assertEqual(balance_after, Decimal('80.00'))
+
+
+class LedgerRollupTest(TestCase):
+    """
+    Verifies that statements built from daily rollups match the raw transaction log.
+    """
+
+    def setUp(self):
+        user = User.objects.create(username="rollup_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Rollup Seller", credit=Decimal('100.00'))
+        self.client = APIClient()
+        self.client.force_authenticate(user=user)
+
+        self.log('2024-01-01T10:00:00Z', 'charge_sale', '-10.00')
+        self.log('2024-01-01T11:00:00Z', 'add_credit', '50.00')
+        self.log('2024-01-01T12:00:00Z', 'charge_sale', '-10.00')
+        self.log('2024-01-02T09:00:00Z', 'charge_sale', '-5.00')
+        self.log('2024-01-03T09:00:00Z', 'charge_sale', '-1.00')
+
+    def log(self, created_at, transaction_type, amount):
+        amount = Decimal(amount)
+        self.seller.credit += amount
+        self.seller.ledger_seq += 1
+        log = TransactionLog.objects.create(
+            seller=self.seller, transaction_type=transaction_type, amount=amount,
+            balance_after=self.seller.credit, seq=self.seller.ledger_seq
+        )
+        TransactionLog.objects.filter(pk=log.pk).update(created_at=created_at)
+
+    def statement(self):
+        return seller_statement(self.seller.id, datetime.date(2024, 1, 1), datetime.date(2024, 1, 3))
+
+    def test_rollups_match_raw_log(self):
+        raw = self.statement()
+        self.assertEqual((raw['opening_balance'], raw['closing_balance']), ('100.00', '124.00'))
+        self.assertEqual(raw['totals']['charge_sale'], {'amount': '-26.00', 'count': 4})
+
+        now = datetime.datetime(2024, 1, 3, 12, tzinfo=datetime.timezone.utc)
+        self.assertEqual(refresh_ledger_rollups(now), 3)
+        self.assertEqual(refresh_ledger_rollups(now), 0)
+        day = LedgerRollup.objects.get(seller=self.seller, day='2024-01-01', transaction_type='charge_sale')
+        self.assertEqual(
+            (day.amount, day.entry_count, day.opening_balance, day.closing_balance),
+            (Decimal('-20.00'), 2, Decimal('100.00'), Decimal('130.00'))
+        )
+
+        # only the day that has not been rolled up is read from the log
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.statement(), raw)
+        log_queries = [q['sql'] for q in queries.captured_queries if 'transactionlog' in q['sql']]
+        self.assertEqual(len(log_queries), 1)
+
+        # the next day continues from the rolled up closing balance
+        self.log('2024-01-04T09:00:00Z', 'charge_sale', '-4.00')
+        refresh_ledger_rollups(now + datetime.timedelta(days=1))
+        self.assertEqual(LedgerRollup.objects.get(day='2024-01-03').opening_balance, Decimal('125.00'))
+        self.assertEqual(LedgerRollupState.objects.get().rolled_up_until.date(), datetime.date(2024, 1, 4))
+
+    def test_sharded_seller_statement_sums_the_chains(self):
+        self.seller.save(update_fields=['credit', 'ledger_seq'])
+        enable_credit_sharding(self.seller.id, 4)
+        TransactionLog.objects.filter(seller=self.seller, transaction_type='shard_rebalance') \
+            .update(created_at='2024-01-03T10:00:00Z')
+        charge_sharded_seller(self.seller.id, Decimal('5.00'), '09120000000')
+        today = timezone.localdate()
+
+        # Each shard holds 31.00 of the 124.00; the day's only entry is on one of them
+        statement = seller_statement(self.seller.id, today, today)
+        self.assertEqual((statement['opening_balance'], statement['closing_balance']), ('124.00', '119.00'))
+
+        refresh_ledger_rollups(day_start(today) + datetime.timedelta(hours=1))
+        self.assertEqual(LedgerRollup.objects.get(day='2024-01-03', transaction_type='shard_rebalance').closing_balance,
+                         Decimal('124.00'))
+        self.assertEqual(seller_statement(self.seller.id, today, today), statement)
+
+    def test_statement_endpoint(self):
+        response = self.client.get('/api/statement/', {'start_date': '2024-01-02', 'end_date': '2024-01-03'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['opening_balance'], '130.00')
+        self.assertEqual([row['day'] for row in response.data['days']], ['2024-01-02', '2024-01-03'])
+
+        self.assertEqual(self.client.get('/api/statement/', {'start_date': 'yesterday'}).status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/statement/', {'start_date': '2024-01-03', 'end_date': '2024-01-01'}).status_code,
+            400
+        )
+
+
+@override_settings(RECONCILIATION_CHUNK_SIZE=2)
+class LedgerReconciliationTest(TestCase):
+    """
+    Verifies that reconciliation follows the balance_after chains incrementally
+    and reports broken links, gaps and tails.
+    """
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create(username="reconcile_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Reconcile Seller", credit=Decimal('100.00'))
+
+    def charge(self, count=1):
+        for _ in range(count):
+            charge_now(self.seller.id, Decimal('3.00'), '09120000000')
+
+    def test_incremental_runs(self):
+        self.charge(5)
+        CreditRequest.objects.create(seller=self.seller, amount=Decimal('20.00'))
+        approve_credit_requests(CreditRequest.objects.values_list('pk', flat=True))
+
+        result = reconcile_seller(self.seller.id)
+        self.assertEqual((result.verified, result.error), (6, None))
+        checkpoint = ReconciliationCheckpoint.objects.get(seller=self.seller)
+        self.assertEqual(checkpoint.entry_count, 6)
+        self.assertEqual((checkpoint.sequences, checkpoint.balances), ({'main': 6}, {'main': '105.00'}))
+
+        self.charge()
+        result = reconcile_seller(self.seller.id)
+        self.assertEqual((result.verified, result.error), (1, None))
+        self.assertEqual(ReconciliationCheckpoint.objects.get(seller=self.seller).entry_count, 7)
+
+    def test_live_balance_mismatch(self):
+        self.charge(3)
+        Seller.objects.filter(pk=self.seller.pk).update(credit=F('credit') + 1)
+        self.assertIn("live balance is 92.00", reconcile_seller(self.seller.id).error)
+
+    def test_broken_link_is_reported(self):
+        self.charge(4)
+        broken = TransactionLog.objects.get(seller=self.seller, seq=3)
+        TransactionLog.objects.filter(pk=broken.pk).update(balance_after=F('balance_after') + 1)
+
+        result = reconcile_seller(self.seller.id)
+        self.assertIn(str(broken.unique_id), result.error)
+        checkpoint = ReconciliationCheckpoint.objects.get(seller=self.seller)
+        self.assertEqual((checkpoint.status, checkpoint.entry_count), ('mismatch', 2))
+
+        with self.assertRaises(CommandError):
+            call_command('reconcile_ledger', seller=[self.seller.id], stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_missing_entry_is_reported(self):
+        self.charge(4)
+        TransactionLog.objects.filter(seller=self.seller, seq=4).delete()
+        self.assertEqual(reconcile_seller(self.seller.id).error, "chain 'main' ends at seq 3 but 4 were issued")
+
+        # re-verified from scratch, the gap shows before the tail
+        TransactionLog.objects.filter(seller=self.seller, seq=2).delete()
+        with self.assertRaises(CommandError):
+            call_command('reconcile_ledger', full=True, seller=[self.seller.id], stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(
+            ReconciliationCheckpoint.objects.get(seller=self.seller).error, "chain 'main' is missing seq 2"
+        )
+
+    def test_sharded_chains(self):
+        self.charge()
+        enable_credit_sharding(self.seller.id, 3)
+        for _ in range(3):
+            charge_sharded_seller(self.seller.id, Decimal('2.00'), '09120000000')
+        CreditRequest.objects.create(seller=self.seller, amount=Decimal('5.00'))
+        approve_credit_requests(CreditRequest.objects.values_list('pk', flat=True))
+        rebalance_credit_shards(self.seller.id)
+
+        result = reconcile_seller(self.seller.id)
+        self.assertIsNone(result.error)
+        self.assertEqual(result.verified, TransactionLog.objects.filter(seller=self.seller).count())
+
+        SellerCreditShard.objects.filter(seller=self.seller, index=0).update(credit=F('credit') - 1)
+        self.assertIn("chain '0'", reconcile_seller(self.seller.id).error)
+
+
+@skipUnless(connection.vendor == 'postgresql', "table partitioning needs PostgreSQL")
+class PartitioningTest(TestCase):
+    """
+    Verifies the monthly partitions of the transaction log and charges:
+    pruning of date filtered queries, creating partitions and archiving old ones.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Migrations leave the tables unpartitioned; the conversion is undone with the class
+        call_command('partition_tables', stdout=io.StringIO())
+
+    def setUp(self):
+        user = User.objects.create(username="partition_user", password="password")
+        self.seller = Seller.objects.create(user=user, name="Partition Seller", credit=Decimal('100.00'))
+
+    def log_entry(self, created_at, seq=1):
+        log = TransactionLog.objects.create(
+            seller=self.seller, transaction_type='add_credit', amount=Decimal('5.00'),
+            balance_after=Decimal('105.00'), seq=seq
+        )
+        TransactionLog.objects.filter(pk=log.pk).update(created_at=created_at)
+        return log
+
+    def rows_in(self, relation):
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {connection.ops.quote_name(relation)}")
+            return cursor.fetchone()[0]
+
+    def test_new_rows_land_in_the_current_month(self):
+        with connection.cursor() as cursor:
+            self.assertTrue(is_partitioned(cursor, TransactionLog))
+            self.assertTrue(is_partitioned(cursor, Charge))
+        out = io.StringIO()
+        call_command('partition_tables', stdout=out)
+        self.assertIn("B2B_shop_charge is partitioned already", out.getvalue())
+        charge_now(self.seller.id, Decimal('10.00'), '09120000000')
+
+        month = month_start(timezone.localdate())
+        self.assertEqual(self.rows_in(partition_name(TransactionLog, month)), 1)
+        self.assertEqual(self.rows_in(partition_name(Charge, month)), 1)
+
+    def test_idempotency_keys_are_unique_across_months(self):
+        charge, _ = charge_now(self.seller.id, Decimal('10.00'), '09120000000', idempotency_key='key-1')
+        # Moved to another partition, whose own unique index knows nothing of later months
+        Charge.objects.filter(pk=charge.pk).update(created_at=datetime.datetime(2020, 3, 15, tzinfo=datetime.timezone.utc))
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            charge_now(self.seller.id, Decimal('10.00'), '09120000000', idempotency_key='key-1')
+        self.assertEqual(Charge.objects.filter(seller=self.seller).count(), 1)
+        data, _ = idempotency.replay(self.seller.id, 'key-1')
+        self.assertEqual(data['charge_id'], str(charge.unique_id))
+
+    def test_seq_repeated_across_months_is_reported(self):
+        self.log_entry(datetime.datetime(2020, 3, 15, tzinfo=datetime.timezone.utc))
+        # Only unique within a month: the repeat is for reconciliation to find
+        self.log_entry(timezone.now())
+        self.assertEqual(TransactionLog.objects.filter(seller=self.seller, seq=1).count(), 2)
+        self.assertEqual(reconcile_seller(self.seller.id).error, "chain 'main' is missing seq 2")
+
+    def test_date_filtered_history_touches_one_partition(self):
+        today = timezone.localdate()
+        transactions = seller_transactions(self.seller, {
+            'start_date': f"{today.replace(day=1)}T00:00:00Z", 'end_date': f"{today}T23:59:59Z",
+        })
+        plan = keyset_page(transactions, None, 100).explain()
+        scanned = set(re.findall(r'on "?(B2B_shop_transactionlog_\w+?)"? ', plan))
+        self.assertEqual(scanned, {partition_name(TransactionLog, month_start(today))}, plan)
+
+    def test_creating_a_partition_moves_default_rows(self):
+        log = self.log_entry(datetime.datetime(2020, 3, 15, tzinfo=datetime.timezone.utc))
+        self.assertEqual(self.rows_in('B2B_shop_transactionlog_default'), 1)
+
+        created = ensure_partitions(months_ahead=0, today=datetime.date(2020, 3, 5))
+        self.assertEqual(created, ['B2B_shop_transactionlog_p202003', 'B2B_shop_charge_p202003'])
+        self.assertEqual(self.rows_in('B2B_shop_transactionlog_default'), 0)
+        self.assertEqual(self.rows_in('B2B_shop_transactionlog_p202003'), 1)
+        self.assertTrue(TransactionLog.objects.filter(pk=log.pk).exists())
+        self.assertEqual(ensure_partitions(months_ahead=0, today=datetime.date(2020, 3, 5)), [])
+
+    def test_archive_old_partitions(self):
+        log = self.log_entry(datetime.datetime(2020, 3, 15, tzinfo=datetime.timezone.utc))
+        ensure_partitions(months_ahead=0, today=datetime.date(2020, 3, 5))
+        self.assertEqual(archive_blockers(TransactionLog, datetime.date(2020, 3, 1)), "not rolled up yet")
+
+        LedgerRollupState.objects.create(pk=1, rolled_up_until=timezone.now())
+        self.assertEqual(archive_blockers(TransactionLog, datetime.date(2020, 3, 1)), "not reconciled yet")
+        ReconciliationCheckpoint.objects.create(seller=self.seller, checked_at=timezone.now())
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            out = io.StringIO()
+            call_command('manage_partitions', retain=1, archive_dir=archive_dir, stdout=out, stderr=io.StringIO())
+            self.assertIn("Archived B2B_shop_transactionlog_p202003", out.getvalue())
+            self.assertIn("Archived B2B_shop_charge_p202003", out.getvalue())
+
+            with gzip.open(os.path.join(archive_dir, 'B2B_shop_transactionlog_p202003.csv.gz'), 'rt') as f:
+                header, row = f.read().splitlines()
+            self.assertTrue(header.startswith('unique_id,'))
+            self.assertTrue(row.startswith(str(log.pk)))
+        self.assertFalse(TransactionLog.objects.filter(pk=log.pk).exists())
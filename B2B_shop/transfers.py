@@ -0,0 +1,117 @@
+from collections import namedtuple
+
+from django.db import IntegrityError
+from rest_framework import status
+
+from . import idempotency
+from .ledger import Posting, apply_postings, retry_on_conflict
+from .models import CreditTransfer
+
+# The transfers written, and the sender's balance after them (of the debited shard for
+# sharded senders); `transfers` is empty and `balance_after` None if the credit fell short.
+# Transfers replayed from the database have no balance_after either.
+TransferResult = namedtuple('TransferResult', 'transfers balance_after')
+
+
+@retry_on_conflict
+def transfer_credit(sender_id, transfers, idempotency_key=None):
+    """
+    Moves credit from a distributor to its sub-resellers: `transfers` are
+    (recipient_id, amount) pairs, one for a single transfer or many for a fan-out.
+    The ledger posts a transfer_out entry for each of them on the sender and a
+    transfer_in entry on the recipient, all or none, in one transaction that locks
+    the sellers in primary key order. Opposite transfers between two sellers
+    therefore queue up rather than deadlock.
+    The recipients must have been checked to be the sender's sub-resellers.
+    With an `idempotency_key`, a second request with the key raises IntegrityError.
+    """
+    postings = []
+    for recipient_id, amount in transfers:
+        postings.append(Posting(sender_id, -amount, 'transfer_out'))
+        postings.append(Posting(recipient_id, amount, 'transfer_in'))
+
+    posted = apply_postings(postings, all_or_nothing=True)
+    if not posted.applied:
+        return TransferResult([], None)
+
+    transfers = CreditTransfer.objects.bulk_create([
+        CreditTransfer(
+            sender_id=sender_id, recipient_id=recipient_id, amount=amount,
+            idempotency_key=idempotency_key, line=line
+        )
+        for line, (recipient_id, amount) in enumerate(transfers, start=1)
+    ])
+    balance_after = [log.balance_after for log in posted.logs if log.seller_id == sender_id][-1]
+    return TransferResult(transfers, balance_after)
+
+
+def transfer_result(result):
+    """
+    Response data describing the outcome of transfer_credit().
+    """
+    if not result.transfers:
+        return {"status": "failed", "error": "Insufficient credit, or a recipient's credit would overflow"}
+    return {
+        "status": "completed",
+        "transfers": [
+            {
+                "transfer_id": str(transfer.unique_id),
+                "to_seller": transfer.recipient_id,
+                "amount": str(transfer.amount),
+            }
+            for transfer in result.transfers
+        ],
+        "total_amount": str(sum(transfer.amount for transfer in result.transfers)),
+        "balance_after": str(result.balance_after) if result.balance_after is not None else None,
+    }
+
+
+def _transfer(sender_id, transfers, idempotency_key=None):
+    result = transfer_credit(sender_id, transfers, idempotency_key)
+    return transfer_result(result), status.HTTP_201_CREATED if result.transfers else status.HTTP_400_BAD_REQUEST
+
+
+def replay_transfer(sender_id, key):
+    """
+    The outcome of an earlier transfer request with this key, or None if the key is new.
+    Completed transfers outlive the cache entry; a failed request is only remembered
+    while it is cached, as it moved no credit.
+    """
+    cached = idempotency.cached_result(sender_id, key, scope='transfer')
+    if cached is not None:
+        return cached
+    transfers = list(CreditTransfer.objects.filter(sender_id=sender_id, idempotency_key=key).order_by('line'))
+    if not transfers:
+        return None
+    result = transfer_result(TransferResult(transfers, None)), status.HTTP_201_CREATED
+    idempotency.remember(sender_id, key, result, scope='transfer')
+    return result
+
+
+def submit_transfer(sender_id, transfers, idempotency_key=None):
+    """
+    Runs transfer_credit() for the transfer endpoint; returns (response data, HTTP status).
+    A request repeating an Idempotency-Key gets the original outcome back without moving
+    credit again, the way submit_charge() handles charges.
+    """
+    if idempotency_key is None:
+        return _transfer(sender_id, transfers)
+
+    result = replay_transfer(sender_id, idempotency_key)
+    if result is not None:
+        return result
+    if not idempotency.reserve(sender_id, idempotency_key, scope='transfer'):
+        return idempotency.IN_PROGRESS_RESPONSE
+
+    try:
+        result = _transfer(sender_id, transfers, idempotency_key)
+    except IntegrityError:
+        # The unique constraint caught transfers stored earlier with this key
+        idempotency.release(sender_id, idempotency_key, scope='transfer')
+        return replay_transfer(sender_id, idempotency_key) or idempotency.IN_PROGRESS_RESPONSE
+    except Exception:
+        idempotency.release(sender_id, idempotency_key, scope='transfer')
+        raise
+
+    idempotency.remember(sender_id, idempotency_key, result, scope='transfer')
+    return result
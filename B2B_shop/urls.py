@@ -1,9 +1,24 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 urlpatterns = [
     path('create/', views.CreateSellerAPIView.as_view(), name='charge_api'),
     path('credit-request/', views.CreditRequestAPIView.as_view(), name='charge_api'),
     path('transactions/', views.TransactionsAPIView.as_view(), name='charge_api'),
+    path('statement/', views.StatementAPIView.as_view(), name='statement_api'),
+    path('balance/', views.BalanceAPIView.as_view(), name='balance_api'),
     path('charge/', views.ChargeAPIView.as_view(), name='charge_api'),
+    path('charge/<uuid:charge_id>/', views.ChargeDetailAPIView.as_view(), name='charge_detail_api'),
+    path('charge/batch/', views.ChargeBatchAPIView.as_view(), name='charge_batch_api'),
+    path('charge/batch/<uuid:batch_id>/', views.ChargeBatchDetailAPIView.as_view(), name='charge_batch_detail_api'),
+    path('transfer/', views.TransferAPIView.as_view(), name='transfer_api'),
+
+    # Async-native versions of the seller endpoints, for the ASGI deployment
+    path('async/credit-request/', async_views.AsyncCreditRequestView.as_view(), name='async_credit_request_api'),
+    path('async/transactions/', async_views.AsyncTransactionsView.as_view(), name='async_transactions_api'),
+    path('async/charge/', async_views.AsyncChargeView.as_view(), name='async_charge_api'),
+    path(
+        'async/charge/<uuid:charge_id>/', async_views.AsyncChargeDetailView.as_view(),
+        name='async_charge_detail_api'
+    ),
 ]
\ No newline at end of file
@@ -1,18 +1,37 @@
-from django.db import transaction, IntegrityError
+import csv
+import io
+
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from rest_framework.authentication import TokenAuthentication
+from rest_framework.permissions import IsAuthenticated
+from .authentication import CachedTokenAuthentication
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
-from .models import Seller, TransactionLog, CreditRequest
+from .models import Seller, ChargeBatch
 from .serializers import (
-    ChargeSerializer, CreateSellerSerializer, SellerSerializer,
-    CreditRequestSerializer, TransactionLogSerializer
+    ChargeSerializer, ChargeBatchSerializer, CreateSellerSerializer, SellerSerializer,
+    CreditRequestSerializer, TransactionLogSerializer, TransferBatchSerializer
+)
+from .charging import submit_charge, submit_charge_batch, charge_batch_result
+from . import idempotency, metrics
+from .idempotency import IDEMPOTENCY_KEY_HEADER
+from .rollups import seller_statement
+from .balances import seller_balance
+from .charge_status import parse_wait, wait_for_charge
+from .ratelimit import SellerRateThrottle
+from .transfers import submit_transfer
+from .auto_approval import submit_credit_request
+from .history import (
+    EXPORT_CONTENT_TYPES, seller_transactions, parse_page_size, keyset_page, split_page, stream_export,
+    astream_export
 )
-from .tasks import process_charge_task
 
 
 class CreateSellerAPIView(APIView):
@@ -41,10 +60,13 @@ class CreateSellerAPIView(APIView):
         
 class CreditRequestAPIView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
+    throttle_classes = [SellerRateThrottle]
+    throttle_scope = 'credit_request'
     
     @swagger_auto_schema(
-        operation_description="Create a new credit request",
+        operation_description="Create a new credit request. It is approved at once if the seller's "
+                              "approval rule allows it, otherwise it stays pending for an admin.",
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
             required=['amount'],
@@ -59,7 +81,8 @@ class CreditRequestAPIView(APIView):
         responses={
             201: CreditRequestSerializer,
             400: "Bad Request - Invalid amount",
-            401: "Authentication credentials were not provided"
+            401: "Authentication credentials were not provided",
+            429: "Over the seller's credit request rate; retry after the Retry-After seconds"
         },
         operation_summary="Create Credit Request",
         tags=['credit']
@@ -77,9 +100,9 @@ class CreditRequestAPIView(APIView):
                 )
             if serializer.is_valid():
                 try:
-                    with transaction.atomic():
-                        credit_request = serializer.save(seller=seller)
-                    return Response(serializer.data, status=status.HTTP_201_CREATED)
+                    # Approved right away if the seller's approval rule allows it
+                    credit_request = submit_credit_request(seller, serializer.validated_data['amount'])
+                    return Response(CreditRequestSerializer(credit_request).data, status=status.HTTP_201_CREATED)
                 except IntegrityError as e:
                     return Response(
                         {"error": str(e)},
@@ -95,12 +118,27 @@ class CreditRequestAPIView(APIView):
 
 class TransactionsAPIView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
 
     @swagger_auto_schema(
-        operation_description="Get transaction history",
+        operation_description="Get transaction history, oldest first, one page at a time. "
+                              "Pass the returned next_cursor to fetch the following page, "
+                              "or set export to stream the whole (filtered) history. Entries are "
+                              "ordered by when they were written, so one committing late can land "
+                              "on a page already read: set end_date a few seconds back to page "
+                              "through settled history.",
         responses={
-            200: TransactionLogSerializer(many=True),
+            200: openapi.Response(
+                description="A page of transactions",
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        'results': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_OBJECT)),
+                        'next_cursor': openapi.Schema(type=openapi.TYPE_STRING, x_nullable=True),
+                    }
+                )
+            ),
+            400: "Bad Request - Invalid cursor, page_size or export format",
             401: "Authentication credentials were not provided or are invalid"
         },
         operation_summary="List Transactions",
@@ -118,49 +156,210 @@ class TransactionsAPIView(APIView):
                 description="End date for filtering (YYYY-MM-DD)",
                 type=openapi.TYPE_STRING,
                 required=False
+            ),
+            openapi.Parameter(
+                'cursor',
+                openapi.IN_QUERY,
+                description="next_cursor of the previous page",
+                type=openapi.TYPE_STRING,
+                required=False
+            ),
+            openapi.Parameter(
+                'page_size',
+                openapi.IN_QUERY,
+                description="Number of transactions per page",
+                type=openapi.TYPE_INTEGER,
+                required=False
+            ),
+            openapi.Parameter(
+                'export',
+                openapi.IN_QUERY,
+                description="Stream all matching transactions instead of a page",
+                type=openapi.TYPE_STRING,
+                enum=list(EXPORT_CONTENT_TYPES),
+                required=False
             )
         ],
         tags=['transactions']
     )
     def get(self, request):
         seller = request.user.seller
-        transactions = TransactionLog.objects.filter(seller=seller)
+        transactions = seller_transactions(seller, request.query_params)
+
+        export_format = request.query_params.get('export')
+        if export_format:
+            if export_format not in EXPORT_CONTENT_TYPES:
+                return Response({"error": "Unsupported export format"}, status=status.HTTP_400_BAD_REQUEST)
+            # Under ASGI, the handler would read a sync iterator whole before sending it
+            stream = astream_export if isinstance(request._request, ASGIRequest) else stream_export
+            response = StreamingHttpResponse(
+                stream(transactions, export_format),
+                content_type=EXPORT_CONTENT_TYPES[export_format]
+            )
+            response['Content-Disposition'] = f'attachment; filename="transactions.{export_format}"'
+            return response
+
+        try:
+            page_size = parse_page_size(request.query_params.get('page_size'))
+            rows = list(keyset_page(transactions, request.query_params.get('cursor'), page_size))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Optional date filtering
+        rows, next_cursor = split_page(rows, page_size)
+        serializer = TransactionLogSerializer(rows, many=True)
+        return Response({"results": serializer.data, "next_cursor": next_cursor})
+
+class StatementAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+
+    @swagger_auto_schema(
+        operation_description="Get per-day totals of each transaction type with opening and closing "
+                              "balances, and the totals of the whole range. Defaults to the current month.",
+        responses={
+            200: openapi.Response(
+                description="Statement",
+                examples={
+                    "application/json": {
+                        "start_date": "2024-01-01",
+                        "end_date": "2024-01-31",
+                        "opening_balance": "100.00",
+                        "closing_balance": "80.00",
+                        "totals": {"charge_sale": {"amount": "-20.00", "count": 2}},
+                        "days": [
+                            {
+                                "day": "2024-01-02",
+                                "transaction_type": "charge_sale",
+                                "amount": "-20.00",
+                                "count": 2,
+                                "opening_balance": "100.00",
+                                "closing_balance": "80.00"
+                            }
+                        ]
+                    }
+                }
+            ),
+            400: "Bad Request - Invalid dates",
+            401: "Authentication credentials were not provided or are invalid"
+        },
+        operation_summary="Get Statement",
+        manual_parameters=[
+            openapi.Parameter(
+                'start_date',
+                openapi.IN_QUERY,
+                description="First day (YYYY-MM-DD)",
+                type=openapi.TYPE_STRING,
+                required=False
+            ),
+            openapi.Parameter(
+                'end_date',
+                openapi.IN_QUERY,
+                description="Last day, inclusive (YYYY-MM-DD)",
+                type=openapi.TYPE_STRING,
+                required=False
+            )
+        ],
+        tags=['transactions']
+    )
+    def get(self, request):
+        today = timezone.localdate()
         start_date = request.query_params.get('start_date')
         end_date = request.query_params.get('end_date')
+        try:
+            start = parse_date(start_date) if start_date else today.replace(day=1)
+            end = parse_date(end_date) if end_date else today
+        except ValueError:
+            start = end = None
+        if start is None or end is None or start > end:
+            return Response({"error": "Invalid start_date or end_date"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if start_date:
-            transactions = transactions.filter(created_at__gte=start_date)
-        if end_date:
-            transactions = transactions.filter(created_at__lte=end_date)
+        return Response(seller_statement(request.user.seller.id, start, end))
 
-        serializer = TransactionLogSerializer(transactions, many=True)
-        return Response(serializer.data)
+class BalanceAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+
+    @swagger_auto_schema(
+        operation_description="Get the seller's current credit from the balance cache. "
+                              "age_seconds tells how long ago the value was read from a committed state.",
+        responses={
+            200: openapi.Response(
+                description="Balance",
+                examples={
+                    "application/json": {
+                        "credit": "80.00",
+                        "last_seq": 42,
+                        "updated_at": "2024-01-01T12:00:00+00:00",
+                        "source": "cache",
+                        "age_seconds": 1.204
+                    }
+                }
+            ),
+            401: "Authentication credentials were not provided or are invalid"
+        },
+        operation_summary="Get Balance",
+        tags=['sellers']
+    )
+    def get(self, request):
+        return Response(seller_balance(request.user.seller.id))
 
 class ChargeAPIView(APIView):
     permission_classes = [IsAuthenticated]
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
+    throttle_classes = [SellerRateThrottle]
+    throttle_scope = 'charge'
     
     @swagger_auto_schema(
         operation_description="Create a new charge request for a seller",
         request_body=ChargeSerializer,
         responses={
+            201: openapi.Response(
+                description="Charge completed (sync mode). For a seller with sharded credit, "
+                            "balance_after is null and shard_balance_after is the debited shard's balance",
+                examples={
+                    "application/json": {
+                        "charge_id": "3fa85f64-5717-4562-b3fc-2c963f66afa6",
+                        "status": "completed",
+                        "amount": "10.00",
+                        "balance_after": "90.00"
+                    }
+                }
+            ),
             202: openapi.Response(
-                description="Charge request accepted",
+                description="Charge request accepted; its outcome is served at /api/charge/<charge_id>/",
                 examples={
                     "application/json": {
-                        "status": "Charge request accepted and is being processed."
+                        "charge_id": "0190b6c2-7d3e-7a41-9c55-3f0e8b2d4a61",
+                        "status": "pending",
+                        "amount": "10.00",
+                        "balance_after": None
                     }
                 }
             ),
             400: openapi.Response(
-                description="Bad request - invalid input",
+                description="Bad request - invalid input, or insufficient credit (sync mode)",
+            ),
+            409: openapi.Response(
+                description="A request with the same Idempotency-Key is still being processed"
+            ),
+            429: openapi.Response(
+                description="Over the seller's charge rate, or too many charges of the seller "
+                            "still pending; retry after the Retry-After seconds"
             ),
             401: openapi.Response(
                 description="Authentication credentials were not provided or are invalid"
             )
         },
+        manual_parameters=[
+            openapi.Parameter(
+                IDEMPOTENCY_KEY_HEADER,
+                openapi.IN_HEADER,
+                description="Client-generated key; retries with the same key return the original "
+                            "outcome instead of charging again",
+                type=openapi.TYPE_STRING,
+                required=False
+            )
+        ],
         operation_summary="Create Charge Request",
         tags=['charges']
     )
@@ -170,15 +369,252 @@ class ChargeAPIView(APIView):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
         validated_data = serializer.validated_data
+
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if idempotency_key is not None:
+            error = idempotency.validate_key(idempotency_key)
+            if error:
+                return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
         
-        seller_id = request.user.seller.id
+        response_data, status_code = submit_charge(
+            request.user.seller,
+            validated_data['amount'],
+            str(validated_data['phone_number']),
+            idempotency_key,
+        )
+        return Response(response_data, status=status_code)
+
+
+class ChargeDetailAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
 
-        # Offload the database operation to Celery
-        process_charge_task.delay(
-            seller_id=seller_id,
-            amount_str=str(validated_data['amount']),
-            phone_number=str(validated_data['phone_number']),
+    @swagger_auto_schema(
+        operation_description="Get the outcome of a charge. With `wait`, a pending charge is held "
+                              "for up to that many seconds (at most CHARGE_STATUS_MAX_WAIT) until "
+                              "its outcome is published, instead of polling. Each waiting request "
+                              "holds a thread; under ASGI, long-poll /api/async/charge/<charge_id>/.",
+        manual_parameters=[
+            openapi.Parameter(
+                'wait',
+                openapi.IN_QUERY,
+                description="Seconds to wait while the charge is pending",
+                type=openapi.TYPE_NUMBER,
+                required=False
+            )
+        ],
+        responses={
+            200: openapi.Response(
+                description="The charge; status is still 'pending' if the wait timed out",
+                examples={
+                    "application/json": {
+                        "charge_id": "0190b6c2-7d3e-7a41-9c55-3f0e8b2d4a61",
+                        "status": "completed",
+                        "amount": "10.00",
+                        "balance_after": "90.00"
+                    }
+                }
+            ),
+            400: openapi.Response(description="Invalid wait"),
+            404: openapi.Response(description="No such charge for this seller"),
+            401: openapi.Response(
+                description="Authentication credentials were not provided or are invalid"
+            )
+        },
+        operation_summary="Get Charge",
+        tags=['charges']
+    )
+    def get(self, request, charge_id, *args, **kwargs):
+        try:
+            wait = parse_wait(request.query_params.get('wait'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        data = wait_for_charge(request.user.seller.id, charge_id, wait)
+        if data is None:
+            return Response({"error": "Charge not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(data)
+
+
+def _charges_from_csv(upload):
+    """
+    Reads the lines of an uploaded CSV with a phone_number,amount header.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(upload, encoding='utf-8-sig'))
+    return [
+        {'phone_number': row.get('phone_number'), 'amount': row.get('amount')}
+        for row in reader
+    ]
+
+class ChargeBatchAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+
+    @swagger_auto_schema(
+        operation_description="Submit many charges at once, as a JSON list of charges, an object "
+                              "with 'mode' and 'charges', or a multipart CSV 'file' with a "
+                              "phone_number,amount header. In 'partial' mode lines are settled in "
+                              "order while the credit covers them; in 'all_or_nothing' mode either "
+                              "every line is charged or none is.",
+        request_body=ChargeBatchSerializer,
+        responses={
+            201: openapi.Response(description="Batch processed (sync mode)"),
+            202: openapi.Response(
+                description="Batch accepted",
+                examples={
+                    "application/json": {
+                        "batch_id": "3fa85f64-5717-4562-b3fc-2c963f66afa6",
+                        "mode": "partial",
+                        "status": "pending",
+                        "line_count": 2,
+                        "total_amount": "30.00",
+                        "completed_count": 0,
+                        "failed_count": 0,
+                        "created_at": "2024-01-01T12:00:00+00:00",
+                        "processed_at": None
+                    }
+                }
+            ),
+            400: openapi.Response(description="Bad request - invalid lines, reported per line"),
+            401: openapi.Response(
+                description="Authentication credentials were not provided or are invalid"
+            )
+        },
+        operation_summary="Create Charge Batch",
+        tags=['charges']
+    )
+    def post(self, request, *args, **kwargs):
+        if 'file' in request.FILES:
+            try:
+                charges = _charges_from_csv(request.FILES['file'])
+            except (UnicodeDecodeError, csv.Error):
+                return Response({"error": "file must be a UTF-8 CSV"}, status=status.HTTP_400_BAD_REQUEST)
+            data = {'mode': request.data.get('mode', 'partial'), 'charges': charges}
+        elif isinstance(request.data, list):
+            data = {'charges': request.data}
+        else:
+            data = request.data
+
+        serializer = ChargeBatchSerializer(data=data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        lines = [
+            (str(charge['phone_number']), charge['amount'])
+            for charge in serializer.validated_data['charges']
+        ]
+        response_data, status_code = submit_charge_batch(
+            request.user.seller, lines, serializer.validated_data['mode']
         )
-        
-        # Return an immediate response to the client
-        return Response({"status": "Charge request accepted and is being processed."}, status=status.HTTP_202_ACCEPTED)
+        return Response(response_data, status=status_code)
+
+class ChargeBatchDetailAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+
+    @swagger_auto_schema(
+        operation_description="Get a charge batch with the outcome of each line",
+        responses={
+            200: openapi.Response(description="Batch summary and per-line outcomes"),
+            404: openapi.Response(description="No such batch for this seller"),
+            401: openapi.Response(
+                description="Authentication credentials were not provided or are invalid"
+            )
+        },
+        operation_summary="Get Charge Batch",
+        tags=['charges']
+    )
+    def get(self, request, batch_id, *args, **kwargs):
+        batch = ChargeBatch.objects.filter(pk=batch_id, seller_id=request.user.seller.id).first()
+        if batch is None:
+            return Response({"error": "Charge batch not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        lines = batch.charges.order_by('batch_line').values_list(
+            'batch_line', 'unique_id', 'phone_number', 'amount', 'status'
+        )
+        return Response(charge_batch_result(batch, lines))
+
+
+class TransferAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [CachedTokenAuthentication]
+
+    @swagger_auto_schema(
+        operation_description="Transfer credit to sub-resellers: a single transfer as an object "
+                              "with 'to_seller' and 'amount', or a fan-out as a JSON list of them or "
+                              "an object with 'transfers'. Either every transfer happens or none does.",
+        request_body=TransferBatchSerializer,
+        responses={
+            201: openapi.Response(
+                description="Transfers completed",
+                examples={
+                    "application/json": {
+                        "status": "completed",
+                        "transfers": [
+                            {
+                                "transfer_id": "0190a4b2-7c1e-7b3a-9f2d-2c963f66afa6",
+                                "to_seller": 7,
+                                "amount": "250.00"
+                            }
+                        ],
+                        "total_amount": "250.00",
+                        "balance_after": "750.00"
+                    }
+                }
+            ),
+            400: openapi.Response(
+                description="Bad request - invalid transfers, recipients that are not sub-resellers, "
+                            "or insufficient credit"
+            ),
+            401: openapi.Response(
+                description="Authentication credentials were not provided or are invalid"
+            ),
+            409: openapi.Response(
+                description="A request with the same Idempotency-Key is still being processed"
+            )
+        },
+        manual_parameters=[
+            openapi.Parameter(
+                IDEMPOTENCY_KEY_HEADER,
+                openapi.IN_HEADER,
+                description="Client-generated key; retries with the same key return the original "
+                            "outcome instead of transferring again",
+                type=openapi.TYPE_STRING,
+                required=False
+            )
+        ],
+        operation_summary="Transfer Credit",
+        tags=['credit']
+    )
+    def post(self, request, *args, **kwargs):
+        if isinstance(request.data, list):
+            data = {'transfers': request.data}
+        elif 'transfers' in request.data:
+            data = request.data
+        else:
+            data = {'transfers': [request.data]}
+
+        sender = request.user.seller
+        serializer = TransferBatchSerializer(data=data, context={'sender': sender})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+        if idempotency_key is not None:
+            error = idempotency.validate_key(idempotency_key)
+            if error:
+                return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        response_data, status_code = submit_transfer(sender.id, [
+            (transfer['to_seller'], transfer['amount']) for transfer in serializer.validated_data['transfers']
+        ], idempotency_key)
+        return Response(response_data, status=status_code)
+
+
+def metrics_view(request):
+    """
+    The metrics of the process serving the request, in the Prometheus text format.
+    """
+    if not metrics.enabled():
+        raise Http404
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -1,5 +1,13 @@
+import bisect
+import hashlib
+import logging
 import os
+from functools import lru_cache
+
 from celery import Celery
+from celery.signals import worker_process_init
+
+logger = logging.getLogger(__name__)
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'b2b_project.settings')
@@ -11,4 +19,82 @@ app = Celery('b2b_project')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django apps.
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+
+class HashRing:
+    """
+    Consistent hash ring: every node owns `replicas` points on the ring and a key
+    belongs to the first point after its hash. Adding a node only moves the keys
+    of the points it takes over, roughly 1/n of them.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+    def get(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def charge_queue_names(count=None):
+    from django.conf import settings
+
+    count = settings.CHARGE_QUEUE_COUNT if count is None else count
+    return [f"{settings.CHARGE_QUEUE_PREFIX}.{i}" for i in range(count)]
+
+
+@lru_cache(maxsize=8)
+def _charge_ring(queues):
+    return HashRing(queues)
+
+
+def charge_queue(seller_id):
+    """
+    The queue of the seller's charge tasks, or None when per-seller queues are off.
+    """
+    queues = tuple(charge_queue_names())
+    if not queues:
+        return None
+    return _charge_ring(queues).get(seller_id)
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    Sends tasks marked `seller_routed` to their seller's charge queue. Each queue is
+    consumed by a single process, so a seller's charges run one at a time, in arrival
+    order, instead of queueing on the seller's row lock in Postgres.
+    """
+    if not getattr(task, 'seller_routed', False):
+        return None
+    seller_id = (kwargs or {}).get('seller_id', args[0] if args else None)
+    queue = charge_queue(seller_id)
+    return {'queue': queue} if queue else None
+
+
+app.conf.task_routes = (route_task,)
+
+
+@worker_process_init.connect
+def serve_worker_metrics(**kwargs):
+    """
+    Every prefork worker process keeps its own metrics, so each serves them on its
+    own port, METRICS_WORKER_PORT + the process index.
+    """
+    from billiard.process import current_process
+    from django.conf import settings
+    from B2B_shop.metrics import serve_metrics
+
+    if not (settings.METRICS_ENABLED and settings.METRICS_WORKER_PORT):
+        return
+    port = settings.METRICS_WORKER_PORT + getattr(current_process(), 'index', 0)
+    try:
+        serve_metrics(port)
+    except OSError as e:
+        logger.warning("Cannot serve worker metrics on port %s: %s", port, e)
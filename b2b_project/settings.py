@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'B2B_shop.profiling.QueryProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -134,7 +135,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'B2B_shop.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
@@ -148,8 +149,128 @@ CACHES = {
     }
 }
 
+# Charge processing: 'task' runs one Celery task per charge,
+# 'batch' buffers charges per seller and settles them in flushes,
+# 'sync' debits inside the request and returns the outcome,
+# 'outbox' only stores the charge and the relay_charge_outbox process publishes it.
+CHARGE_PROCESSING_MODE = os.environ.get('CHARGE_PROCESSING_MODE', 'task')
+CHARGE_BATCH_MAX_SIZE = int(os.environ.get('CHARGE_BATCH_MAX_SIZE', 500))
+CHARGE_BATCH_FLUSH_INTERVAL_MS = int(os.environ.get('CHARGE_BATCH_FLUSH_INTERVAL_MS', 50))
+# Charge outbox relay: most charges published per round, the pause after a round that
+# was not full, and the seconds after which a charge still pending is published again
+CHARGE_OUTBOX_BATCH_SIZE = int(os.environ.get('CHARGE_OUTBOX_BATCH_SIZE', 1000))
+CHARGE_OUTBOX_POLL_INTERVAL_MS = int(os.environ.get('CHARGE_OUTBOX_POLL_INTERVAL_MS', 50))
+CHARGE_OUTBOX_REDELIVER_AFTER = int(os.environ.get('CHARGE_OUTBOX_REDELIVER_AFTER', 300))
+# Most lines accepted by one /api/charge/batch/ submission
+CHARGE_BATCH_MAX_LINES = int(os.environ.get('CHARGE_BATCH_MAX_LINES', 10000))
+# Most recipients of one /api/transfer/ fan-out
+TRANSFER_MAX_RECIPIENTS = int(os.environ.get('TRANSFER_MAX_RECIPIENTS', 1000))
+# How long the outcome of a charge is cached for Idempotency-Key replays (seconds)
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+# How long accepted charges and their outcomes are cached for /api/charge/<id>/ (seconds),
+# and the longest a request may wait there for a pending charge
+CHARGE_STATUS_TTL = int(os.environ.get('CHARGE_STATUS_TTL', 60 * 60))
+CHARGE_STATUS_MAX_WAIT = float(os.environ.get('CHARGE_STATUS_MAX_WAIT', 30))
+
+# Admission control (B2B_shop.ratelimit) of the charge and credit request endpoints:
+# a token bucket per seller (rate per minute, burst), and a cap on each seller's accepted
+# charges that have not settled yet. Over-limit requests get a 429 with Retry-After.
+# Sellers can override their limits in the admin; 0 turns a limit off
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+CHARGE_RATE_LIMIT = int(os.environ.get('CHARGE_RATE_LIMIT', 6000))
+CHARGE_RATE_BURST = int(os.environ.get('CHARGE_RATE_BURST', 200))
+CREDIT_REQUEST_RATE_LIMIT = int(os.environ.get('CREDIT_REQUEST_RATE_LIMIT', 10))
+CREDIT_REQUEST_RATE_BURST = int(os.environ.get('CREDIT_REQUEST_RATE_BURST', 10))
+MAX_INFLIGHT_CHARGES = int(os.environ.get('MAX_INFLIGHT_CHARGES', 1000))
+# Longest an accepted charge counts as in flight, in case its outcome is never published (seconds),
+# and the Retry-After of a request refused by the cap
+INFLIGHT_CHARGE_TTL = int(os.environ.get('INFLIGHT_CHARGE_TTL', 300))
+INFLIGHT_RETRY_AFTER = int(os.environ.get('INFLIGHT_RETRY_AFTER', 1))
+
+# Ledger transactions (B2B_shop.ledger) that hit a deadlock, a serialization failure or a
+# NOWAIT lock conflict are run again up to LEDGER_MAX_RETRIES times, after a random pause
+# of up to LEDGER_RETRY_BACKOFF_MS that doubles per attempt, capped at LEDGER_RETRY_MAX_BACKOFF_MS
+LEDGER_MAX_RETRIES = int(os.environ.get('LEDGER_MAX_RETRIES', 5))
+LEDGER_RETRY_BACKOFF_MS = int(os.environ.get('LEDGER_RETRY_BACKOFF_MS', 10))
+LEDGER_RETRY_MAX_BACKOFF_MS = int(os.environ.get('LEDGER_RETRY_MAX_BACKOFF_MS', 500))
+
+# New credit requests matching a CreditApprovalRule are approved right away (B2B_shop.auto_approval).
+# Each process compiles the rules in memory and checks whether an admin edited them at most
+# every AUTO_APPROVAL_RULES_CHECK_INTERVAL seconds
+AUTO_APPROVAL_ENABLED = os.environ.get('AUTO_APPROVAL_ENABLED', '1') == '1'
+AUTO_APPROVAL_RULES_CHECK_INTERVAL = float(os.environ.get('AUTO_APPROVAL_RULES_CHECK_INTERVAL', 1))
+
+# Token identities are cached in-process and in Redis (seconds).
+# Another process may see a revoked token for up to the local TTL.
+AUTH_TOKEN_LOCAL_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_LOCAL_CACHE_SIZE', 10000))
+AUTH_TOKEN_LOCAL_CACHE_TTL = int(os.environ.get('AUTH_TOKEN_LOCAL_CACHE_TTL', 30))
+AUTH_TOKEN_CACHE_TTL = int(os.environ.get('AUTH_TOKEN_CACHE_TTL', 300))
+
+# Seconds a cached balance snapshot is served; every commit that changes credit rewrites it
+BALANCE_CACHE_TTL = int(os.environ.get('BALANCE_CACHE_TTL', 300))
+
+# Transaction history pagination
+TRANSACTIONS_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_PAGE_SIZE', 100))
+TRANSACTIONS_MAX_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_MAX_PAGE_SIZE', 1000))
+
+# Default number of shards used when an admin enables credit sharding for a seller
+SELLER_CREDIT_SHARDS = int(os.environ.get('SELLER_CREDIT_SHARDS', 8))
+
+# Seconds log entries get to commit after midnight before their day is rolled up
+LEDGER_ROLLUP_SETTLE_SECONDS = int(os.environ.get('LEDGER_ROLLUP_SETTLE_SECONDS', 300))
+
+# Ledger reconciliation reads each balance_after chain in chunks of this many entries
+RECONCILIATION_CHUNK_SIZE = int(os.environ.get('RECONCILIATION_CHUNK_SIZE', 5000))
+
+# Monthly partitions of the transaction log and charges (Postgres): how many months
+# ahead are created, how many past months are kept attached (0 keeps everything),
+# and where manage_partitions writes archived partitions
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+PARTITION_RETENTION_MONTHS = int(os.environ.get('PARTITION_RETENTION_MONTHS', 0))
+PARTITION_ARCHIVE_DIR = os.environ.get('PARTITION_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+
+# Per-seller charge queues: charge tasks go to one of CHARGE_QUEUE_COUNT queues
+# ('charges.0', ...) chosen by consistent hashing of the seller id, each consumed by a
+# single worker process. 0 keeps them on the default queue.
+CHARGE_QUEUE_COUNT = int(os.environ.get('CHARGE_QUEUE_COUNT', 0))
+CHARGE_QUEUE_PREFIX = os.environ.get('CHARGE_QUEUE_PREFIX', 'charges')
+
+# In-process charge metrics (B2B_shop.metrics), served at /metrics by the web process.
+# Celery worker processes serve theirs on METRICS_WORKER_PORT + the process index (0: off)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_WORKER_PORT = int(os.environ.get('METRICS_WORKER_PORT', 0))
+
+# Per-request query profiling (B2B_shop.profiling): counts and DB time per endpoint go
+# to the metrics, statements slower than QUERY_PROFILING_SLOW_MS are logged and, with
+# DEBUG on, responses carry the QUERY_PROFILING_SLOWEST slowest statements in a header
+QUERY_PROFILING_ENABLED = os.environ.get('QUERY_PROFILING_ENABLED', '1') == '1'
+QUERY_PROFILING_SLOW_MS = float(os.environ.get('QUERY_PROFILING_SLOW_MS', 100))
+QUERY_PROFILING_SLOWEST = int(os.environ.get('QUERY_PROFILING_SLOWEST', 3))
+
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0")
+# Tasks are short and DB-bound: a process reserves one task at a time, so a slow
+# task does not hold others back that another process could run
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_BEAT_SCHEDULE = {
+    'rebalance-credit-shards': {
+        'task': 'B2B_shop.tasks.rebalance_all_credit_shards_task',
+        'schedule': 30.0,
+    },
+    'refresh-ledger-rollups': {
+        'task': 'B2B_shop.tasks.refresh_ledger_rollups_task',
+        'schedule': 300.0,
+    },
+    'reconcile-ledger': {
+        'task': 'B2B_shop.tasks.reconcile_all_sellers_task',
+        'schedule': 600.0,
+    },
+    'ensure-partitions': {
+        'task': 'B2B_shop.tasks.ensure_partitions_task',
+        'schedule': 24 * 60 * 60.0,
+    },
+}
 
 SWAGGER_SETTINGS = {
     'USE_SESSION_AUTH': False
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.authtoken import views
+
+from B2B_shop.views import metrics_view
 from rest_framework import permissions
 
 from rest_framework.authentication import SessionAuthentication
@@ -22,6 +24,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('B2B_shop.urls')),
     path('api/token/', views.obtain_auth_token),
+    path('metrics', metrics_view, name='metrics'),
    #  path('api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 
 